@@ -0,0 +1,391 @@
+# irc.py - an IRC-like implementation for Portland State University's
+#          CS594 - Internetworking Protocols project
+#
+# Copyright (C) 2017  Jeremiah Peschka <jpeschka@pdx.edu>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+# Asyncio client library for CS594 project
+#
+# For bots, bridges and tests that talk to the server from code rather than
+# a terminal:
+#
+#     async with AsyncClient("bot") as bot:
+#         await bot.connect("127.0.0.1", 8080)
+#         await bot.join("room")
+#         async for message in bot:
+#             if isinstance(message, common.MessageRoom):
+#                 await bot.msg(message.room, "heard " + message.username)
+
+from collections import deque
+from typing import List
+import asyncio
+import unittest
+import unittest.mock
+import common
+
+# Pushed messages kept for the iterator before the oldest are dropped
+QUEUE_LIMIT = 1024
+# Names asked for in each page when a list_* call gathers a whole listing
+LIST_PAGE = 1000
+
+
+class RequestFailed(Exception):
+    """Raised when the server answers a request with an error. The reply is
+    kept on `reply` and its error code on `error`."""
+
+    def __init__(self, reply: common.IrcPacket):
+        super().__init__(type(reply).__name__ + " failed: " +
+                         reply.error.name)
+        self.reply = reply
+        self.error = reply.error
+
+
+class AsyncClient(object):
+    """One user's session with the server, driven from an event loop.
+
+    Requests are pipelined: each call writes its request and waits only for
+    its own reply, which is matched against the oldest outstanding request
+    the way client.ServerSession does. Everything else the server sends
+    (room messages, private messages, broadcasts, presence events and
+    replayed history) comes out of `async for message in client`. Pings
+    from the server are answered without the caller's help.
+
+    A client is a stream pair and one reader task, so thousands of them can
+    share an event loop.
+    """
+
+    def __init__(self, nick: str, queue_limit: int = QUEUE_LIMIT):
+        self.nick = nick
+        self.reader: asyncio.StreamReader = None
+        self.writer: asyncio.StreamWriter = None
+        self.read_task: asyncio.Task = None
+        # (request, Future) pairs in the order they were written
+        self.pending = deque()
+        self.binary = False
+        self.compressor: common.Compressor = None
+        self.decompressor: common.Decompressor = None
+        # Features the server agreed to at Connect
+        self.features = 0
+        # Pushed messages waiting for the iterator. When it falls behind,
+        # the oldest are dropped and counted rather than held without
+        # limit or left to stall replies.
+        self.incoming = asyncio.Queue(queue_limit)
+        self.dropped = 0
+        # Set once the server accepts our Connect, so close() only
+        # disconnects a nick that is ours
+        self.connected = False
+        self.closed = False
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self) -> common.IrcPacket:
+        if self.closed and self.incoming.empty():
+            raise StopAsyncIteration
+        message = await self.incoming.get()
+        if message is None:
+            raise StopAsyncIteration
+        return message
+
+    async def connect(self, host: str = "127.0.0.1", port: int = 8080,
+                      binary: bool = True, compress: bool = False,
+                      presence: bool = False) -> common.Connect:
+        """Opens a session as `nick`. Raises RequestFailed if the server
+        refuses it, such as when the nick is taken."""
+        self.reader, self.writer = await asyncio.open_connection(host, port)
+        self.read_task = asyncio.ensure_future(self.read_forever())
+        # Pings are answered without the caller's help.
+        features = common.FEATURE_HEARTBEAT
+        if binary or compress:
+            features |= common.FEATURE_BINARY
+        if compress:
+            features |= common.FEATURE_COMPRESS
+            # The server may compress from its reply on.
+            self.decompressor = common.Decompressor()
+        if presence:
+            features |= common.FEATURE_PRESENCE
+        reply = await self.call(
+            common.Connect(self.nick, 0, features=features))
+        self.features = reply.features
+        self.connected = True
+        if reply.features & common.FEATURE_COMPRESS:
+            self.compressor = common.Compressor()
+        return reply
+
+    def send(self, packet: common.IrcPacket) -> asyncio.Future:
+        """Writes a request and returns a Future for its reply, which is
+        None if the connection closes first."""
+        if self.closed:
+            raise ConnectionResetError("client is closed")
+        future = asyncio.get_running_loop().create_future()
+        self.pending.append((packet, future))
+        if self.compressor is not None:
+            self.writer.write(self.compressor.pack(packet.encode_binary()))
+        elif self.binary:
+            self.writer.write(packet.encode_binary())
+        else:
+            self.writer.write(packet.encode())
+        return future
+
+    async def request(self, packet: common.IrcPacket) -> common.IrcPacket:
+        """Sends a request and returns the server's reply as it is."""
+        future = self.send(packet)
+        await self.writer.drain()
+        return await future
+
+    async def call(self, packet: common.IrcPacket) -> common.IrcPacket:
+        """Sends a request and returns its reply, raising RequestFailed if
+        it is an error and ConnectionResetError if no reply comes."""
+        reply = await self.request(packet)
+        if reply is None:
+            raise ConnectionResetError("connection closed before the reply")
+        if reply.status != common.Status.OK:
+            raise RequestFailed(reply)
+        return reply
+
+    async def create(self, room: str):
+        await self.call(common.CreateRoom(room, self.nick))
+
+    async def join(self, room: str, history: int = 0):
+        """Joins a room, asking for its last `history` messages, which
+        arrive through the iterator."""
+        await self.call(common.JoinRoom(room, self.nick, history=history))
+
+    async def leave(self, room: str):
+        await self.call(common.LeaveRoom(room, self.nick))
+
+    async def msg(self, room: str, text: str):
+        await self.call(common.MessageRoom(room, text, self.nick))
+
+    async def pm(self, to: str, text: str):
+        await self.call(common.PrivateMessage(self.nick, to, text))
+
+    async def broadcast(self, text: str):
+        await self.call(common.Broadcast(text, self.nick))
+
+    async def history(self, room: str, count: int) -> int:
+        """Replays up to `count` recent messages of a room through the
+        iterator and returns how many there were."""
+        reply = await self.call(common.RoomHistory(room, self.nick, count))
+        return reply.count
+
+    async def list_rooms(self, prefix: str = "") -> List[str]:
+        return await self.gather(
+            lambda cursor: common.ListRooms(
+                [], self.nick, cursor=cursor, limit=LIST_PAGE,
+                prefix=prefix), "rooms")
+
+    async def list_users(self, prefix: str = "") -> List[str]:
+        return await self.gather(
+            lambda cursor: common.ListUsers(
+                [], self.nick, cursor=cursor, limit=LIST_PAGE,
+                prefix=prefix), "users")
+
+    async def list_users_in(self, room: str, prefix: str = "") -> List[str]:
+        return await self.gather(
+            lambda cursor: common.ListUsersInRoom(
+                [], room, self.nick, cursor=cursor, limit=LIST_PAGE,
+                prefix=prefix), "users")
+
+    async def gather(self, page, field: str) -> List[str]:
+        """Follows a listing's cursor until every page has been read.
+        `page` makes the request for the page after a cursor."""
+        names = []
+        cursor = ""
+        while True:
+            reply = await self.call(page(cursor))
+            names.extend(getattr(reply, field))
+            if not reply.cursor:
+                return names
+            cursor = reply.cursor
+
+    async def stats(self) -> List[str]:
+        reply = await self.call(common.ServerStats([], self.nick))
+        return reply.stats
+
+    async def close(self):
+        """Disconnects, if still connected, and waits for the reader to
+        finish."""
+        if self.writer is None:
+            return
+        if self.connected and not self.closed:
+            try:
+                await self.request(common.Disconnect(self.nick))
+            except ConnectionError:
+                pass
+        self.closed = True
+        self.writer.close()
+        await self.read_task
+
+    async def read_frame(self) -> bytes:
+        """Reads the next frame from the server. Returns b"" at EOF."""
+        first = b""
+        if not self.binary:
+            first = await self.reader.read(1)
+            if not common.starts_binary(first):
+                if not first:
+                    return b""
+                return first + await self.reader.readline()
+            self.binary = True
+        return await common.read_binary_async(self.reader, self.decompressor,
+                                              first)
+
+    async def read_forever(self):
+        try:
+            while True:
+                data = await self.read_frame()
+                if not data:
+                    break
+                if self.binary:
+                    message = common.decode_binary(data)
+                else:
+                    message = common.decode(data)
+                self.dispatch(message)
+        except (ConnectionError, TypeError, asyncio.IncompleteReadError):
+            # Without a sane frame there's no finding the next one.
+            pass
+        finally:
+            self.closed = True
+            while self.pending:
+                future = self.pending.popleft()[1]
+                if not future.done():
+                    future.set_result(None)
+            self.push(None)
+
+    def dispatch(self, message: common.IrcPacket):
+        if self.pending and common.is_reply(message, self.pending[0][0]):
+            future = self.pending.popleft()[1]
+            if not future.done():
+                future.set_result(message)
+            return
+        if isinstance(message, common.Ping):
+            # Replies to the answer are matched like any other and dropped.
+            if not self.closed and not self.writer.is_closing():
+                self.send(common.Ping(self.nick))
+            return
+        self.push(message)
+
+    def push(self, message):
+        incoming = self.incoming
+        if incoming.full():
+            incoming.get_nowait()
+            self.dropped += 1
+        incoming.put_nowait(message)
+
+
+class TestAsyncClient(unittest.TestCase):
+    """Runs clients against the asyncio engine in the same process."""
+
+    def setUp(self):
+        import registry
+        import server
+        self.server = server
+        for name, value in (("REGISTRY", registry.Registry()),
+                            ("ENGINE", "asyncio")):
+            patcher = unittest.mock.patch.object(server, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def run_with_server(self, test):
+        async def main():
+            listener = await asyncio.start_server(self.server.handle_stream,
+                                                  "127.0.0.1", 0)
+            port = listener.sockets[0].getsockname()[1]
+            try:
+                await test(port)
+            finally:
+                listener.close()
+                await listener.wait_closed()
+
+        asyncio.run(main())
+
+    def test_requests_and_messages(self):
+        async def test(port):
+            async with AsyncClient("alice") as alice, \
+                    AsyncClient("bob") as bob:
+                await alice.connect(port=port, presence=True)
+                await bob.connect(port=port, binary=False)
+                self.assertTrue(alice.binary)
+                self.assertFalse(bob.binary)
+                await alice.create("room")
+                await alice.join("room")
+                await bob.join("room")
+                await bob.msg("room", "hello")
+                await bob.pm("alice", "psst")
+                self.assertEqual(["alice", "bob"],
+                                 await alice.list_users_in("room"))
+                self.assertEqual(["room"], await bob.list_rooms())
+                received = []
+                async for message in alice:
+                    received.append(type(message).__name__)
+                    if isinstance(message, common.PrivateMessage):
+                        break
+                self.assertEqual(["Presence", "MessageRoom",
+                                  "PrivateMessage"], received)
+                with self.assertRaises(RequestFailed) as failed:
+                    await bob.join("nowhere")
+                self.assertEqual(common.Error.ROOM_NOT_FOUND,
+                                 failed.exception.error)
+
+        self.run_with_server(test)
+
+    def test_nick_taken(self):
+        async def test(port):
+            async with AsyncClient("alice") as first, \
+                    AsyncClient("alice") as second:
+                await first.connect(port=port)
+                with self.assertRaises(RequestFailed) as failed:
+                    await second.connect(port=port)
+                self.assertEqual(common.Error.USER_ALREADY_EXISTS,
+                                 failed.exception.error)
+                await second.close()
+                self.assertEqual(["alice"], await first.list_users())
+
+        self.run_with_server(test)
+
+    def test_paged_listing(self):
+        async def test(port):
+            clients = [AsyncClient("user%03d" % i) for i in range(30)]
+            await asyncio.gather(*(c.connect(port=port, compress=True)
+                                   for c in clients))
+            global LIST_PAGE
+            page, LIST_PAGE = LIST_PAGE, 7
+            try:
+                self.assertEqual([c.nick for c in clients],
+                                 await clients[0].list_users())
+                self.assertEqual(["user0" + str(i) for i in range(10, 20)],
+                                 await clients[0].list_users("user01"))
+            finally:
+                LIST_PAGE = page
+            await asyncio.gather(*(c.close() for c in clients))
+
+        self.run_with_server(test)
+
+    def test_dropped_when_behind(self):
+        client = AsyncClient("nobody", queue_limit=2)
+        for i in range(5):
+            client.push(i)
+        self.assertEqual(3, client.dropped)
+        self.assertEqual(3, client.incoming.get_nowait())
+
+
+if __name__ == '__main__':
+    unittest.main()
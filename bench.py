@@ -0,0 +1,328 @@
+# irc.py - an IRC-like implementation for Portland State University's
+#          CS594 - Internetworking Protocols project
+#
+# Copyright (C) 2017  Jeremiah Peschka <jpeschka@pdx.edu>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+# Microbenchmarks for CS594 project
+
+from dateutil import tz
+import datetime
+import io
+import os
+import sys
+import timeit
+import tracemalloc
+import dateutil.parser
+import common
+import limits
+import registry
+import render
+import server
+
+USAGE = """Usage: python3 bench.py [<benchmark> ...]
+
+Available benchmarks:
+"""
+
+
+class NullSession(object):
+    """Stands in for a client connection and discards everything sent."""
+
+    binary = False
+
+    def send(self, data: bytes):
+        pass
+
+
+class RetainingSession(object):
+    """Stands in for a client connection and keeps the last frame sent, the
+    way a queued frame stays alive until a writer gets to it."""
+
+    binary = False
+
+    def __init__(self):
+        self.data = None
+
+    def send(self, data: bytes):
+        self.data = data
+
+
+def populate(users: int,
+             rooms: int = 0,
+             members: int = 0,
+             session_class: type = NullSession):
+    """Replaces the server's registry with a fresh one holding `users`
+    connected users and `rooms` rooms of `members` users each."""
+    server.REGISTRY = registry.Registry()
+    for i in range(users):
+        server.REGISTRY.add_user(
+            registry.User("user" + str(i), ("127.0.0.1", 0), 0,
+                          session_class()))
+    for r in range(rooms):
+        name = "room" + str(r)
+        server.REGISTRY.add_room(registry.Room(name))
+        for i in range(members):
+            server.REGISTRY.join("user" + str((r * members + i) % users),
+                                 name)
+
+
+def report(name: str, seconds: float, count: int, unit: str = "op"):
+    print("{:<40} {:>10.2f} us/{}".format(name, seconds / count * 1e6, unit))
+
+
+def bench_fanout():
+    """Time to deliver one room message as the total user count grows."""
+    members = 50
+    count = 2000
+    for users in (100, 1000, 10000, 100000):
+        populate(users, 1, members)
+        packet = common.MessageRoom("room0", "hello, world", "user0")
+        seconds = timeit.timeit(
+            lambda: server.IRCServer.handle_message_room(packet),
+            number=count)
+        report("fanout {} members / {} users".format(members, users),
+               seconds, count, "msg")
+
+
+def bench_broadcast():
+    """Time and memory allocated to broadcast one message to 10k users."""
+    users = 10000
+    populate(users, session_class=RetainingSession)
+    packet = common.Broadcast("hello, everyone", "user0")
+
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    server.IRCServer.handle_broadcast(packet)
+    allocated = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+
+    frames = set(id(user.session.data)
+                 for user in server.REGISTRY.user_list())
+    seconds = timeit.timeit(lambda: server.IRCServer.handle_broadcast(packet),
+                            number=20)
+    report("broadcast to {} users".format(users), seconds, 20, "msg")
+    print("{:<40} {:>10} buffers, {} bytes retained".format(
+        "broadcast frames", len(frames), allocated))
+
+
+def bench_codec():
+    """Timestamp parsing and whole-packet decode costs."""
+    count = 20000
+    timestamp = common.MessageRoom("room", "", "user").timestamp.isoformat()
+    report("timestamp dateutil.parser.parse",
+           timeit.timeit(lambda: dateutil.parser.parse(timestamp),
+                         number=count), count)
+    report("timestamp common.parse_timestamp",
+           timeit.timeit(lambda: common.parse_timestamp(timestamp),
+                         number=count), count)
+
+    data = common.MessageRoom("room", "hello, world", "user").encode()
+    report("decode MessageRoom",
+           timeit.timeit(lambda: common.decode(data), number=count), count)
+    packet = common.MessageRoom("room", "hello, world", "user")
+    report("encode MessageRoom",
+           timeit.timeit(packet.encode, number=count), count)
+
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    packets = [common.decode(data) for _ in range(count)]
+    allocated = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+    print("{:<40} {:>10.1f} bytes/packet".format("decoded MessageRoom size",
+                                                 allocated / len(packets)))
+
+
+def bench_frames():
+    """Frames per second through the text and binary codecs, alone and when
+    read back off a buffered stream the way the server reads requests."""
+    count = 20000
+    packet = common.MessageRoom("room", "hello, world", "user")
+    # decode_binary() takes the frame body; read_binary() strips the length.
+    prefix = common.FRAME_LENGTH.size
+    for name, roundtrip in (
+        ("text", lambda: common.decode(packet.encode())),
+        ("binary", lambda: common.decode_binary(packet.encode_binary()[prefix:])),
+    ):
+        seconds = timeit.timeit(roundtrip, number=count)
+        print("{:<40} {:>10.0f} frames/s".format(name + " encode+decode",
+                                                 count / seconds))
+
+    text = io.BytesIO(packet.encode() * count)
+    binary = io.BytesIO(packet.encode_binary() * count)
+
+    def parse_text():
+        text.seek(0)
+        for line in text:
+            common.decode(line)
+
+    def parse_binary():
+        binary.seek(0)
+        data = common.read_binary(binary)
+        while data:
+            common.decode_binary(data)
+            data = common.read_binary(binary)
+
+    for name, parse in (("text", parse_text), ("binary", parse_binary)):
+        seconds = timeit.timeit(parse, number=1)
+        print("{:<40} {:>10.0f} frames/s".format(name + " stream parse",
+                                                 count / seconds))
+
+
+def bench_listing():
+    """Time to list users whole and a page at a time as the user count
+    grows."""
+    count = 20
+    for users in (1000, 10000, 50000):
+        populate(users)
+        whole = common.ListUsers([], "user0")
+        report("list all of {} users".format(users),
+               timeit.timeit(lambda: server.IRCServer.handle_list_users(whole),
+                             number=count), count)
+        # The reply's cursor is written back to the same packet, so each
+        # call asks for the page after the last, as a client paging through
+        # would.
+        page = common.ListUsers([], "user0", limit=50)
+        report("list 50 of {} users".format(users),
+               timeit.timeit(lambda: server.IRCServer.handle_list_users(page),
+                             number=count * 100), count * 100)
+
+
+def bench_throttle():
+    """Time to refuse a broadcast over the sender's rate limit, next to the
+    time to serve one."""
+    count = 2000
+    populate(10000)
+    packet = common.Broadcast("hello, everyone", "user0")
+    served = timeit.timeit(
+        lambda: server.IRCServer.handle_request(packet, None, None),
+        number=20)
+    report("broadcast to 10000 users, served", served, 20, "msg")
+    server.LIMITS = limits.RateLimits({"BROADCAST": (1, 1)})
+    try:
+        seconds = timeit.timeit(
+            lambda: server.IRCServer.handle_request(packet, None, None),
+            number=count)
+    finally:
+        server.LIMITS = None
+    report("broadcast over its rate limit, refused", seconds, count, "msg")
+
+
+def bench_compress():
+    """CPU time per frame against bytes saved when compressing a stream of
+    frames, for several kinds of traffic and deflate levels."""
+    count = 2000
+    nicks = ["user" + str(i) for i in range(1000)]
+    lines = [
+        "a somewhat longer message, line number {} of a paste that goes "
+        "on for a while, long enough that it clears the compression "
+        "threshold with plenty to spare, the way pasted logs and stack "
+        "traces tend to when people share them".format(i)
+        for i in range(count)
+    ]
+    traffic = (
+        ("chat lines", [
+            common.MessageRoom("room" + str(i % 10), "hello, world",
+                               nicks[i % 100]).encode_binary()
+            for i in range(count)
+        ]),
+        ("long messages", [
+            common.MessageRoom("room" + str(i % 10), lines[i],
+                               nicks[i % 100]).encode_binary()
+            for i in range(count)
+        ]),
+        ("50-user listings", [
+            common.ListUsers(nicks[i % 950:i % 950 + 50],
+                             "user0").encode_binary() for i in range(count)
+        ]),
+        ("1000-user listings", [
+            common.ListUsers(nicks, "user0").encode_binary()
+            for i in range(count // 20)
+        ]),
+    )
+    for name, frames in traffic:
+        raw = sum(len(frame) for frame in frames)
+        for setting, level, threshold in (
+            ("level 1", 1, common.COMPRESS_THRESHOLD),
+            ("level 6", 6, common.COMPRESS_THRESHOLD),
+            ("level 1, no threshold", 1, 0),
+        ):
+            pack = common.Compressor(threshold, level).pack
+            packed = 0
+            start = timeit.default_timer()
+            for frame in frames:
+                packed += len(pack(frame))
+            seconds = timeit.default_timer() - start
+            print("{:<42} {:>8.2f} us/frame {:>6.1%} of {} bytes".format(
+                name + ", " + setting,
+                seconds / len(frames) * 1e6, packed / raw, raw))
+
+
+def bench_render():
+    """Time for the client to show a room message: formatting the time and
+    printing each line, next to the cached formatter and batched writer.
+    Output goes to a line-buffered null device, as a terminal is."""
+    count = 20000
+    now = datetime.datetime.utcnow()
+    lines = [("room", "user" + str(i % 50), "message number " + str(i), now)
+             for i in range(count)]
+    zone = tz.tzlocal()
+    utc = tz.tzutc()
+    with open(os.devnull, "w", buffering=1) as terminal:
+
+        def direct():
+            for room, user, text, when in lines:
+                local = when.replace(tzinfo=utc).astimezone(zone)
+                print(local.strftime("%Y-%m-%d %H:%M") + " <" + room + "> " +
+                      user + ": " + text,
+                      file=terminal)
+
+        report("format and print each line", timeit.timeit(direct, number=1),
+               count, "line")
+
+        times = render.TimeFormatter(zone)
+        renderer = render.Renderer(terminal)
+
+        def batched():
+            for room, user, text, when in lines:
+                renderer.write(times.format(when) + " <" + room + "> " +
+                               user + ": " + text)
+            renderer.flush(60)
+
+        report("cached time, batched writes", timeit.timeit(batched,
+                                                            number=1),
+               count, "line")
+
+
+BENCHMARKS = {
+    "fanout": bench_fanout,
+    "broadcast": bench_broadcast,
+    "codec": bench_codec,
+    "frames": bench_frames,
+    "listing": bench_listing,
+    "throttle": bench_throttle,
+    "compress": bench_compress,
+    "render": bench_render,
+}
+
+
+if __name__ == "__main__":
+    names = sys.argv[1:] or list(BENCHMARKS)
+    for name in names:
+        if name not in BENCHMARKS:
+            print(USAGE + "\n".join("    " + n for n in BENCHMARKS))
+            sys.exit(1)
+    for name in names:
+        BENCHMARKS[name]()
@@ -19,36 +19,60 @@
 # Client for CS594 project
 
 import common
+import render
+from collections import deque
+from concurrent.futures import Future
 from datetime import datetime
 from dateutil import tz
+import os
 import random
+import select
 import socket
 import socketserver
 import sys
 import threading
-from typing import Tuple, List
+from typing import Dict, List, Set, Tuple
+import unittest
+import unittest.mock
 
 DEBUG = False
 
-USAGE = """Usage: python3 client.py <nick> [<server> <port> [<low_port> <high_port>]]
+USAGE = """Usage: python3 client.py [--session | --binary | --compress] [--firehose] <nick> [<server> <port> [<low_port> <high_port>]]
 
     <low_port> and <high_port> are used to designate a random port for
     the client to listen on. If they are not supplied, the default values
     of 45679 and 45965 are used for the range. These ports are listed as
     available on macOS 10.13
+
+    --session keeps a single connection to the server open for the whole
+    session and receives messages over it, so no listening port is needed.
+
+    --binary is --session using the length-prefixed binary framing, if the
+    server supports it.
+
+    --compress is --binary with large frames, such as long listings,
+    compressed in both directions, if the server supports it.
+
+    --firehose redraws at most ten times a second and skips all but the
+    latest lines when more arrive in between, for very busy rooms.
 """
 
 helptext = """Available Commands:
 /quit                  Disconnect from the server and quit this program
 /create <room>         Creates <room>. Does not join <room>
-/join <room>           Joins <room>
+/join <room>           Joins <room> and shows its latest messages
 /leave <room>          Leaves <room>
 /msg <room> <message>  Sends <message> to <room>
-/ls rooms              List available rooms
-/ls users              List available users
-/ls usersin <room>     List available users present in <room>
+/ls rooms [<prefix>]   List available rooms, optionally only those
+                       starting with <prefix>
+/ls users [<prefix>]   List available users
+/ls usersin <room> [<prefix>]
+                       List available users present in <room>
+/more                  Show the next page of the last list
+/history <room> [<n>]  Show the last <n> (default 20) messages in <room>
 /pm <user> <message>   Sends <message> to <user>
 /bcast <message>       Sends <message> to all users
+/stats                 Show the server's metrics
 """
 
 INVALID_COMMAND = """
@@ -57,6 +81,13 @@ and their usage. Here, let me do that for you now...
 """
 
 USERNAME: str = ""
+# Messages the server replays when joining a room, and by default for
+# /history
+HISTORY_ON_JOIN: int = 20
+# Names asked for in each page of a listing
+LIST_PAGE: int = 50
+# Reply to the last listing that has more pages, for /more
+LAST_LISTING: common.IrcPacket = None
 SERVER_ADDRESS: str = "127.0.0.1"
 SERVER_PORT: int = 8080
 LOW_PORT: int = 45679
@@ -65,49 +96,318 @@ LISTEN_PORT: int
 SERVER: Tuple[str, int]
 TO_ZONE = tz.tzlocal()
 FROM_ZONE = tz.tzutc()
+TIMES = render.TimeFormatter(TO_ZONE)
+# Writes what the server sends us to the terminal in batches; None prints
+# each line directly
+RENDERER: render.Renderer = None
+SESSION: "ServerSession" = None
+# Warm connections for requests when not in session mode, made on first use
+POOL: "ConnectionPool" = None
+# Idle connections kept open to the server outside session mode
+POOL_SIZE: int = 2
+# Feature bits asked for at Connect
+FEATURES: int = 0
+# Set when the server agreed to send us presence events
+PRESENCE: bool = False
+# Members of the rooms we are in, kept up to date by presence events
+MEMBERS: Dict[str, Set[str]] = dict()
+MEMBERS_LOCK = threading.Lock()
 
 
 class IRCClient(socketserver.StreamRequestHandler):
     def handle(self):
         try:
             data = self.rfile.readline()
+            if not data:
+                # The server checking that we're still listening
+                return
             message = common.decode(data)
 
-            self.handle_server_message(message)
+            handle_server_message(message)
         except SystemError as se:
             print("System error encountered!")
             print(se)
             sys.exit(1)
 
-    def handle_server_message(self, message: common.IrcPacket):
+
+class ConnectionPool(object):
+    """Keeps connections to the server open between requests.
+
+    Outside session mode every command is a request and a one-line reply,
+    and the server keeps serving a connection until the client closes it.
+    Reusing one saves a TCP handshake per command, so a command costs a
+    single round trip. A connection carries one request at a time, so its
+    next line is the reply; up to `size` idle connections are kept for
+    callers on other threads.
+
+    A connection that sat idle may have been closed by the server. One
+    with anything waiting to be read, which is either the end of the stream
+    or a line that isn't a reply to us, is dropped before it's used. If
+    sending a request fails before any of it is written, it is sent again
+    on a new connection; once some of it may have reached the server it
+    never is, since the server may already have acted on it.
+    """
+
+    def __init__(self, server: Tuple[str, int], size: int = POOL_SIZE):
+        self.server = server
+        self.size = size
+        self.lock = threading.Lock()
+        # (socket, file) pairs waiting for a request
+        self.idle = deque()
+
+    def connect(self):
+        s = socket.create_connection(self.server)
+        s.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        return s, s.makefile('rb')
+
+    def checkout(self):
+        while True:
+            with self.lock:
+                if not self.idle:
+                    break
+                connection = self.idle.pop()
+            readable, _, _ = select.select([connection[0]], [], [], 0)
+            if not readable:
+                return connection, True
+            self.discard(connection)
+        return self.connect(), False
+
+    def checkin(self, connection):
+        with self.lock:
+            if len(self.idle) < self.size:
+                self.idle.append(connection)
+                return
+        self.discard(connection)
+
+    @staticmethod
+    def discard(connection):
+        s, rfile = connection
+        rfile.close()
+        s.close()
+
+    def request(self, packet: common.IrcPacket) -> common.IrcPacket:
+        data = packet.encode()
+        while True:
+            connection, reused = self.checkout()
+            s, rfile = connection
+            try:
+                sent = s.send(data)
+            except OSError:
+                # Nothing was written, so the server never saw it.
+                self.discard(connection)
+                if reused:
+                    continue
+                raise
+            try:
+                if sent < len(data):
+                    s.sendall(data[sent:])
+                line = rfile.readline()
+            except OSError:
+                self.discard(connection)
+                raise
+            break
+        if not line:
+            self.discard(connection)
+            raise ConnectionResetError("server closed the connection")
+
         if DEBUG:
-            print("In handle_server_message")
-            print("\tmessage is '" + message.__str__() + "'")
-        if isinstance(message, common.Connect):
-            print("Connection successful!")
-        elif isinstance(message, common.Disconnect):
-            print("You have been disconnected. Goodbye!")
-            sys.exit(0)
-        elif isinstance(message, common.CreateRoom):
-            display_status_message("Room " + message.room + " created",
-                                   message.timestamp)
-        elif isinstance(message, common.JoinRoom):
-            display_status_message("Joined " + message.room, message.timestamp)
-        elif isinstance(message, common.LeaveRoom):
-            display_status_message("Left " + message.room, message.timestamp)
-        elif isinstance(message, common.MessageRoom):
-            if message.status == common.Status.OK:
-                display_message(message.room, message.username,
+            print("Received message from server: '" + line.decode() + "'")
+        try:
+            reply = common.decode(line)
+        except TypeError:
+            self.discard(connection)
+            raise
+        if (reply.opcode != packet.opcode
+                or reply.username != packet.username
+                or reply.timestamp != packet.timestamp):
+            # Replies come in request order, so this connection is out of
+            # step with its requests.
+            self.discard(connection)
+            raise TypeError("reply doesn't match the request")
+        if isinstance(reply, common.Disconnect):
+            # The server closes the connection after a Disconnect.
+            self.discard(connection)
+        else:
+            self.checkin(connection)
+        return reply
+
+    def close(self):
+        with self.lock:
+            idle, self.idle = self.idle, deque()
+        for connection in idle:
+            self.discard(connection)
+
+
+class ServerSession(object):
+    """A single long-lived connection to the server.
+
+    Requests can be pipelined: submit() writes a request and returns a
+    Future without waiting for earlier replies. The server answers requests
+    in order, so a reader thread matches each reply against the oldest
+    outstanding request by its opcode, username and timestamp; everything
+    else is a message the server pushed to us.
+    """
+
+    def __init__(self, server: Tuple[str, int]):
+        self.socket = socket.create_connection(server)
+        self.socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.rfile = self.socket.makefile('rb')
+        self.lock = threading.Lock()
+        # (request, Future) pairs in the order they were written
+        self.pending = deque()
+        self.closing = False
+        # Frames are binary in both directions once the server accepts
+        # FEATURE_BINARY, starting with its reply to our Connect.
+        self.binary = False
+        # Deflate streams for each direction once the server accepts
+        # FEATURE_COMPRESS
+        self.compressor: common.Compressor = None
+        self.decompressor: common.Decompressor = None
+
+        reader = threading.Thread(target=self.read_forever)
+        reader.daemon = True
+        reader.start()
+
+    def submit(self, packet: common.IrcPacket) -> Future:
+        """Sends a request and returns a Future for the server's reply."""
+        future = Future()
+        with self.lock:
+            if isinstance(packet, common.Disconnect):
+                self.closing = True
+            self.pending.append((packet, future))
+            if self.compressor is not None:
+                self.socket.sendall(
+                    self.compressor.pack(packet.encode_binary()))
+            elif self.binary:
+                self.socket.sendall(packet.encode_binary())
+            else:
+                if (isinstance(packet, common.Connect)
+                        and packet.features & common.FEATURE_COMPRESS):
+                    # The server may compress from its reply on.
+                    self.decompressor = common.Decompressor()
+                self.socket.sendall(packet.encode())
+            if isinstance(packet, common.Connect) and packet.features:
+                # The reply decides the framing of everything after it.
+                reply = future.result()
+                if (reply is not None
+                        and reply.features & common.FEATURE_COMPRESS):
+                    self.compressor = common.Compressor()
+        return future
+
+    def request(self, packet: common.IrcPacket):
+        return self.submit(packet).result()
+
+    def is_reply(self, message: common.IrcPacket):
+        return bool(self.pending) and common.is_reply(message,
+                                                      self.pending[0][0])
+
+    def read_frame(self):
+        """Reads the next frame from the server. Returns b"" at EOF."""
+        if not self.binary:
+            self.binary = common.starts_binary(self.rfile.peek(1)[:1])
+        if not self.binary:
+            return self.rfile.readline()
+        try:
+            return common.read_binary(self.rfile, self.decompressor)
+        except TypeError:
+            # Without a sane length there's no finding the next frame.
+            return b""
+
+    def read_forever(self):
+        while True:
+            try:
+                data = self.read_frame()
+                if not data:
+                    break
+                if self.binary:
+                    message = common.decode_binary(data)
+                else:
+                    message = common.decode(data)
+            except TypeError as te:
+                show("Error parsing message from server: '" + te.__str__() +
+                     "'")
+                continue
+
+            if self.is_reply(message):
+                self.pending.popleft()[1].set_result(message)
+            else:
+                handle_server_message(message)
+
+        if self.closing:
+            while self.pending:
+                self.pending.popleft()[1].set_result(None)
+            return
+        show("Lost connection to the server. Goodbye!")
+        finish_output()
+        os._exit(1)
+
+
+def handle_server_message(message: common.IrcPacket):
+    if DEBUG:
+        print("In handle_server_message")
+        print("\tmessage is '" + message.__str__() + "'")
+    if isinstance(message, common.Connect):
+        show("Connection successful!")
+    elif isinstance(message, common.Disconnect):
+        show("You have been disconnected. Goodbye!")
+        finish_output()
+        os._exit(0)
+    elif isinstance(message, common.CreateRoom):
+        display_status_message("Room " + message.room + " created",
+                               message.timestamp)
+    elif isinstance(message, common.JoinRoom):
+        display_status_message("Joined " + message.room, message.timestamp)
+    elif isinstance(message, common.LeaveRoom):
+        display_status_message("Left " + message.room, message.timestamp)
+    elif isinstance(message, common.MessageRoom):
+        if message.status == common.Status.OK:
+            display_message(message.room, message.username, message.message,
+                            message.timestamp)
+        else:
+            display_error("Unable to message '" + message.room + "'",
+                          message.error)
+    elif isinstance(message, common.PrivateMessage):
+        display_private_message(message.username, message.to,
                                 message.message, message.timestamp)
+    elif isinstance(message, common.Broadcast):
+        display_broadcast(message.username, message.message,
+                          message.timestamp)
+    elif isinstance(message, common.Presence):
+        update_members(message)
+    elif isinstance(message, common.Ping) and SESSION is not None:
+        SESSION.submit(common.Ping(message.username))
+
+
+def update_members(message: common.Presence):
+    with MEMBERS_LOCK:
+        members = MEMBERS.get(message.room)
+        if members is not None:
+            if message.change == common.PRESENCE_JOIN:
+                members.add(message.username)
             else:
-                display_error("Unable to message '" + message.room + "'",
-                              message.error)
-        elif isinstance(message, common.PrivateMessage):
-            display_private_message(message.username, message.to,
-                                    message.message, message.timestamp)
-        elif isinstance(message, common.Broadcast):
-            display_broadcast(message.username, message.message,
-                              message.timestamp)
+                members.discard(message.username)
+    if message.change == common.PRESENCE_JOIN:
+        change = " joined "
+    elif message.change == common.PRESENCE_LEAVE:
+        change = " left "
+    else:
+        change = " quit "
+    display_status_message(message.username + change + message.room,
+                           message.timestamp)
+
+
+def track_members(room: str):
+    """Fetches the members of a room we just joined once; presence events
+    keep the list up to date from then on."""
+
+    def seed(future):
+        reply = future.result()
+        if reply is not None and reply.status == common.Status.OK:
+            with MEMBERS_LOCK:
+                MEMBERS[room] = set(reply.users)
+
+    request = common.ListUsersInRoom([], room, USERNAME)
+    SESSION.submit(request).add_done_callback(seed)
 
 
 def utc_to_local(utc: datetime):
@@ -115,13 +415,17 @@ def utc_to_local(utc: datetime):
 
 
 def event_loop(username, port):
+    global USERNAME, PRESENCE
     while True:
-        connect_request = common.Connect(username, port)
-        send_message(connect_request)
+        connect_request = common.Connect(username, port, features=FEATURES)
+        response = send_message(connect_request, wait=True)
 
-        if connect_request.error == common.Error.NO_ERROR:
+        if response is None or response.error == common.Error.NO_ERROR:
+            USERNAME = username
+            PRESENCE = response is not None and bool(
+                response.features & common.FEATURE_PRESENCE)
             break
-        elif connect_request.error == common.Error.USER_ALREADY_EXISTS:
+        elif response.error == common.Error.USER_ALREADY_EXISTS:
             print("Username already in use on the server")
             username = input("New username: ").strip()
             while username.find(' ') != -1 and username.find(
@@ -142,16 +446,22 @@ def event_loop(username, port):
             leave_room(command)
         elif command.startswith("/msg"):
             message_room(command)
-        elif command == "/ls rooms":
-            list_rooms()
-        elif command == "/ls users":
-            list_users()
+        elif command.startswith("/ls rooms"):
+            list_rooms(command)
         elif command.startswith("/ls usersin"):
             list_users_in_room(command)
+        elif command.startswith("/ls users"):
+            list_users(command)
+        elif command == "/more":
+            list_more()
         elif command.startswith("/pm"):
             private_message(command)
         elif command.startswith("/bcast"):
             broadcast(command)
+        elif command.startswith("/history"):
+            room_history(command)
+        elif command == "/stats":
+            server_stats()
         elif command == "/help":
             print(helptext)
         else:
@@ -161,7 +471,7 @@ def event_loop(username, port):
 
 def quit_server():
     disco = common.Disconnect(USERNAME)
-    send_message(disco)
+    send_message(disco, wait=True)
     print("Exiting program")
 
 
@@ -183,10 +493,20 @@ def join_room(command: str):
             common.UNIT_SEPARATOR) != -1:
         print("Enter a valid room name")
         return
-    jr = common.JoinRoom(room, USERNAME)
+    jr = common.JoinRoom(room, USERNAME, history=HISTORY_ON_JOIN)
     send_message(jr)
 
 
+def room_history(command: str):
+    parts = command[8:].split()
+    if not 1 <= len(parts) <= 2 or (len(parts) == 2
+                                    and not parts[1].isdigit()):
+        print("Usage: /history <room> [<count>]")
+        return
+    count = int(parts[1]) if len(parts) == 2 else HISTORY_ON_JOIN
+    send_message(common.RoomHistory(parts[0], USERNAME, count))
+
+
 def leave_room(command: str):
     command = command[6:].strip()
     parts = command.split(' ')
@@ -220,24 +540,68 @@ def message_room(command: str):
     send_message(msg)
 
 
-def list_rooms():
+def list_rooms(command: str):
     rooms: List[str] = list()
-    send_message(common.ListRooms(rooms, USERNAME))
+    prefix = command[9:].strip()
+    send_message(
+        common.ListRooms(rooms, USERNAME, limit=LIST_PAGE, prefix=prefix))
 
 
-def list_users():
+def list_users(command: str):
     users: List[str] = list()
-    send_message(common.ListUsers(users, USERNAME))
+    prefix = command[9:].strip()
+    send_message(
+        common.ListUsers(users, USERNAME, limit=LIST_PAGE, prefix=prefix))
+
+
+def list_more():
+    global LAST_LISTING
+    listing = LAST_LISTING
+    if listing is None:
+        print("Nothing more to list")
+        return
+    LAST_LISTING = None
+    if isinstance(listing, common.ListRooms):
+        request = common.ListRooms([], USERNAME)
+    elif isinstance(listing, common.ListUsers):
+        request = common.ListUsers([], USERNAME)
+    else:
+        request = common.ListUsersInRoom([], listing.room, USERNAME)
+    request.cursor = listing.cursor
+    request.limit = LIST_PAGE
+    request.prefix = listing.prefix
+    send_message(request)
+
+
+def server_stats():
+    stats: List[str] = list()
+    send_message(common.ServerStats(stats, USERNAME))
 
 
 def list_users_in_room(command: str):
     users: List[str] = list()
-    room = command[11:].strip()
-    if len(room) < 1 or room.find(' ') != -1 or room.find(
+    parts = command[11:].split()
+    if len(parts) < 1 or len(parts) > 2 or command.find(
             common.UNIT_SEPARATOR) != -1:
         print("Enter a valid room")
         return
-    send_message(common.ListUsersInRoom(users, room, USERNAME))
+    room = parts[0]
+    prefix = parts[1] if len(parts) > 1 else ""
+    with MEMBERS_LOCK:
+        members = MEMBERS.get(room)
+        if members is not None:
+            members = sorted(m for m in members if m.startswith(prefix))
+    if members is not None:
+        # Kept up to date by presence events; no need to ask the server.
+        display_status_message("Users in '" + room + "': \n\t" +
+                               ", ".join(members))
+        return
+    send_message(
+        common.ListUsersInRoom(users,
+                               room,
+                               USERNAME,
+                               limit=LIST_PAGE,
+                               prefix=prefix))
 
 
 def private_message(command: str):
@@ -270,20 +634,31 @@ def broadcast(command: str):
     send_message(bcast)
 
 
-def send_message(packet: common.IrcPacket):
-    try:
-        s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        s.connect(SERVER)
-        s.send(packet.encode())
-        raw_response = s.makefile('r').readline()
-
-        if DEBUG:
-            print("Received message from server: '" + raw_response + "'")
+def send_message(packet: common.IrcPacket, wait: bool = False):
+    """Sends a request to the server and handles its reply.
 
-        response = common.decode(raw_response.encode())
-        s.close()
+    In session mode the request is pipelined unless `wait` is set: this
+    returns as soon as it is written and the reply is handled whenever it
+    arrives. Otherwise this returns the reply.
+    """
+    if SESSION is not None:
+        future = SESSION.submit(packet)
+        if not wait:
+            future.add_done_callback(lambda f: handle_message(f.result()))
+            return None
+        response = future.result()
+        handle_message(response)
+        return response
 
+    global POOL
+    if POOL is None or POOL.server != SERVER:
+        if POOL is not None:
+            POOL.close()
+        POOL = ConnectionPool(SERVER)
+    try:
+        response = POOL.request(packet)
         handle_message(response)
+        return response
     except TypeError as te:
         print("Error parsing response from server: '" + te.__str__() + "'")
 
@@ -293,9 +668,10 @@ def handle_message(message: common.IrcPacket):
         print("In handle_message")
 
     if isinstance(message, common.Connect):
-        print("Connection successful!")
+        show("Connection successful!")
     elif isinstance(message, common.Disconnect):
-        print("You have been disconnected. Goodbye!")
+        show("You have been disconnected. Goodbye!")
+        finish_output()
         sys.exit(0)
     elif isinstance(message, common.CreateRoom):
         if message.status == common.Status.ERROR:
@@ -309,8 +685,13 @@ def handle_message(message: common.IrcPacket):
         if message.status == common.Status.ERROR:
             display_error("Error joining room '" + message.room + "'",
                           message.error)
+            return
         display_status_message("Joined " + message.room, message.timestamp)
+        if PRESENCE:
+            track_members(message.room)
     elif isinstance(message, common.LeaveRoom):
+        with MEMBERS_LOCK:
+            MEMBERS.pop(message.room, None)
         display_status_message("Left " + message.room, message.timestamp)
     elif isinstance(message, common.MessageRoom):
         # We only check for errors here since. If our message is successful,
@@ -332,9 +713,19 @@ def handle_message(message: common.IrcPacket):
         else:
             display_status_message(
                 "No rooms available. Create one with `/create <room>`.")
+        remember_listing(message)
     elif isinstance(message, common.ListUsers):
         display_status_message("Users available: " + ", ".join(message.users),
                                message.timestamp)
+        remember_listing(message)
+    elif isinstance(message, common.RoomHistory):
+        if message.status == common.Status.ERROR:
+            display_error("Unable to show history of '" + message.room + "'",
+                          message.error)
+    elif isinstance(message, common.ServerStats):
+        display_status_message(
+            "Server stats:\n\t" + "\n\t".join(message.stats),
+            message.timestamp)
     elif isinstance(message, common.ListUsersInRoom):
         if message.status == common.Status.ERROR:
             display_error(
@@ -349,6 +740,7 @@ def handle_message(message: common.IrcPacket):
         display_status_message(
             "Users in '" + message.room + "': \n\t" + ", ".join(message.users),
             message.timestamp)
+        remember_listing(message)
     elif isinstance(message, common.PrivateMessage):
         if message.status == common.Status.ERROR:
             display_error("Unable to send private message.", message.error)
@@ -359,46 +751,176 @@ def handle_message(message: common.IrcPacket):
     #     display_broadcast(message.username, message.message, message.timestamp)
 
 
+def remember_listing(message: common.IrcPacket):
+    """Keeps a listing with more pages to come for /more."""
+    global LAST_LISTING
+    if message.cursor:
+        LAST_LISTING = message
+        show("More with /more")
+
+
+def show(line: str):
+    """Shows a line of output about the server's messages and replies."""
+    if RENDERER is not None:
+        RENDERER.write(line)
+    else:
+        print(line)
+
+
+def finish_output():
+    """Writes out everything shown so far, before the client exits."""
+    if RENDERER is not None:
+        RENDERER.flush()
+
+
 def display_message(room: str,
                     from_user: str,
                     message: str,
                     message_time: datetime = datetime.utcnow()):
-    print(
-        utc_to_local(message_time).strftime("%Y-%m-%d %H:%M") + " <" + room +
-        "> " + from_user + ": " + message)
+    show(TIMES.format(message_time) + " <" + room + "> " + from_user + ": " +
+         message)
 
 
 def display_status_message(message: str,
                            message_time: datetime = datetime.utcnow()):
-    print(
-        utc_to_local(message_time).strftime("%Y-%m-%d %H:%M") + ": " + message)
+    show(TIMES.format(message_time) + ": " + message)
 
 
 def display_error(preamble: str, error: common.Error):
-    print(preamble + ": " + error.to_string())
+    show(preamble + ": " + error.to_string())
 
 
 def display_private_message(from_user: str,
                             to_user: str,
                             message: str,
                             timestamp: datetime = datetime.utcnow()):
-    print(
-        utc_to_local(timestamp).strftime("%Y-%m-%d %H:%M") + " PM " + from_user
-        + " -> " + to_user + ": " + message)
+    show(TIMES.format(timestamp) + " PM " + from_user + " -> " + to_user +
+         ": " + message)
 
 
 def display_broadcast(from_user: str,
                       message: str,
                       timestamp: datetime = datetime.utcnow()):
-    print("\n" + utc_to_local(timestamp).strftime("%Y-%m-%d %H:%M") +
-          " BROADCAST\n\tFrom <" + from_user + ">: " + message)
+    show("\n" + TIMES.format(timestamp) + " BROADCAST\n\tFrom <" + from_user +
+         ">: " + message)
 
 
 def random_port_in_range(low: int, high: int):
     return random.randrange(low, high)
 
 
+class TestConnectionPool(unittest.TestCase):
+    """Runs the pool against the threaded engine in the same process."""
+
+    def setUp(self):
+        import registry
+        import server
+        users = registry.Registry()
+        # The pool's requests come from alice, taking deliveries on a port
+        # of this host that nothing answers.
+        users.add_user(
+            registry.User("alice", ("127.0.0.1", 0), 9,
+                          server.Callback("alice", "127.0.0.1", 9)))
+        for name, value in (("REGISTRY", users), ("ENGINE", "threaded")):
+            patcher = unittest.mock.patch.object(server, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.server = server
+        listener = server.QuietIRCServer(("127.0.0.1", 0), server.IRCServer)
+        # Counts the connections the server accepts, and keeps its end of
+        # each so a test can close it.
+        patcher = unittest.mock.patch.object(
+            listener, "process_request", wraps=listener.process_request)
+        self.accepted = patcher.start()
+        self.addCleanup(patcher.stop)
+        serving = threading.Thread(target=listener.serve_forever)
+        serving.daemon = True
+        serving.start()
+        self.addCleanup(listener.server_close)
+        self.addCleanup(listener.shutdown)
+        self.pool = ConnectionPool(listener.server_address)
+        self.addCleanup(self.pool.close)
+
+    def list_users(self) -> common.ListUsers:
+        return self.pool.request(common.ListUsers([], "alice"))
+
+    def close_server_end(self):
+        """Closes the server's end of the pool's idle connection, and waits
+        for the client's end to see it."""
+        self.accepted.call_args[0][0].shutdown(socket.SHUT_RDWR)
+        select.select([self.pool.idle[0][0]], [], [], 5)
+
+    def test_warm_reuse(self):
+        for _ in range(3):
+            self.assertEqual(common.Status.OK, self.list_users().status)
+        self.assertEqual(1, self.accepted.call_count)
+        self.assertEqual(1, len(self.pool.idle))
+
+    def test_closed_idle_connection_is_replaced(self):
+        self.list_users()
+        self.close_server_end()
+        self.assertEqual(common.Status.OK, self.list_users().status)
+        self.assertEqual(2, self.accepted.call_count)
+
+    def test_written_request_is_not_resent(self):
+        self.list_users()
+        self.close_server_end()
+        # The server closes the connection just after it passes the check.
+        with unittest.mock.patch.object(select, "select",
+                                        return_value=([], [], [])):
+            with self.assertRaises(ConnectionError):
+                self.list_users()
+        self.assertEqual(1, self.accepted.call_count)
+        self.assertEqual(0, len(self.pool.idle))
+
+    def test_unwritten_request_is_resent(self):
+        self.list_users()
+        send = socket.socket.send
+        failures = [BrokenPipeError()]
+
+        def fail_once(s, data):
+            if failures:
+                raise failures.pop()
+            return send(s, data)
+
+        with unittest.mock.patch.object(socket.socket, "send", fail_once):
+            self.assertEqual(common.Status.OK, self.list_users().status)
+        self.assertEqual(2, self.accepted.call_count)
+
+    def test_mismatched_reply_is_dropped(self):
+        self.list_users()
+        with unittest.mock.patch.object(
+                self.server.IRCServer, "handle_list_users",
+                side_effect=lambda p: common.ListUsers([], p.username)):
+            with self.assertRaises(TypeError):
+                self.list_users()
+        self.assertEqual(0, len(self.pool.idle))
+        self.assertEqual(common.Status.OK, self.list_users().status)
+        self.assertEqual(2, self.accepted.call_count)
+
+    def test_disconnect_discards_connection(self):
+        reply = self.pool.request(common.Connect("bob", 9))
+        self.assertEqual(common.Status.OK, reply.status)
+        self.assertEqual(1, len(self.pool.idle))
+        reply = self.pool.request(common.Disconnect("bob"))
+        self.assertEqual(common.Status.OK, reply.status)
+        self.assertEqual(0, len(self.pool.idle))
+
+
 if __name__ == '__main__':
+    use_session = any(flag in sys.argv
+                      for flag in ("--session", "--binary", "--compress"))
+    if "--binary" in sys.argv or "--compress" in sys.argv:
+        FEATURES = common.FEATURE_BINARY
+    if "--compress" in sys.argv:
+        FEATURES |= common.FEATURE_COMPRESS
+    if use_session:
+        FEATURES |= common.FEATURE_PRESENCE | common.FEATURE_HEARTBEAT
+    RENDERER = render.Renderer(firehose="--firehose" in sys.argv)
+    sys.argv = [
+        a for a in sys.argv
+        if a not in ("--session", "--binary", "--compress", "--firehose")
+    ]
     argc = len(sys.argv)
 
     if argc == 2:
@@ -420,17 +942,23 @@ if __name__ == '__main__':
         print(helptext)
         sys.exit()
 
-    LISTEN_PORT = random_port_in_range(LOW_PORT, HIGH_PORT)
     SERVER = (SERVER_ADDRESS, SERVER_PORT)
 
     print("Attempting to connect to " + str(SERVER_ADDRESS) + ":" +
           str(SERVER_PORT))
-    print("Listening on port " + str(LISTEN_PORT))
 
-    client = socketserver.ThreadingTCPServer(("127.0.0.1", LISTEN_PORT),
-                                             IRCClient)
-    ct = threading.Thread(target=client.serve_forever)
-    ct.daemon = True
-    ct.start()
+    if use_session:
+        # Port 0 tells the server to push messages over our connection.
+        LISTEN_PORT = 0
+        SESSION = ServerSession(SERVER)
+    else:
+        LISTEN_PORT = random_port_in_range(LOW_PORT, HIGH_PORT)
+        print("Listening on port " + str(LISTEN_PORT))
+
+        client = socketserver.ThreadingTCPServer(("127.0.0.1", LISTEN_PORT),
+                                                 IRCClient)
+        ct = threading.Thread(target=client.serve_forever)
+        ct.daemon = True
+        ct.start()
 
     event_loop(USERNAME, LISTEN_PORT)
@@ -18,14 +18,36 @@
 
 # Common structures for CS594 project
 
-from typing import List
+from typing import List, Tuple
 from enum import Enum
+import asyncio
 import datetime
 import dateutil.parser
+import io
+import struct
 import unittest
+import zlib
 
 UNIT_SEPARATOR = chr(31)
 
+# Optional features a client can ask for in its Connect message. The server
+# answers with the subset it agreed to.
+FEATURE_BINARY = 1
+# Push a Presence message to the client whenever someone joins or leaves a
+# room the client is in
+FEATURE_PRESENCE = 2
+# Compress large binary frames with a deflate stream kept for the whole
+# connection; needs FEATURE_BINARY
+FEATURE_COMPRESS = 4
+# Send the client a Ping after a quiet spell; a session that stays quiet is
+# taken to be dead and disconnected
+FEATURE_HEARTBEAT = 8
+
+# Changes carried by a Presence message
+PRESENCE_JOIN = 1
+PRESENCE_LEAVE = 2
+PRESENCE_QUIT = 3
+
 
 # Operations
 class Operations(Enum):
@@ -40,6 +62,12 @@ class Operations(Enum):
     USER_MSG = 9
     BROADCAST = 10
     USER_IN_ROOM_LIST = 11
+    SERVER_STATS = 12
+    SERVER_LINK = 13
+    RELAY = 14
+    ROOM_HISTORY = 15
+    ROOM_PRESENCE = 16
+    SERVER_PING = 17
 
     def __str__(self):
         return self.name
@@ -112,13 +140,178 @@ class Error(Enum):
             return Error.UNKNOWN_ERROR
 
 
+# Field types used in packet layouts
+TEXT = "text"
+NUMBER = "number"
+LIST = "list"
+TIME = "time"
+BYTES = "bytes"
+
+
+def parse_timestamp(s: str) -> datetime.datetime:
+    """Parses a packet's timestamp field.
+
+    Packets from this implementation carry datetime.isoformat() output, which
+    fromisoformat reads without any guesswork. dateutil is only used for
+    timestamps written some other way.
+    """
+    try:
+        return datetime.datetime.fromisoformat(s)
+    except ValueError:
+        return dateutil.parser.parse(s)
+
+
+def parse_list(s: str) -> List[str]:
+    if len(s) > 0:
+        return s.split(',')
+    return []
+
+
+# How each field type is written to and read from the text format. None
+# means the field is already a string.
+FORMATTERS = {
+    TEXT: None,
+    NUMBER: str,
+    LIST: ",".join,
+    TIME: datetime.datetime.isoformat,
+    BYTES: bytes.hex,
+}
+PARSERS = {
+    TEXT: None,
+    NUMBER: int,
+    LIST: parse_list,
+    TIME: parse_timestamp,
+    BYTES: bytes.fromhex,
+}
+STATUSES = {str(status.value): status for status in Status}
+ERRORS = {str(error.value): error for error in Error}
+
+# Binary (version 2) framing. A frame is a 32-bit length followed by that
+# many bytes of body. The body starts with a fixed-size head: opcode, status
+# and error as one byte each, then one slot per layout field. Numbers and
+# timestamps (microseconds since the Unix epoch, UTC) are stored in the head
+# as 64-bit signed integers; text and lists store their UTF-8 byte length or
+# item count there, with the bytes themselves following the head in layout
+# order. Byte strings are stored like text, without the UTF-8; the text
+# format writes them in hex. List items are each a 32-bit length and UTF-8
+# bytes. Everything is
+# big-endian. Keeping every fixed-width value in the head lets a whole
+# packet be packed or unpacked with a single struct call plus slicing,
+# though turning the head's values into datetimes and strings still makes
+# decoding about twice as slow as splitting a text frame.
+FRAME_LENGTH = struct.Struct(">I")
+UINT32 = struct.Struct(">I")
+MAX_FRAME = 16 * 1024 * 1024
+# Set in a frame's length prefix when its body is compressed; the rest of the
+# prefix is the compressed length
+COMPRESSED = 0x80000000
+# Binary frames shorter than this are sent as they are on a compressed
+# connection; a chat line gains little and costs a trip through deflate
+COMPRESS_THRESHOLD = 256
+EPOCH = datetime.datetime(1970, 1, 1)
+ONE_MICROSECOND = datetime.timedelta(microseconds=1)
+
+# struct codes for each field type's slot in the head
+HEAD_CODES = {
+    TEXT: "I",
+    NUMBER: "q",
+    LIST: "I",
+    TIME: "q",
+    BYTES: "I",
+}
+
+
+def micros_since_epoch(value: datetime.datetime) -> int:
+    if value.tzinfo is not None:
+        value = value.astimezone(datetime.timezone.utc).replace(tzinfo=None)
+    return (value - EPOCH) // ONE_MICROSECOND
+
+
+def pack_list(tail: List[bytes], value: List[str]) -> int:
+    for item in value:
+        data = item.encode()
+        tail.append(UINT32.pack(len(data)))
+        tail.append(data)
+    return len(value)
+
+
+def unpack_list(count: int, data: bytes, offset: int):
+    items = []
+    for _ in range(count):
+        (length, ) = UINT32.unpack_from(data, offset)
+        offset += 4
+        end = offset + length
+        items.append(data[offset:end].decode())
+        offset = end
+    return items, offset
+
+
+STATUS_VALUES = {status.value: status for status in Status}
+ERROR_VALUES = {error.value: error for error in Error}
+
+# Marks a layout field that must be present in text frames
+REQUIRED = object()
+
+# Packet classes by the opcode field as it appears in text and binary frames
+PACKETS = dict()
+BINARY_PACKETS = dict()
+
+
+def compile_layout(cls):
+    """Works out a packet class's encoders and decoders from its layout and
+    registers it for decoding.
+
+    A layout entry may carry a third element, the value to use when a text
+    frame ends before that field. Such fields must come last.
+    """
+    fields = [(entry[0], entry[1]) for entry in cls.layout]
+    defaults = [entry[2] if len(entry) > 2 else REQUIRED
+                for entry in cls.layout]
+    cls.attributes = ("opcode", "status",
+                      "error") + tuple(name for name, _ in fields)
+    cls.encoders = tuple((name, FORMATTERS[kind]) for name, kind in fields)
+    cls.decoders = tuple(
+        (name, index, PARSERS[kind], default)
+        for index, ((name, kind), default) in enumerate(zip(fields, defaults),
+                                                        3))
+    cls.binary_head = struct.Struct(
+        ">BBB" + "".join(HEAD_CODES[kind] for _, kind in fields))
+    cls.binary_fields = tuple(fields)
+    cls.binary_decoders = tuple(
+        (name, index, kind) for index, (name, kind) in enumerate(fields, 3))
+    if cls.opcode_type is not None:
+        cls.opcode_text = str(cls.opcode_type.value)
+        PACKETS[cls.opcode_text] = cls
+        BINARY_PACKETS[cls.opcode_type.value] = cls
+
+
 class IrcPacket(object):
+    """Base class for all messages.
+
+    Every packet class lists the fields that follow opcode, status and error
+    on the wire, in order, as (attribute, field type) pairs in `layout`.
+    The encoders and decoders are worked out from the layout once, when the
+    class is defined.
+    """
+
+    __slots__ = ("opcode", "status", "error", "username", "timestamp")
+    layout = (("username", TEXT), ("timestamp", TIME))
+    opcode_type: Operations = None
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        compile_layout(cls)
+
     def __init__(self,
                  opcode: Operations,
                  username: str,
-                 timestamp: datetime = datetime.datetime.utcnow(),
+                 timestamp: datetime = None,
                  status: Status = Status.OK,
                  error: Error = Error.NO_ERROR):
+        # Default to the time the packet is built rather than the time this
+        # module was imported; session clients match replies on it.
+        if timestamp is None:
+            timestamp = datetime.datetime.utcnow()
         self.opcode = opcode
         self.status = status
         self.username = username
@@ -127,172 +320,224 @@ class IrcPacket(object):
 
     def __eq__(self, other):
         if type(other) is type(self):
-            return self.__dict__ == other.__dict__
+            for name in self.attributes:
+                if getattr(self, name) != getattr(other, name):
+                    return False
+            return True
         return False
 
     def __str__(self):
-        return "{1}{0}{2}{0}{3}{0}{4}{0}{5}".format(
-            UNIT_SEPARATOR,
-            self.opcode.value,
-            self.status.value,
-            self.error.value,
-            self.username,
-            self.timestamp.isoformat(),
-        )
+        pieces = [
+            str(self.opcode.value),
+            str(self.status.value),
+            str(self.error.value),
+        ]
+        for name, formatter in self.encoders:
+            value = getattr(self, name)
+            pieces.append(value if formatter is None else formatter(value))
+        return UNIT_SEPARATOR.join(pieces)
 
     def to_string(self):
-        return "{1}{0}{2}{0}{3}{0}{4}{0}{5}".format(
-            UNIT_SEPARATOR,
-            self.opcode.value,
-            self.status.value,
-            self.error.value,
-            self.username,
-            self.timestamp.isoformat(),
-        )
+        return self.__str__()
 
     def encode(self):
         return (self.__str__() + "\n").encode()
 
+    def encode_binary(self):
+        head = [self.opcode.value, self.status.value, self.error.value]
+        tail = []
+        for name, kind in self.binary_fields:
+            value = getattr(self, name)
+            if kind is TEXT:
+                value = value.encode()
+                tail.append(value)
+                head.append(len(value))
+            elif kind is NUMBER:
+                head.append(value)
+            elif kind is TIME:
+                head.append(micros_since_epoch(value))
+            elif kind is BYTES:
+                tail.append(value)
+                head.append(len(value))
+            else:
+                head.append(pack_list(tail, value))
+        body = self.binary_head.pack(*head) + b"".join(tail)
+        return FRAME_LENGTH.pack(len(body)) + body
+
+    @classmethod
+    def unpack(cls, pieces: List[str]):
+        """Builds a packet from the fields of a split text frame."""
+        packet = cls.__new__(cls)
+        packet.opcode = cls.opcode_type
+        packet.status = STATUSES[pieces[1]]
+        packet.error = ERRORS[pieces[2]]
+        count = len(pieces)
+        for name, index, parser, default in cls.decoders:
+            if index < count:
+                value = pieces[index]
+                if parser is not None:
+                    value = parser(value)
+            elif default is REQUIRED:
+                raise IndexError("missing field " + name)
+            else:
+                value = default
+            setattr(packet, name, value)
+        return packet
+
+    @classmethod
+    def unpack_binary(cls, data: bytes):
+        """Builds a packet from the body of a binary frame."""
+        head = cls.binary_head.unpack_from(data)
+        packet = cls.__new__(cls)
+        packet.opcode = cls.opcode_type
+        packet.status = STATUS_VALUES[head[1]]
+        packet.error = ERROR_VALUES[head[2]]
+        offset = cls.binary_head.size
+        for name, index, kind in cls.binary_decoders:
+            value = head[index]
+            if kind is TEXT:
+                end = offset + value
+                value = data[offset:end].decode()
+                offset = end
+            elif kind is TIME:
+                value = EPOCH + datetime.timedelta(0, 0, value)
+            elif kind is LIST:
+                value, offset = unpack_list(value, data, offset)
+            elif kind is BYTES:
+                end = offset + value
+                value = bytes(data[offset:end])
+                offset = end
+            setattr(packet, name, value)
+        if offset != len(data):
+            raise ValueError("frame length doesn't match its fields")
+        return packet
+
+
+compile_layout(IrcPacket)
+
 
 class Connect(IrcPacket):
+    __slots__ = ("port", "features")
+    layout = (("username", TEXT), ("port", NUMBER), ("timestamp", TIME),
+              ("features", NUMBER, 0))
+    opcode_type = Operations.SERVER_JOIN
+
     def __init__(self,
                  username: str,
                  port: int,
-                 timestamp: datetime = datetime.datetime.utcnow(),
+                 timestamp: datetime = None,
                  status: Status = Status.OK,
-                 error: Error = Error.NO_ERROR):
+                 error: Error = Error.NO_ERROR,
+                 features: int = 0):
         super().__init__(Operations.SERVER_JOIN, username, timestamp, status,
                          error)
         self.port = port
-
-    def __str__(self):
-        return "{1}{0}{2}{0}{3}{0}{4}{0}{5}{0}{6}".format(
-            UNIT_SEPARATOR,
-            self.opcode.value,
-            self.status.value,
-            self.error.value,
-            self.username,
-            self.port,
-            self.timestamp.isoformat(),
-        )
-
-    def encode(self):
-        return (self.__str__() + "\n").encode()
+        self.features = features
 
 
 class Disconnect(IrcPacket):
+    __slots__ = ()
+    opcode_type = Operations.SERVER_PART
+
     def __init__(self,
                  username: str,
-                 timestamp: datetime = datetime.datetime.utcnow(),
+                 timestamp: datetime = None,
                  status: Status = Status.OK,
                  error: Error = Error.NO_ERROR):
         super().__init__(Operations.SERVER_PART, username, timestamp, status,
                          error)
 
-    def __str__(self):
-        return "{1}{0}{2}{0}{3}{0}{4}{0}{5}".format(
-            UNIT_SEPARATOR,
-            self.opcode.value,
-            self.status.value,
-            self.error.value,
-            self.username,
-            self.timestamp.isoformat(),
-        )
-
-    def encode(self):
-        return (self.__str__() + "\n").encode()
-
 
 class CreateRoom(IrcPacket):
+    __slots__ = ("room", )
+    layout = (("username", TEXT), ("timestamp", TIME), ("room", TEXT))
+    opcode_type = Operations.ROOM_CREATE
+
     def __init__(self,
                  room: str,
                  username: str,
-                 timestamp: datetime = datetime.datetime.utcnow(),
+                 timestamp: datetime = None,
                  status: Status = Status.OK,
                  error: Error = Error.NO_ERROR):
         super().__init__(Operations.ROOM_CREATE, username, timestamp, status,
                          error)
         self.room = room
 
-    def __str__(self):
-        return "{1}{0}{2}{0}{3}{0}{4}{0}{5}{0}{6}".format(
-            UNIT_SEPARATOR, self.opcode.value, self.status.value,
-            self.error.value, self.username,
-            self.timestamp.isoformat(), self.room)
-
-    def encode(self):
-        return (self.__str__() + "\n").encode()
-
 
 class JoinRoom(IrcPacket):
+    __slots__ = ("room", "history")
+    layout = (("username", TEXT), ("timestamp", TIME), ("room", TEXT),
+              ("history", NUMBER, 0))
+    opcode_type = Operations.ROOM_JOIN
+
     def __init__(self,
                  room: str,
                  username: str,
-                 timestamp: datetime = datetime.datetime.utcnow(),
+                 timestamp: datetime = None,
                  status: Status = Status.OK,
-                 error: Error = Error.NO_ERROR):
+                 error: Error = Error.NO_ERROR,
+                 history: int = 0):
         super().__init__(Operations.ROOM_JOIN, username, timestamp, status,
                          error)
         self.room = room
-
-    def __str__(self):
-        return "{1}{0}{2}{0}{3}{0}{4}{0}{5}{0}{6}".format(
-            UNIT_SEPARATOR, self.opcode.value, self.status.value,
-            self.error.value, self.username,
-            self.timestamp.isoformat(), self.room)
-
-    def encode(self):
-        return (self.__str__() + "\n").encode()
+        # Recent messages to replay once joined
+        self.history = history
 
 
 class LeaveRoom(IrcPacket):
+    __slots__ = ("room", )
+    layout = (("username", TEXT), ("timestamp", TIME), ("room", TEXT))
+    opcode_type = Operations.ROOM_PART
+
     def __init__(self,
                  room: str,
                  username: str,
-                 timestamp: datetime = datetime.datetime.utcnow(),
+                 timestamp: datetime = None,
                  status: Status = Status.OK,
                  error: Error = Error.NO_ERROR):
         super().__init__(Operations.ROOM_PART, username, timestamp, status,
                          error)
         self.room = room
 
-    def __str__(self):
-        return "{1}{0}{2}{0}{3}{0}{4}{0}{5}{0}{6}".format(
-            UNIT_SEPARATOR, self.opcode.value, self.status.value,
-            self.error.value, self.username,
-            self.timestamp.isoformat(), self.room)
-
-    def encode(self):
-        return (self.__str__() + "\n").encode()
-
 
 class ListRooms(IrcPacket):
+    __slots__ = ("rooms", "cursor", "limit", "prefix")
+    layout = (("username", TEXT), ("timestamp", TIME), ("rooms", LIST),
+              ("cursor", TEXT, ""), ("limit", NUMBER, 0),
+              ("prefix", TEXT, ""))
+    opcode_type = Operations.ROOM_LIST
+
     def __init__(self,
                  rooms: List[str],
                  username: str,
-                 timestamp: datetime = datetime.datetime.utcnow(),
+                 timestamp: datetime = None,
                  status: Status = Status.OK,
-                 error: Error = Error.NO_ERROR):
+                 error: Error = Error.NO_ERROR,
+                 cursor: str = "",
+                 limit: int = 0,
+                 prefix: str = ""):
         super().__init__(Operations.ROOM_LIST, username, timestamp, status,
                          error)
         self.rooms = rooms
-
-    def __str__(self):
-        return "{1}{0}{2}{0}{3}{0}{4}{0}{5}{0}{6}".format(
-            UNIT_SEPARATOR, self.opcode.value, self.status.value,
-            self.error.value, self.username,
-            self.timestamp.isoformat(), ",".join(self.rooms))
-
-    def encode(self):
-        return (self.__str__() + "\n").encode()
+        # Asks for up to `limit` names after `cursor` that start with
+        # `prefix`; a limit of 0 asks for all of them. The reply's cursor is
+        # the last name sent, or empty once there are no more.
+        self.cursor = cursor
+        self.limit = limit
+        self.prefix = prefix
 
 
 class MessageRoom(IrcPacket):
+    __slots__ = ("room", "message")
+    layout = (("username", TEXT), ("timestamp", TIME), ("room", TEXT),
+              ("message", TEXT))
+    opcode_type = Operations.ROOM_MSG
+
     def __init__(self,
                  room: str,
                  message: str,
                  username: str,
-                 timestamp: datetime = datetime.datetime.utcnow(),
+                 timestamp: datetime = None,
                  status: Status = Status.OK,
                  error: Error = Error.NO_ERROR):
         super().__init__(Operations.ROOM_MSG, username, timestamp, status,
@@ -300,70 +545,68 @@ class MessageRoom(IrcPacket):
         self.room = room
         self.message = message
 
-    def __str__(self):
-        return "{1}{0}{2}{0}{3}{0}{4}{0}{5}{0}{6}{0}{7}".format(
-            UNIT_SEPARATOR, self.opcode.value, self.status.value,
-            self.error.value, self.username,
-            self.timestamp.isoformat(), self.room, self.message)
-
-    def encode(self):
-        return (self.__str__() + "\n").encode()
-
 
 class ListUsers(IrcPacket):
+    __slots__ = ("users", "cursor", "limit", "prefix")
+    layout = (("username", TEXT), ("timestamp", TIME), ("users", LIST),
+              ("cursor", TEXT, ""), ("limit", NUMBER, 0),
+              ("prefix", TEXT, ""))
+    opcode_type = Operations.USER_LIST
+
     def __init__(self,
                  users: List[str],
                  username: str,
-                 timestamp: datetime = datetime.datetime.utcnow(),
+                 timestamp: datetime = None,
                  status: Status = Status.OK,
-                 error: Error = Error.NO_ERROR):
+                 error: Error = Error.NO_ERROR,
+                 cursor: str = "",
+                 limit: int = 0,
+                 prefix: str = ""):
         super().__init__(Operations.USER_LIST, username, timestamp, status,
                          error)
         self.users = users
-
-    def __str__(self):
-        return "{1}{0}{2}{0}{3}{0}{4}{0}{5}{0}{6}".format(
-            UNIT_SEPARATOR, self.opcode.value, self.status.value,
-            self.error.value, self.username,
-            self.timestamp.isoformat(), ",".join(self.users))
-
-    def encode(self):
-        return (self.__str__() + "\n").encode()
+        self.cursor = cursor
+        self.limit = limit
+        self.prefix = prefix
 
 
 class ListUsersInRoom(IrcPacket):
+    __slots__ = ("users", "room", "cursor", "limit", "prefix")
+    layout = (("username", TEXT), ("timestamp", TIME), ("room", TEXT),
+              ("users", LIST), ("cursor", TEXT, ""), ("limit", NUMBER, 0),
+              ("prefix", TEXT, ""))
+    opcode_type = Operations.USER_IN_ROOM_LIST
+
     def __init__(self,
                  users: List[str],
                  room: str,
                  username: str,
-                 timestamp: datetime = datetime.datetime.utcnow(),
+                 timestamp: datetime = None,
                  status: Status = Status.OK,
-                 error: Error = Error.NO_ERROR):
+                 error: Error = Error.NO_ERROR,
+                 cursor: str = "",
+                 limit: int = 0,
+                 prefix: str = ""):
         super().__init__(Operations.USER_IN_ROOM_LIST, username, timestamp,
                          status, error)
         self.users = users
         self.room = room
-
-    def __str__(self):
-        user_list_str = ""
-        if (len(self.users) > 0):
-            user_list_str = ",".join(self.users)
-
-        return "{1}{0}{2}{0}{3}{0}{4}{0}{5}{0}{6}{0}{7}".format(
-            UNIT_SEPARATOR, self.opcode.value, self.status.value,
-            self.error.value, self.username,
-            self.timestamp.isoformat(), self.room, user_list_str)
-
-    def encode(self):
-        return (self.__str__() + "\n").encode()
+        self.cursor = cursor
+        self.limit = limit
+        self.prefix = prefix
 
 
 class PrivateMessage(IrcPacket):
+    __slots__ = ("to", "message")
+    layout = (("username", TEXT), ("timestamp", TIME), ("to", TEXT),
+              ("message", TEXT))
+    opcode_type = Operations.USER_MSG
+
     def __init__(self,
                  username: str,
                  to: str,
                  message: str,
-                 timestamp: datetime = datetime.datetime.utcnow(),
+                 timestamp: datetime = None,
                  status: Status = Status.OK,
                  error: Error = Error.NO_ERROR):
         super().__init__(Operations.USER_MSG, username, timestamp, status,
@@ -371,102 +614,319 @@ class PrivateMessage(IrcPacket):
         self.to = to
         self.message = message
 
-    def __str__(self):
-        return "{1}{0}{2}{0}{3}{0}{4}{0}{5}{0}{6}{0}{7}".format(
-            UNIT_SEPARATOR, self.opcode.value, self.status.value,
-            self.error.value, self.username,
-            self.timestamp.isoformat(), self.to, self.message)
-
-    def encode(self):
-        return (self.__str__() + "\n").encode()
-
 
 class Broadcast(IrcPacket):
+    __slots__ = ("message", )
+    layout = (("username", TEXT), ("timestamp", TIME), ("message", TEXT))
+    opcode_type = Operations.BROADCAST
+
     def __init__(self,
                  message: str,
                  username: str,
-                 timestamp: datetime = datetime.datetime.utcnow(),
+                 timestamp: datetime = None,
                  status: Status = Status.OK,
                  error: Error = Error.NO_ERROR):
         super().__init__(Operations.BROADCAST, username, timestamp, status,
                          error)
         self.message = message
 
-    def __str__(self):
-        return "{1}{0}{2}{0}{3}{0}{4}{0}{5}{0}{6}".format(
-            UNIT_SEPARATOR, self.opcode.value, self.status.value,
-            self.error.value, self.username,
-            self.timestamp.isoformat(), self.message)
 
-    def encode(self):
-        return (self.__str__() + "\n").encode()
+class ServerStats(IrcPacket):
+    __slots__ = ("stats", )
+    layout = (("username", TEXT), ("timestamp", TIME), ("stats", LIST))
+    opcode_type = Operations.SERVER_STATS
+
+    def __init__(self,
+                 stats: List[str],
+                 username: str,
+                 timestamp: datetime = None,
+                 status: Status = Status.OK,
+                 error: Error = Error.NO_ERROR):
+        super().__init__(Operations.SERVER_STATS, username, timestamp,
+                         status, error)
+        self.stats = stats
+
+
+class RoomHistory(IrcPacket):
+    """Asks for a room's recent messages: the last `count` of them, or if
+    `count` is 0, those sent since `since`. The reply's `count` is how many
+    were replayed."""
+
+    __slots__ = ("room", "count", "since")
+    layout = (("username", TEXT), ("timestamp", TIME), ("room", TEXT),
+              ("count", NUMBER), ("since", TIME))
+    opcode_type = Operations.ROOM_HISTORY
+
+    def __init__(self,
+                 room: str,
+                 username: str,
+                 count: int = 0,
+                 since: datetime = EPOCH,
+                 timestamp: datetime = None,
+                 status: Status = Status.OK,
+                 error: Error = Error.NO_ERROR):
+        super().__init__(Operations.ROOM_HISTORY, username, timestamp,
+                         status, error)
+        self.room = room
+        self.count = count
+        self.since = since
+
+
+class Presence(IrcPacket):
+    """Tells a client that `username` joined, left, or disconnected from a
+    room the client is in. `change` is one of the PRESENCE_ constants."""
+
+    __slots__ = ("room", "change")
+    layout = (("username", TEXT), ("timestamp", TIME), ("room", TEXT),
+              ("change", NUMBER))
+    opcode_type = Operations.ROOM_PRESENCE
+
+    def __init__(self,
+                 room: str,
+                 username: str,
+                 change: int,
+                 timestamp: datetime = None,
+                 status: Status = Status.OK,
+                 error: Error = Error.NO_ERROR):
+        super().__init__(Operations.ROOM_PRESENCE, username, timestamp,
+                         status, error)
+        self.room = room
+        self.change = change
+
+
+class Ping(IrcPacket):
+    """Sent by the server to a quiet session, which answers with a Ping of
+    its own to show it is still there."""
+
+    __slots__ = ()
+    opcode_type = Operations.SERVER_PING
+
+    def __init__(self,
+                 username: str,
+                 timestamp: datetime = None,
+                 status: Status = Status.OK,
+                 error: Error = Error.NO_ERROR):
+        super().__init__(Operations.SERVER_PING, username, timestamp, status,
+                         error)
+
+
+class ServerLink(IrcPacket):
+    """Opens a link from another server. `username` is the name of the
+    server asking to link."""
+
+    __slots__ = ()
+    opcode_type = Operations.SERVER_LINK
+
+    def __init__(self,
+                 username: str,
+                 timestamp: datetime = None,
+                 status: Status = Status.OK,
+                 error: Error = Error.NO_ERROR):
+        super().__init__(Operations.SERVER_LINK, username, timestamp, status,
+                         error)
+
+
+class Relay(IrcPacket):
+    """Carries a packet between linked servers.
+
+    `username` is the server the packet started from and `sequence` numbers
+    the packets that server sends, so a copy arriving by a second route can
+    be recognized. A sequence of 0 marks state that is safe to apply twice.
+    `payload` is the body of the carried packet's binary encoding, so its
+    text arrives intact whatever characters it holds.
+    """
+
+    __slots__ = ("sequence", "hops", "payload")
+    layout = (("username", TEXT), ("timestamp", TIME), ("sequence", NUMBER),
+              ("hops", NUMBER), ("payload", BYTES))
+    opcode_type = Operations.RELAY
+
+    def __init__(self,
+                 origin: str,
+                 sequence: int,
+                 payload: bytes,
+                 hops: int = 0,
+                 timestamp: datetime = None,
+                 status: Status = Status.OK,
+                 error: Error = Error.NO_ERROR):
+        super().__init__(Operations.RELAY, origin, timestamp, status, error)
+        self.sequence = sequence
+        self.hops = hops
+        self.payload = payload
+
+    @classmethod
+    def carrying(cls, origin: str, sequence: int, packet: IrcPacket):
+        """Makes a Relay carrying `packet`."""
+        return cls(origin, sequence,
+                   packet.encode_binary()[FRAME_LENGTH.size:])
+
+    def packet(self) -> IrcPacket:
+        """Decodes the carried packet."""
+        return decode_binary(self.payload)
+
+
+class Frame(object):
+    """A packet along with its encodings, each made at most once.
+
+    Fan-out hands one Frame to every recipient, so the packet is encoded
+    once per wire format in use no matter how many users receive it.
+    """
+
+    __slots__ = ("packet", "text", "binary")
+
+    def __init__(self, packet: IrcPacket):
+        self.packet = packet
+        self.text = None
+        self.binary = None
+
+    def encode(self, binary: bool = False) -> bytes:
+        if binary:
+            if self.binary is None:
+                self.binary = self.packet.encode_binary()
+            return self.binary
+        if self.text is None:
+            self.text = self.packet.encode()
+        return self.text
 
 
 def decode(packet: bytes):
-    pieces = packet.decode().strip().split(UNIT_SEPARATOR)
-    msg_type = int(pieces[0])
-    pieces[-1] = pieces[-1].strip()
-
-    # field order: opcode, status, error, username, timestamp
-    if msg_type == 1:
-        return Connect(pieces[3],
-                       int(pieces[4]),
-                       dateutil.parser.parse(pieces[5]),
-                       Status(int(pieces[1])), Error(int(pieces[2])))
-    elif msg_type == 2:
-        return Disconnect(pieces[3],
-                          dateutil.parser.parse(pieces[4]),
-                          Status(int(pieces[1])), Error(int(pieces[2])))
-    elif msg_type == 3:
-        return CreateRoom(pieces[5], pieces[3],
-                          dateutil.parser.parse(pieces[4]),
-                          Status(int(pieces[1])), Error(int(pieces[2])))
-    elif msg_type == 4:
-        return JoinRoom(pieces[5], pieces[3],
-                        dateutil.parser.parse(pieces[4]),
-                        Status(int(pieces[1])), Error(int(pieces[2])))
-    elif msg_type == 5:
-        return LeaveRoom(pieces[5], pieces[3],
-                         dateutil.parser.parse(pieces[4]),
-                         Status(int(pieces[1])), Error(int(pieces[2])))
-    elif msg_type == 6:
-        return MessageRoom(pieces[5], pieces[6], pieces[3],
-                           dateutil.parser.parse(pieces[4]),
-                           Status(int(pieces[1])), Error(int(pieces[2])))
-    elif msg_type == 7:
-        room_list = []
-        if (len(pieces) > 5):
-            room_list.extend(pieces[5].split(','))
-
-        return ListRooms(room_list, pieces[3],
-                         dateutil.parser.parse(pieces[4]),
-                         Status(int(pieces[1])), Error(int(pieces[2])))
-    elif msg_type == 8:
-        user_list = []
-        if (len(pieces) > 5):
-            user_list.extend(pieces[5].split(','))
-
-        return ListUsers(user_list, pieces[3],
-                         dateutil.parser.parse(pieces[4]),
-                         Status(int(pieces[1])), Error(int(pieces[2])))
-    elif msg_type == 9:
-        return PrivateMessage(pieces[3], pieces[5], pieces[6],
-                              dateutil.parser.parse(pieces[4]),
-                              Status(int(pieces[1])), Error(int(pieces[2])))
-    elif msg_type == 10:
-        return Broadcast(pieces[5], pieces[3],
-                         dateutil.parser.parse(pieces[4]),
-                         Status(int(pieces[1])), Error(int(pieces[2])))
-    elif msg_type == 11:
-        user_list = []
-        if (len(pieces) > 6):
-            user_list.extend(pieces[6].split(','))
-
-        return ListUsersInRoom(user_list, pieces[5], pieces[3],
-                               dateutil.parser.parse(pieces[4]),
-                               Status(int(pieces[1])), Error(int(pieces[2])))
-
-    raise TypeError
+    """Decodes one newline-terminated frame.
+
+    Raises TypeError if the frame isn't a well-formed packet.
+    """
+    try:
+        pieces = packet.decode().rstrip("\r\n").split(UNIT_SEPARATOR)
+        return PACKETS[pieces[0]].unpack(pieces)
+    except (KeyError, IndexError, ValueError, OverflowError) as e:
+        raise TypeError("malformed packet: " + repr(e))
+
+
+def decode_binary(data: bytes):
+    """Decodes the body of one binary frame, without its length prefix.
+
+    Raises TypeError if the frame isn't a well-formed packet.
+    """
+    try:
+        return BINARY_PACKETS[data[0]].unpack_binary(data)
+    except (KeyError, IndexError, ValueError, OverflowError,
+            struct.error) as e:
+        raise TypeError("malformed packet: " + repr(e))
+
+
+class Compressor(object):
+    """Compresses the binary frames sent over one connection.
+
+    Every frame goes through the same deflate stream, so nicks, room names
+    and text seen in earlier frames are matched against the 32KB window
+    rather than spelled out again. Each frame is sync-flushed, so it can be
+    decoded as soon as it arrives. Frames shorter than `threshold` are left
+    alone and never enter the stream. Frames must be packed in the order
+    they are written to the connection.
+    """
+
+    def __init__(self, threshold: int = COMPRESS_THRESHOLD, level: int = 1):
+        self.threshold = threshold
+        self.stream = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+
+    def pack(self, frame: bytes) -> bytes:
+        """Returns a length-prefixed frame ready to send in place of
+        `frame`."""
+        if len(frame) < self.threshold:
+            return frame
+        stream = self.stream
+        body = stream.compress(memoryview(frame)[FRAME_LENGTH.size:])
+        body += stream.flush(zlib.Z_SYNC_FLUSH)
+        return FRAME_LENGTH.pack(len(body) | COMPRESSED) + body
+
+
+class Decompressor(object):
+    """Inflates the compressed frames from one connection's Compressor."""
+
+    def __init__(self):
+        self.stream = zlib.decompressobj(-zlib.MAX_WBITS)
+
+    def unpack(self, data: bytes) -> bytes:
+        stream = self.stream
+        try:
+            body = stream.decompress(data, MAX_FRAME + 1)
+        except zlib.error as e:
+            raise TypeError("bad compressed frame: " + str(e))
+        if len(body) > MAX_FRAME or stream.unconsumed_tail:
+            raise TypeError("compressed frame is too large")
+        return body
+
+
+def starts_binary(first: bytes) -> bool:
+    """Tells whether a frame is binary from its first byte.
+
+    A binary frame starts with the high byte of its length, which is zero
+    apart from the compressed flag; a text frame starts with an opcode digit.
+    """
+    return first == b"\x00" or first == b"\x80"
+
+
+def frame_length(prefix: bytes,
+                 decompressor: Decompressor = None) -> Tuple[int, bool]:
+    """Reads a binary frame's length prefix. Returns the length of the body
+    and whether it is compressed.
+
+    Raises TypeError if the frame is too large, or compressed on a
+    connection without a `decompressor`.
+    """
+    (length, ) = FRAME_LENGTH.unpack(prefix)
+    compressed = length & COMPRESSED
+    length &= ~COMPRESSED
+    if length > MAX_FRAME:
+        raise TypeError("frame of " + str(length) + " bytes is too large")
+    if compressed and decompressor is None:
+        raise TypeError("compressed frame on an uncompressed connection")
+    return length, compressed
+
+
+def read_binary(rfile, decompressor: Decompressor = None) -> bytes:
+    """Reads the body of the next binary frame from a buffered binary file,
+    inflating it with `decompressor` if it was compressed.
+
+    Returns b"" at the end of the stream.
+    """
+    prefix = rfile.read(FRAME_LENGTH.size)
+    if len(prefix) < FRAME_LENGTH.size:
+        return b""
+    length, compressed = frame_length(prefix, decompressor)
+    data = rfile.read(length)
+    if len(data) < length:
+        return b""
+    if compressed:
+        return decompressor.unpack(data)
+    return data
+
+
+async def read_binary_async(reader: asyncio.StreamReader,
+                            decompressor: Decompressor = None,
+                            first: bytes = b"") -> bytes:
+    """read_binary() for an asyncio stream. `first` is the start of the
+    length prefix, if the caller already read it to sniff the framing.
+
+    Raises asyncio.IncompleteReadError if the stream ends mid-frame.
+    """
+    prefix = first + await reader.readexactly(FRAME_LENGTH.size - len(first))
+    length, compressed = frame_length(prefix, decompressor)
+    data = await reader.readexactly(length)
+    if compressed:
+        return decompressor.unpack(data)
+    return data
+
+
+def is_reply(message: IrcPacket, request: IrcPacket) -> bool:
+    """Tells whether a message from the server answers `request`.
+
+    Replies come back in request order, echoing the request's opcode,
+    username and timestamp, so a session client compares each message with
+    its oldest outstanding request; anything else was pushed to it.
+    """
+    return (message.opcode == request.opcode
+            and message.username == request.username
+            and message.timestamp == request.timestamp)
 
 
 class TestCommon(unittest.TestCase):
@@ -543,12 +1003,144 @@ class TestCommon(unittest.TestCase):
         dp = decode(ep)
         self.assertEqual(p, dp)
 
+    def test_ListUsers_page(self):
+        p = ListUsers(["bob", "bobby"], "user", cursor="bobby", limit=2,
+                      prefix="bob")
+        self.assertEqual(p, decode(p.encode()))
+        self.assertEqual(p, decode_binary(p.encode_binary()[4:]))
+
+    def test_ListUsersInRoom_without_page(self):
+        p = ListUsersInRoom(["a", "b"], "The Room", "user")
+        old = UNIT_SEPARATOR.join(str(p).split(UNIT_SEPARATOR)[:-3]) + "\n"
+        self.assertEqual(p, decode(old.encode()))
+
     def test_PrivateMessage(self):
         p = PrivateMessage("from", "to", "message")
         ep = p.encode()
         dp = decode(ep)
         self.assertEqual(p, dp)
 
+    def test_Connect_without_features(self):
+        p = Connect("some_user", 8081)
+        old = UNIT_SEPARATOR.join(str(p).split(UNIT_SEPARATOR)[:-1]) + "\n"
+        self.assertEqual(p, decode(old.encode()))
+
+    def test_binary(self):
+        packets = [
+            Connect("some_user", 0, features=FEATURE_BINARY),
+            Disconnect("some_user"),
+            CreateRoom("room", "some_user"),
+            JoinRoom("room", "some_user"),
+            LeaveRoom("room", "some_user"),
+            ListRooms([], "some_user"),
+            ListRooms(["first", "second"], "some_user"),
+            MessageRoom("room", "m\u00e9ssage\nwith\x1fanything", "user"),
+            ListUsers(["some user", "another user"], "user"),
+            ListUsersInRoom([], "The Room", "user"),
+            PrivateMessage("from", "to", "message", status=Status.ERROR,
+                           error=Error.USER_NOT_FOUND),
+            Broadcast("some message", "some_user"),
+            ServerStats(["users 2", "rooms 1"], "some_user"),
+            ServerLink("node-a"),
+            JoinRoom("room", "some_user", history=20),
+            RoomHistory("room", "some_user", since=datetime.datetime(
+                2017, 10, 3, 22, 0)),
+            Relay("node-a", 7,
+                  MessageRoom("room", "hi", "user").encode_binary()[4:], 2),
+        ]
+        stream = io.BytesIO(b"".join(p.encode_binary() for p in packets))
+        for p in packets:
+            self.assertEqual(p, decode_binary(read_binary(stream)))
+        self.assertEqual(b"", read_binary(stream))
+
+    def test_compressed(self):
+        packets = [
+            ListUsers(["user" + str(i) for i in range(200)], "some_user"),
+            MessageRoom("room", "short", "user"),
+            ListUsers(["user" + str(i) for i in range(200)], "some_user"),
+        ]
+        compressor = Compressor()
+        frames = [compressor.pack(p.encode_binary()) for p in packets]
+        self.assertEqual(packets[1].encode_binary(), frames[1])
+        # The second listing is mostly matches against the first.
+        self.assertLess(len(frames[2]), len(frames[0]) // 4)
+        stream = io.BytesIO(b"".join(frames))
+        decompressor = Decompressor()
+        for p in packets:
+            self.assertEqual(p,
+                             decode_binary(read_binary(stream, decompressor)))
+        with self.assertRaises(TypeError):
+            read_binary(io.BytesIO(frames[0]))
+        with self.assertRaises(TypeError):
+            garbage = FRAME_LENGTH.pack(100 | COMPRESSED) + b"\xff" * 100
+            read_binary(io.BytesIO(garbage), Decompressor())
+
+    def test_binary_malformed(self):
+        frame = MessageRoom("room", "message", "user").encode_binary()
+        # A timestamp far past the end of datetime
+        head = MessageRoom.binary_head
+        fields = list(head.unpack_from(frame, 4))
+        fields[4] = 2 ** 62
+        overflow = head.pack(*fields) + frame[4 + head.size:]
+        for body in (b"", b"\x63\x00\x00", frame[4:-1], overflow):
+            with self.assertRaises(TypeError):
+                decode_binary(body)
+
+    def test_malformed(self):
+        for frame in (b"", b"99\x1f0\x1f0\x1fuser\n", b"2\x1f0\n",
+                      b"6\x1f0\x1f0\x1fuser\x1fnot a time\x1froom\x1fmsg\n",
+                      b"2\x1f0\x1f0\x1fzzz\x1f99999999999999999999999\n"):
+            with self.assertRaises(TypeError):
+                decode(frame)
+
+    def test_no_instance_dict(self):
+        for cls in PACKETS.values():
+            self.assertFalse(hasattr(cls.__new__(cls), "__dict__"))
+
+    def test_parse_timestamp(self):
+        now = datetime.datetime.utcnow()
+        self.assertEqual(now, parse_timestamp(now.isoformat()))
+        self.assertEqual(
+            datetime.datetime(2017, 10, 3, 22, 0),
+            parse_timestamp("October 3, 2017 10:00 PM"))
+
+    def test_ServerStats(self):
+        p = ServerStats(["users 2", "requests_ROOM_MSG 10"], "some_user")
+        ep = p.encode()
+        dp = decode(ep)
+        self.assertEqual(p, dp)
+
+    def test_JoinRoom_without_history(self):
+        p = JoinRoom("room", "some_user")
+        old = UNIT_SEPARATOR.join(str(p).split(UNIT_SEPARATOR)[:-1]) + "\n"
+        self.assertEqual(p, decode(old.encode()))
+
+    def test_RoomHistory(self):
+        p = RoomHistory("room", "some_user", 10)
+        ep = p.encode()
+        dp = decode(ep)
+        self.assertEqual(p, dp)
+
+    def test_Presence(self):
+        p = Presence("room", "some_user", PRESENCE_QUIT)
+        self.assertEqual(p, decode(p.encode()))
+        self.assertEqual(p, decode_binary(p.encode_binary()[4:]))
+
+    def test_Ping(self):
+        p = Ping("some_user")
+        self.assertEqual(p, decode(p.encode()))
+        self.assertEqual(p, decode_binary(p.encode_binary()[4:]))
+
+    def test_Relay(self):
+        inner = PrivateMessage("from", "to", "a\x1fb\nc")
+        p = Relay.carrying("node-a", 12, inner)
+        dp = decode_binary(read_binary(io.BytesIO(p.encode_binary())))
+        self.assertEqual(p, dp)
+        self.assertEqual(inner, dp.packet())
+        dp = decode(p.encode())
+        self.assertEqual(p, dp)
+        self.assertEqual(inner, dp.packet())
+
     def test_Broadcast(self):
         p = Broadcast("some message", "some_user")
         ep = p.encode()
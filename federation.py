@@ -0,0 +1,628 @@
+# irc.py - an IRC-like implementation for Portland State University's
+#          CS594 - Internetworking Protocols project
+#
+# Copyright (C) 2017  Jeremiah Peschka <jpeschka@pdx.edu>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+# Server-to-server links for CS594 project
+
+from collections import OrderedDict
+from typing import Dict, List, Set
+import itertools
+import logging
+import socket
+import threading
+import time
+import unittest
+import common
+import registry
+
+LOG = logging.getLogger("irc.federation")
+
+# Relays that have crossed this many links are dropped
+MAX_HOPS = 16
+# How many (origin, sequence) pairs to remember for spotting duplicates
+SEEN_LIMIT = 65536
+# Seconds between attempts to bring a configured link back up
+RECONNECT_DELAY = 1.0
+
+
+class RemoteUser(object):
+    """A user connected to another server."""
+
+    __slots__ = ("nick", "home", "link")
+
+    def __init__(self, nick: str, home: str, link: "Link"):
+        self.nick = nick
+        # The server the user is connected to
+        self.home = home
+        # The link the user was learned through, and messages for them go
+        self.link = link
+
+
+class Link(object):
+    """A connection to a neighbouring server, carrying binary Relay frames."""
+
+    def __init__(self, connection: socket.socket, rfile, name: str):
+        self.connection = connection
+        self.rfile = rfile
+        self.name = name
+        self.lock = threading.Lock()
+        self.closed = False
+
+    def send(self, relay: common.Relay):
+        if self.closed:
+            return
+        try:
+            with self.lock:
+                self.connection.sendall(relay.encode_binary())
+        except OSError as e:
+            # The reader notices too and tears the link down.
+            LOG.warning("Unable to send to %s: %s", self.name, e)
+
+    def read(self):
+        """Returns the next relay, or None once the link is closed."""
+        while True:
+            try:
+                data = common.read_binary(self.rfile)
+            except (OSError, ValueError, TypeError):
+                return None
+            if not data:
+                return None
+            try:
+                relay = common.decode_binary(data)
+            except TypeError as e:
+                LOG.warning("Bad frame from %s: %s", self.name, e)
+                continue
+            if isinstance(relay, common.Relay):
+                return relay
+
+    def close(self):
+        self.closed = True
+        try:
+            self.connection.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.connection.close()
+
+
+class Federation(object):
+    """Shares one namespace of users and rooms with linked servers.
+
+    Every server keeps a full copy of the network's state: rooms go into the
+    server's registry, while users on other servers and their room
+    memberships are kept here. Connects, disconnects, room creation, joins
+    and leaves are relayed to every link and passed on by each server that
+    finds they change something, so a change stops spreading once everyone
+    has it. Room messages and broadcasts are delivered by each server to
+    its own users and passed on to every other link; duplicates arriving by
+    a second route are recognized by origin and sequence number. Private
+    messages follow the link their recipient was learned through.
+
+    `local` delivers to this server's users and must provide deliver_room,
+    deliver_user, deliver_all and deliver_presence.
+    """
+
+    def __init__(self, name: str, users: registry.Registry, local):
+        self.name = name
+        self.registry = users
+        self.local = local
+        self.lock = threading.RLock()
+        self.links: List[Link] = list()
+        self.remote_users: Dict[str, RemoteUser] = dict()
+        # Sorted nicks of remote users, for paged listings
+        self.user_index = registry.SortedNames()
+        # Room name -> nicks of members on other servers
+        self.memberships: Dict[str, registry.SortedNames] = dict()
+        self.seen = OrderedDict()
+        # Links that withdrew routes we used since they last asked for a sync
+        self.withdrawn: Set[Link] = set()
+        # Start from the clock so a restarted server doesn't reuse sequence
+        # numbers its neighbours still remember.
+        self.sequence = itertools.count(time.time_ns() // 1000)
+
+    # Bringing links up
+
+    def connect(self, host: str, port: int):
+        """Keeps a link to the server at host:port up from a background
+        thread."""
+        threading.Thread(target=self.link_forever,
+                         args=(host, port),
+                         daemon=True).start()
+
+    def link_forever(self, host: str, port: int):
+        while True:
+            try:
+                connection = socket.create_connection((host, port))
+            except OSError:
+                time.sleep(RECONNECT_DELAY)
+                continue
+            connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            rfile = connection.makefile("rb")
+            try:
+                connection.sendall(common.ServerLink(self.name).encode())
+                reply = common.decode(rfile.readline())
+            except (OSError, TypeError) as e:
+                LOG.warning("Linking to %s:%s failed: %s", host, port, e)
+                reply = None
+            if reply is not None and reply.status == common.Status.OK:
+                LOG.info("Linked to %s at %s:%s", reply.username, host, port)
+                self.run(Link(connection, rfile, reply.username))
+            connection.close()
+            time.sleep(RECONNECT_DELAY)
+
+    def accept(self, connection: socket.socket, rfile,
+               packet: common.ServerLink):
+        """Serves a link another server opened, until it goes down."""
+        name = packet.username
+        with self.lock:
+            known = name == self.name or any(link.name == name
+                                             for link in self.links)
+        if known:
+            packet.status = common.Status.ERROR
+            packet.error = common.Error.USER_ALREADY_EXISTS
+            connection.sendall(packet.encode())
+            return
+        packet.username = self.name
+        packet.status = common.Status.OK
+        packet.error = common.Error.NO_ERROR
+        connection.sendall(packet.encode())
+        LOG.info("Linked from %s", name)
+        self.run(Link(connection, rfile, name))
+
+    def run(self, link: Link):
+        with self.lock:
+            self.links.append(link)
+        # Send our state from another thread so neither side stops reading
+        # while both are sending.
+        threading.Thread(target=self.burst, args=(link, ),
+                         daemon=True).start()
+        try:
+            while True:
+                relay = link.read()
+                if relay is None:
+                    break
+                self.receive(link, relay)
+        finally:
+            self.unlink(link)
+
+    def burst(self, link: Link):
+        """Sends everything a newly linked server needs to know."""
+        relays = []
+        for nick in self.registry.user_names():
+            relays.append((self.name, common.Connect(nick, 0)))
+        with self.lock:
+            remote = [
+                user for user in self.remote_users.values()
+                if user.link is not link
+            ]
+            memberships = {
+                name: set(nicks)
+                for name, nicks in self.memberships.items()
+            }
+        for user in remote:
+            relays.append((user.home, common.Connect(user.nick, 0)))
+        for name in self.registry.room_names():
+            relays.append((self.name, common.CreateRoom(name, self.name)))
+            for user in self.registry.members(name) or ():
+                relays.append((self.name, common.JoinRoom(name, user.nick)))
+        for user in remote:
+            for name, nicks in memberships.items():
+                if user.nick in nicks:
+                    relays.append((user.home,
+                                   common.JoinRoom(name, user.nick)))
+        for origin, packet in relays:
+            link.send(common.Relay.carrying(origin, 0, packet))
+
+    def unlink(self, link: Link):
+        """Forgets the users behind a link that went down."""
+        with self.lock:
+            if link in self.links:
+                self.links.remove(link)
+            self.withdrawn.discard(link)
+            lost = [
+                user for user in self.remote_users.values()
+                if user.link is link
+            ]
+        link.close()
+        lost = self.withdraw(lost, link)
+        LOG.info("Link to %s is down; %d users lost", link.name, len(lost))
+        if lost:
+            self.request_sync(link)
+
+    def withdraw(self, users: List[RemoteUser],
+                 link: Link) -> List[RemoteUser]:
+        """Forgets users whose route through `link` is gone, and tells the
+        other links so. Returns the users forgotten.
+
+        A withdrawal is a Disconnect relayed with a sequence of 0, and is
+        only applied by servers that reach the user through the server
+        sending it. A user whose home server is linked to this one directly
+        is still reachable, and is routed over that link instead.
+        """
+        events = []
+        lost = []
+        with self.lock:
+            homes = {other.name: other for other in self.links}
+            for user in users:
+                if self.remote_users.get(user.nick) is not user:
+                    continue
+                home = homes.get(user.home)
+                if home is not None and home is not link:
+                    user.link = home
+                    continue
+                lost.append(user)
+                events += self.forget(user.nick)
+        for event in events:
+            self.local.deliver_presence(event)
+        for user in lost:
+            self.forward(
+                common.Relay.carrying(user.home, 0,
+                                      common.Disconnect(user.nick)),
+                link)
+        return lost
+
+    def request_sync(self, came_from: Link):
+        """Asks every other link for everything it knows, so users still
+        reachable by another route are learned again through it. Sent
+        after the withdrawals, so nobody answers with a route through us."""
+        self.forward(
+            common.Relay.carrying(self.name, 0, common.ServerLink(self.name)),
+            came_from)
+
+    # What this server's handlers tell the network
+
+    def relay(self, packet: common.IrcPacket):
+        """Sends a change or message that started on this server to every
+        linked server."""
+        sequence = next(self.sequence)
+        self.first_sight(self.name, sequence)
+        self.forward(common.Relay.carrying(self.name, sequence, packet), None)
+
+    def route(self, packet: common.PrivateMessage) -> bool:
+        """Sends a private message towards a user on another server.
+
+        Returns False if no linked server has the user.
+        """
+        with self.lock:
+            user = self.remote_users.get(packet.to)
+        if user is None:
+            return False
+        sequence = next(self.sequence)
+        self.first_sight(self.name, sequence)
+        user.link.send(common.Relay.carrying(self.name, sequence, packet))
+        return True
+
+    def knows(self, nick: str) -> bool:
+        return nick in self.remote_users
+
+    def user_names(self) -> List[str]:
+        with self.lock:
+            return list(self.remote_users)
+
+    def members(self, name: str) -> List[str]:
+        with self.lock:
+            return list(self.memberships.get(name, ()))
+
+    def user_page(self, after: str, limit: int, prefix: str):
+        with self.lock:
+            return self.user_index.page(after, limit, prefix)
+
+    def member_page(self, name: str, after: str, limit: int, prefix: str):
+        with self.lock:
+            nicks = self.memberships.get(name)
+            if nicks is None:
+                return [], False
+            return nicks.page(after, limit, prefix)
+
+    # What linked servers tell us
+
+    def receive(self, link: Link, relay: common.Relay):
+        if relay.username == self.name or relay.hops >= MAX_HOPS:
+            return
+        if relay.sequence and not self.first_sight(relay.username,
+                                                   relay.sequence):
+            return
+        try:
+            packet = relay.packet()
+        except TypeError as e:
+            LOG.warning("Bad relay from %s: %s", link.name, e)
+            return
+        relay.hops += 1
+
+        if isinstance(packet, common.ServerLink):
+            # A neighbour lost routes and wants ours. If it withdrew some
+            # from us first, our other neighbours may have them.
+            threading.Thread(target=self.burst, args=(link, ),
+                             daemon=True).start()
+            with self.lock:
+                withdrawn = link in self.withdrawn
+                self.withdrawn.discard(link)
+            if withdrawn:
+                self.request_sync(link)
+            return
+        if isinstance(packet, common.Disconnect) and not relay.sequence:
+            with self.lock:
+                user = self.remote_users.get(packet.username)
+            if (user is not None and user.link is link
+                    and user.home == relay.username
+                    and self.withdraw([user], link)):
+                with self.lock:
+                    self.withdrawn.add(link)
+            return
+        if isinstance(packet, common.PrivateMessage):
+            if not self.local.deliver_user(packet):
+                with self.lock:
+                    user = self.remote_users.get(packet.to)
+                if user is not None and user.link is not link:
+                    user.link.send(relay)
+            return
+        if self.apply(packet, relay.username, link):
+            self.forward(relay, link)
+
+    def apply(self, packet: common.IrcPacket, home: str, link: Link) -> bool:
+        """Applies a relayed packet here. Returns True if it should be
+        passed on to the other links."""
+        if isinstance(packet, common.MessageRoom):
+            self.local.deliver_room(packet)
+            return True
+        if isinstance(packet, common.Broadcast):
+            self.local.deliver_all(packet)
+            return True
+        if isinstance(packet, common.CreateRoom):
+            return self.registry.add_room(registry.Room(packet.room))
+
+        # Presence changes for local users are delivered once the lock is
+        # released.
+        events = []
+        with self.lock:
+            changed = self.update(packet, home, link, events)
+        for event in events:
+            self.local.deliver_presence(event)
+        return changed
+
+    def update(self, packet: common.IrcPacket, home: str, link: Link,
+               events: List[common.Presence]) -> bool:
+        """Applies a relayed change to who is where, adding a Presence for
+        each room whose members changed to `events`. Call with the lock
+        held."""
+        if isinstance(packet, common.Connect):
+            nick = packet.username
+            if self.registry.find_user(nick) is not None or (
+                    nick in self.remote_users
+                    and self.remote_users[nick].home != home):
+                LOG.warning("Nick collision on %s from %s", nick, home)
+                return False
+            if nick in self.remote_users:
+                return False
+            self.remote_users[nick] = RemoteUser(nick, home, link)
+            self.user_index.add(nick)
+            return True
+        if isinstance(packet, common.Disconnect):
+            user = self.remote_users.get(packet.username)
+            if user is None or user.home != home:
+                return False
+            events += self.forget(packet.username)
+            return True
+        if isinstance(packet, common.JoinRoom):
+            if packet.username not in self.remote_users:
+                return False
+            self.registry.add_room(registry.Room(packet.room))
+            nicks = self.memberships.setdefault(packet.room,
+                                                registry.SortedNames())
+            if not nicks.add(packet.username):
+                return False
+            events.append(
+                common.Presence(packet.room, packet.username,
+                                common.PRESENCE_JOIN))
+            return True
+        if isinstance(packet, common.LeaveRoom):
+            nicks = self.memberships.get(packet.room)
+            if nicks is None or not nicks.discard(packet.username):
+                return False
+            events.append(
+                common.Presence(packet.room, packet.username,
+                                common.PRESENCE_LEAVE))
+            return True
+        return False
+
+    def forget(self, nick: str) -> List[common.Presence]:
+        """Removes a remote user. Returns a Presence for each room they
+        were in."""
+        del self.remote_users[nick]
+        self.user_index.discard(nick)
+        return [
+            common.Presence(name, nick, common.PRESENCE_QUIT)
+            for name, nicks in self.memberships.items() if nicks.discard(nick)
+        ]
+
+    def forward(self, relay: common.Relay, came_from: Link):
+        with self.lock:
+            links = [link for link in self.links if link is not came_from]
+        for link in links:
+            link.send(relay)
+
+    def first_sight(self, origin: str, sequence: int) -> bool:
+        """Records a relay as seen. Returns False if it was seen before."""
+        key = (origin, sequence)
+        with self.lock:
+            if key in self.seen:
+                return False
+            self.seen[key] = None
+            if len(self.seen) > SEEN_LIMIT:
+                self.seen.popitem(last=False)
+            return True
+
+
+class RecordingLocal(object):
+    """Stands in for a server's users and keeps what it was asked to
+    deliver."""
+
+    def __init__(self, users: registry.Registry):
+        self.users = users
+        self.delivered = []
+        self.presence = []
+
+    def deliver_room(self, packet):
+        self.delivered.append(packet)
+
+    def deliver_user(self, packet):
+        if self.users.find_user(packet.to) is None:
+            return False
+        self.delivered.append(packet)
+        return True
+
+    def deliver_all(self, packet):
+        self.delivered.append(packet)
+
+    def deliver_presence(self, packet):
+        self.presence.append((packet.room, packet.username, packet.change))
+
+
+class TestFederation(unittest.TestCase):
+    def setUp(self):
+        # Three servers linked in a triangle, so every relay has a second
+        # route to arrive by.
+        self.registries = [registry.Registry() for _ in range(3)]
+        self.locals = [RecordingLocal(r) for r in self.registries]
+        self.nodes = [
+            Federation("node" + str(i), self.registries[i], self.locals[i])
+            for i in range(3)
+        ]
+        self.link(0, 1)
+        self.link(1, 2)
+        self.link(2, 0)
+
+    def tearDown(self):
+        for node in self.nodes:
+            for link in list(node.links):
+                link.close()
+
+    def link(self, a: int, b: int):
+        left, right = socket.socketpair()
+        for node, connection, peer in ((a, left, b), (b, right, a)):
+            link = Link(connection, connection.makefile("rb"),
+                        "node" + str(peer))
+            threading.Thread(target=self.nodes[node].run,
+                             args=(link, ),
+                             daemon=True).start()
+
+    def wait_for(self, condition):
+        deadline = time.monotonic() + 5
+        while not condition():
+            if time.monotonic() > deadline:
+                self.fail("timed out")
+            time.sleep(0.01)
+
+    def connect(self, node: int, nick: str):
+        self.registries[node].add_user(
+            registry.User(nick, ("127.0.0.1", 0), 0))
+        self.nodes[node].relay(common.Connect(nick, 0))
+
+    def test_namespace_is_shared(self):
+        self.connect(0, "alice")
+        self.nodes[1].relay(common.CreateRoom("room", "bob"))
+        self.registries[1].add_room(registry.Room("room"))
+        self.wait_for(lambda: all(n.knows("alice") for n in self.nodes[1:]))
+        self.wait_for(lambda: all("room" in r.room_names()
+                                  for r in self.registries))
+        self.registries[0].join("alice", "room")
+        self.nodes[0].relay(common.JoinRoom("room", "alice"))
+        self.wait_for(lambda: self.nodes[2].members("room") == ["alice"])
+        self.registries[0].remove_user("alice")
+        self.nodes[0].relay(common.Disconnect("alice"))
+        self.wait_for(lambda: not any(n.knows("alice") for n in self.nodes))
+        self.assertEqual([], self.nodes[1].members("room"))
+        self.assertEqual([("room", "alice", common.PRESENCE_JOIN),
+                          ("room", "alice", common.PRESENCE_QUIT)],
+                         self.locals[2].presence)
+        self.assertEqual([], self.locals[0].presence)
+
+    def test_messages_arrive_once(self):
+        # Binary clients may send any text; it must arrive whole.
+        packet = common.MessageRoom("room", "a\x1fb\nc", "alice")
+        self.nodes[0].relay(packet)
+        self.nodes[0].relay(common.Broadcast("everyone", "alice"))
+        self.wait_for(lambda: len(self.locals[1].delivered) == 2 and len(
+            self.locals[2].delivered) == 2)
+        time.sleep(0.1)
+        for received in self.locals[1:]:
+            self.assertEqual(packet, received.delivered[0])
+            self.assertEqual(2, len(received.delivered))
+        self.assertEqual([], self.locals[0].delivered)
+
+    def test_private_message_is_routed(self):
+        self.connect(2, "carol")
+        self.wait_for(lambda: self.nodes[0].knows("carol"))
+        packet = common.PrivateMessage("alice", "carol", "hi")
+        self.assertTrue(self.nodes[0].route(packet))
+        self.assertFalse(self.nodes[0].route(
+            common.PrivateMessage("alice", "nobody", "hi")))
+        self.wait_for(lambda: self.locals[2].delivered)
+        self.assertEqual([packet], self.locals[2].delivered)
+
+    def test_link_up_syncs_state(self):
+        late = registry.Registry()
+        late.add_user(registry.User("dave", ("127.0.0.1", 0), 0))
+        late.add_room(registry.Room("den"))
+        late.join("dave", "den")
+        self.registries.append(late)
+        self.locals.append(RecordingLocal(late))
+        self.nodes.append(Federation("node3", late, self.locals[3]))
+        self.connect(0, "alice")
+        self.wait_for(lambda: self.nodes[2].knows("alice"))
+        self.link(3, 2)
+        self.wait_for(lambda: self.nodes[3].knows("alice"))
+        self.wait_for(lambda: self.nodes[0].members("den") == ["dave"])
+
+    def test_link_down_forgets_users(self):
+        self.connect(0, "alice")
+        self.wait_for(lambda: self.nodes[1].knows("alice"))
+        for link in list(self.nodes[0].links):
+            link.close()
+        self.wait_for(lambda: not self.nodes[1].knows("alice"))
+        self.wait_for(lambda: not self.nodes[2].knows("alice"))
+
+    def test_partial_link_failure_keeps_other_routes(self):
+        self.wait_for(lambda: all(len(n.links) == 2 for n in self.nodes))
+        self.connect(0, "alice")
+        self.connect(1, "bob")
+        self.registries[0].add_room(registry.Room("room"))
+        self.nodes[0].relay(common.CreateRoom("room", "alice"))
+        self.registries[0].join("alice", "room")
+        self.nodes[0].relay(common.JoinRoom("room", "alice"))
+        self.wait_for(lambda: all(
+            n.members("room") == ["alice"] for n in self.nodes[1:]))
+        self.wait_for(lambda: self.nodes[2].knows("bob"))
+        for link in list(self.nodes[0].links):
+            if link.name == "node1":
+                link.close()
+        # node0 and node1 learn each other's users again through node2.
+        self.wait_for(lambda: self.nodes[1].knows("alice") and self.nodes[
+            1].remote_users["alice"].link.name == "node2")
+        self.wait_for(lambda: self.nodes[0].knows("bob") and self.nodes[0].
+                      remote_users["bob"].link.name == "node2")
+        self.wait_for(lambda: self.nodes[1].members("room") == ["alice"])
+        # node2 never lost either of them, and reaches each directly.
+        self.assertEqual("node0",
+                         self.nodes[2].remote_users["alice"].link.name)
+        self.assertEqual("node1",
+                         self.nodes[2].remote_users["bob"].link.name)
+        self.assertEqual([("room", "alice", common.PRESENCE_JOIN)],
+                         self.locals[2].presence)
+
+
+if __name__ == '__main__':
+    unittest.main()
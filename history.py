@@ -0,0 +1,180 @@
+# irc.py - an IRC-like implementation for Portland State University's
+#          CS594 - Internetworking Protocols project
+#
+# Copyright (C) 2017  Jeremiah Peschka <jpeschka@pdx.edu>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+# Room message history for CS594 project
+
+from collections import deque
+from typing import Deque, List
+import datetime
+import threading
+import unittest
+import common
+
+
+class Entry(object):
+    """One message in a room's history."""
+
+    __slots__ = ("when", "size", "frame", "live")
+
+    def __init__(self, when: int, size: int, frame: common.Frame):
+        # Microseconds since the epoch, so aware and naive times compare
+        self.when = when
+        self.size = size
+        self.frame = frame
+        # Cleared once the entry is evicted from its room
+        self.live = True
+
+
+class History(object):
+    """Keeps the last `capacity` messages of every room, within an overall
+    budget of `budget` bytes.
+
+    Each room's ring is a deque on the Room. Entries hold the Frame that
+    was fanned out, so replay sends the bytes already encoded for the live
+    delivery. When the budget is exceeded, the oldest messages across all
+    rooms are evicted first.
+    """
+
+    def __init__(self, capacity: int, budget: int):
+        self.capacity = capacity
+        self.budget = budget
+        self.lock = threading.Lock()
+        self.size = 0
+        self.count = 0
+        # Every live entry and the ring holding it, oldest first. Entries
+        # evicted by their room's capacity stay here, marked dead, until
+        # they reach the front or are swept out.
+        self.order: Deque = deque()
+
+    def record(self, ring: Deque[Entry], frame: common.Frame):
+        packet = frame.packet
+        entry = Entry(common.micros_since_epoch(packet.timestamp),
+                      len(frame.encode()), frame)
+        with self.lock:
+            if len(ring) >= self.capacity:
+                self.evict(ring.popleft())
+            ring.append(entry)
+            self.order.append((ring, entry))
+            self.size += entry.size
+            self.count += 1
+            while self.size > self.budget and self.order:
+                oldest_ring, oldest = self.order.popleft()
+                if oldest.live:
+                    oldest_ring.popleft()
+                    self.evict(oldest)
+            if len(self.order) > 2 * self.count + 64:
+                self.order = deque(
+                    item for item in self.order if item[1].live)
+
+    def evict(self, entry: Entry):
+        entry.live = False
+        self.size -= entry.size
+        self.count -= 1
+
+    def recent(self, ring: Deque[Entry], count: int) -> List[common.Frame]:
+        """Returns up to the last `count` frames of a room, oldest first."""
+        with self.lock:
+            start = max(0, len(ring) - count)
+            return [ring[i].frame for i in range(start, len(ring))]
+
+    def since(self, ring: Deque[Entry],
+              when: datetime.datetime) -> List[common.Frame]:
+        """Returns the frames of a room sent at or after `when`, in the
+        order they arrived.
+
+        Send times come from the senders' clocks, so a ring in arrival
+        order isn't in time order, and the whole ring is checked.
+        """
+        after = common.micros_since_epoch(when)
+        with self.lock:
+            return [entry.frame for entry in ring if entry.when >= after]
+
+    def oldest(self, ring: Deque[Entry]):
+        """Returns the earliest send time of the messages still kept for a
+        room, in microseconds since the epoch, or None if none are kept."""
+        with self.lock:
+            return min(entry.when for entry in ring) if ring else None
+
+
+class TestHistory(unittest.TestCase):
+    def message(self, text: str, minute: int = 0):
+        return common.Frame(
+            common.MessageRoom("room", text, "user",
+                               datetime.datetime(2017, 10, 3, 22, minute)))
+
+    def test_capacity(self):
+        history = History(3, 1 << 20)
+        ring = deque()
+        for i in range(5):
+            history.record(ring, self.message(str(i)))
+        self.assertEqual(["2", "3", "4"],
+                         [f.packet.message for f in history.recent(ring, 10)])
+        self.assertEqual(["4"],
+                         [f.packet.message for f in history.recent(ring, 1)])
+        self.assertEqual(3, history.count)
+
+    def test_budget_evicts_oldest_first(self):
+        size = len(self.message("x").encode())
+        history = History(10, 3 * size)
+        first, second = deque(), deque()
+        history.record(first, self.message("a"))
+        history.record(second, self.message("b"))
+        history.record(first, self.message("c"))
+        history.record(second, self.message("d"))
+        self.assertEqual(["c"], [e.frame.packet.message for e in first])
+        self.assertEqual(["b", "d"], [e.frame.packet.message for e in second])
+        self.assertEqual(3 * size, history.size)
+
+    def test_since(self):
+        history = History(10, 1 << 20)
+        ring = deque()
+        for minute in range(5):
+            history.record(ring, self.message(str(minute), minute))
+        frames = history.since(ring, datetime.datetime(2017, 10, 3, 22, 3))
+        self.assertEqual(["3", "4"], [f.packet.message for f in frames])
+        self.assertEqual(ring[0].when, history.oldest(ring))
+        self.assertIsNone(history.oldest(deque()))
+
+    def test_since_with_skewed_clocks(self):
+        history = History(10, 1 << 20)
+        ring = deque()
+        # A sender with a slow clock got a message in between two others.
+        for text, minute in (("a", 4), ("slow", 1), ("b", 5)):
+            history.record(ring, self.message(text, minute))
+        frames = history.since(ring, datetime.datetime(2017, 10, 3, 22, 3))
+        self.assertEqual(["a", "b"], [f.packet.message for f in frames])
+        self.assertEqual(ring[1].when, history.oldest(ring))
+
+    def test_replay_reuses_encoding(self):
+        history = History(10, 1 << 20)
+        ring = deque()
+        frame = self.message("hello")
+        data = frame.encode()
+        history.record(ring, frame)
+        self.assertIs(data, history.recent(ring, 1)[0].encode())
+
+    def test_dead_entries_are_swept(self):
+        history = History(1, 1 << 20)
+        ring = deque()
+        for i in range(1000):
+            history.record(ring, self.message(str(i)))
+        self.assertLess(len(history.order), 100)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,186 @@
+# irc.py - an IRC-like implementation for Portland State University's
+#          CS594 - Internetworking Protocols project
+#
+# Copyright (C) 2017  Jeremiah Peschka <jpeschka@pdx.edu>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+# Request rate limits and connection admission for CS594 project
+
+from typing import Dict, Tuple
+import threading
+import time
+import unittest
+import common
+
+# Stands for every opcode without a rate of its own
+ALL = "*"
+
+
+class TokenBucket(object):
+    """Allows `rate` requests a second on average and up to `burst` at
+    once."""
+
+    __slots__ = ("rate", "burst", "tokens", "stamp")
+
+    def __init__(self, rate: float, burst: float, now: float):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.stamp = now
+
+    def take(self, now: float) -> bool:
+        tokens = min(self.burst, self.tokens + (now - self.stamp) * self.rate)
+        self.stamp = now
+        if tokens < 1:
+            self.tokens = tokens
+            return False
+        self.tokens = tokens - 1
+        return True
+
+
+def parse_rate(text: str) -> Tuple[str, float, float]:
+    """Parses OPCODE=RATE[/BURST], where OPCODE is an opcode name such as
+    BROADCAST or * for all of them. BURST defaults to RATE, or to 1 for a
+    rate below 1."""
+    name, _, limit = text.partition("=")
+    rate, _, burst = limit.partition("/")
+    if name != ALL and name not in common.Operations.__members__:
+        raise ValueError("unknown opcode " + name)
+    rate = float(rate)
+    burst = float(burst) if burst else max(rate, 1.0)
+    if rate <= 0 or burst < 1:
+        raise ValueError("rates must be positive and bursts at least 1")
+    return name, rate, burst
+
+
+class RateLimits(object):
+    """Keeps a token bucket for each rate-limited opcode on whatever
+    requests are charged to: the server charges a connection, or for a
+    dial-back client, the client.
+
+    `rates` maps opcode names, or ALL, to (rate, burst) pairs. Buckets live
+    in the owner's `buckets` attribute, so they go away with it, and
+    checking one is a couple of dictionary lookups and some arithmetic.
+    Handler threads share owners, so that is done under a lock.
+    """
+
+    def __init__(self, rates: Dict[str, Tuple[float, float]]):
+        default = rates.get(ALL)
+        self.rates = {
+            op: rates.get(op.name, default)
+            for op in common.Operations
+        }
+        self.lock = threading.Lock()
+
+    def allow(self, owner, opcode: common.Operations,
+              now: float = None) -> bool:
+        rate = self.rates[opcode]
+        if rate is None:
+            return True
+        if now is None:
+            now = time.monotonic()
+        with self.lock:
+            buckets = owner.buckets
+            if buckets is None:
+                buckets = owner.buckets = dict()
+            bucket = buckets.get(opcode)
+            if bucket is None:
+                bucket = buckets[opcode] = TokenBucket(rate[0], rate[1], now)
+            return bucket.take(now)
+
+
+class Admission(object):
+    """Counts open connections and turns new ones away past `limit`."""
+
+    def __init__(self, limit: int):
+        self.limit = limit
+        self.count = 0
+        self.lock = threading.Lock()
+
+    def enter(self) -> bool:
+        with self.lock:
+            if self.count >= self.limit:
+                return False
+            self.count += 1
+            return True
+
+    def leave(self):
+        with self.lock:
+            self.count -= 1
+
+
+class FakeOwner(object):
+    buckets = None
+
+
+class TestLimits(unittest.TestCase):
+    def test_bucket(self):
+        bucket = TokenBucket(2, 3, 0.0)
+        self.assertEqual([True, True, True, False],
+                         [bucket.take(0.0) for _ in range(4)])
+        self.assertTrue(bucket.take(0.5))
+        self.assertFalse(bucket.take(0.5))
+        self.assertEqual(3, sum(bucket.take(100.0) for _ in range(10)))
+
+    def test_parse_rate(self):
+        self.assertEqual(("BROADCAST", 1.0, 5.0), parse_rate("BROADCAST=1/5"))
+        self.assertEqual((ALL, 20.0, 20.0), parse_rate("*=20"))
+        self.assertEqual(("ROOM_MSG", 0.5, 1.0), parse_rate("ROOM_MSG=0.5"))
+        for text in ("NOPE=1", "BROADCAST", "BROADCAST=0", "BROADCAST=1/0"):
+            with self.assertRaises(ValueError):
+                parse_rate(text)
+
+    def test_rate_limits(self):
+        limits = RateLimits({"BROADCAST": (1, 1), ALL: (10, 10)})
+        user = FakeOwner()
+        self.assertTrue(limits.allow(user, common.Operations.BROADCAST, 0))
+        self.assertFalse(limits.allow(user, common.Operations.BROADCAST, 0))
+        self.assertTrue(limits.allow(user, common.Operations.ROOM_MSG, 0))
+        self.assertTrue(limits.allow(user, common.Operations.BROADCAST, 1))
+        unlimited = RateLimits({"BROADCAST": (1, 1)})
+        self.assertTrue(
+            all(
+                unlimited.allow(user, common.Operations.ROOM_MSG, 0)
+                for _ in range(100)))
+
+    def test_rate_limits_across_threads(self):
+        limits = RateLimits({"BROADCAST": (0.001, 100)})
+        owner = FakeOwner()
+        allowed = []
+
+        def spend():
+            allowed.append(
+                sum(
+                    limits.allow(owner, common.Operations.BROADCAST, 0.0)
+                    for _ in range(1000)))
+
+        threads = [threading.Thread(target=spend) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(100, sum(allowed))
+
+    def test_admission(self):
+        admission = Admission(2)
+        self.assertTrue(admission.enter())
+        self.assertTrue(admission.enter())
+        self.assertFalse(admission.enter())
+        admission.leave()
+        self.assertTrue(admission.enter())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,295 @@
+# irc.py - an IRC-like implementation for Portland State University's
+#          CS594 - Internetworking Protocols project
+#
+# Copyright (C) 2017  Jeremiah Peschka <jpeschka@pdx.edu>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+# Load generator for CS594 project
+#
+# Simulates many session clients from a single process against a running
+# server and reports throughput and latency. Every chat message carries the
+# time it was sent, so each copy the server delivers is a latency sample.
+
+from collections import deque
+from datetime import datetime
+from typing import Dict, List
+import argparse
+import asyncio
+import json
+import random
+import subprocess
+import sys
+import time
+import asyncclient
+import common
+
+PREFIX = "lg-"
+# Actions each simulated client picks from, weighted by --mix
+ACTIONS = ["room", "pm", "broadcast", "list"]
+
+
+class Results(object):
+    """Samples and counters shared by every simulated client."""
+
+    def __init__(self):
+        self.delivery: List[float] = []
+        self.request: List[float] = []
+        self.sent = 0
+        self.expected = 0
+        self.errors = 0
+
+    def percentiles(self, samples: List[float]):
+        """Returns the p50, p99 and p99.9 of `samples` in milliseconds."""
+        if not samples:
+            return [None, None, None]
+        ordered = sorted(samples)
+        last = len(ordered) - 1
+        return [
+            round(ordered[min(last, int(len(ordered) * q))] * 1e3, 3)
+            for q in (0.5, 0.99, 0.999)
+        ]
+
+
+class SimClient(asyncclient.AsyncClient):
+    """One simulated user on a session connection.
+
+    An AsyncClient that times each request's reply and each delivery of a
+    stamped message instead of queueing what the server pushes.
+    """
+
+    def __init__(self, nick: str, rooms: List[str], results: Results):
+        super().__init__(nick)
+        self.rooms = rooms
+        self.results = results
+        # When each request in `pending` was written, in the same order
+        self.started = deque()
+
+    def send(self, packet: common.IrcPacket) -> asyncio.Future:
+        future = super().send(packet)
+        self.started.append(time.perf_counter())
+        return future
+
+    def dispatch(self, message: common.IrcPacket):
+        if self.pending and common.is_reply(message, self.pending[0][0]):
+            self.results.request.append(time.perf_counter() -
+                                        self.started.popleft())
+            if message.status != common.Status.OK:
+                self.results.errors += 1
+        super().dispatch(message)
+
+    def push(self, message: common.IrcPacket):
+        text = getattr(message, "message", None)
+        if text is not None and text.startswith(PREFIX):
+            self.results.delivery.append(time.perf_counter() -
+                                         float(text[len(PREFIX):]))
+
+
+def stamp():
+    return PREFIX + repr(time.perf_counter())
+
+
+async def chat(client: SimClient, clients: List[SimClient],
+               members: Dict[str, int], weights: List[int], rate: float,
+               deadline: float):
+    results = client.results
+    everyone = len(clients)
+    while time.perf_counter() < deadline:
+        # Exponential gaps give a Poisson arrival process per client.
+        await asyncio.sleep(random.expovariate(rate))
+        action = random.choices(ACTIONS, weights)[0]
+        if action == "room":
+            room = random.choice(client.rooms)
+            client.send(common.MessageRoom(room, stamp(), client.nick))
+            results.expected += members[room]
+        elif action == "pm":
+            to = clients[random.randrange(everyone)].nick
+            client.send(common.PrivateMessage(client.nick, to, stamp()))
+            results.expected += 1
+        elif action == "broadcast":
+            client.send(common.Broadcast(stamp(), client.nick))
+            results.expected += everyone
+        else:
+            client.send(
+                random.choice([
+                    common.ListUsers([], client.nick),
+                    common.ListRooms([], client.nick)
+                ]))
+            continue
+        results.sent += 1
+        await client.writer.drain()
+
+
+def parse_mix(mix: str) -> List[int]:
+    weights = dict.fromkeys(ACTIONS, 0)
+    for part in mix.split(","):
+        name, _, weight = part.partition("=")
+        if name not in weights:
+            raise argparse.ArgumentTypeError("unknown action '" + name + "'")
+        weights[name] = int(weight)
+    return [weights[name] for name in ACTIONS]
+
+
+def version():
+    try:
+        return subprocess.run(["git", "describe", "--always", "--dirty"],
+                              capture_output=True,
+                              text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+async def run(args):
+    results = Results()
+    rooms = [PREFIX + "room" + str(r) for r in range(args.rooms)]
+    clients = []
+    members = dict.fromkeys(rooms, 0)
+    for i in range(args.clients):
+        joined = [rooms[(i + k) % len(rooms)] for k in range(args.joins)]
+        for room in joined:
+            members[room] += 1
+        clients.append(SimClient(PREFIX + str(i), joined, results))
+
+    started = time.perf_counter()
+    await asyncio.gather(*(client.connect(args.host, args.port, args.binary)
+                           for client in clients))
+    for room in rooms:
+        # Left over from an earlier run against the same server is fine.
+        await clients[0].request(common.CreateRoom(room, clients[0].nick))
+    await asyncio.gather(*(client.request(common.JoinRoom(room, client.nick))
+                           for client in clients for room in client.rooms))
+    results.errors = 0
+    results.request.clear()
+    print("{} clients connected and joined in {:.2f}s".format(
+        len(clients),
+        time.perf_counter() - started))
+
+    started = time.perf_counter()
+    deadline = started + args.duration
+    await asyncio.gather(*(chat(client, clients, members, args.mix, args.rate,
+                                deadline) for client in clients))
+    # Let whatever is still queued on the server arrive.
+    await asyncio.sleep(args.drain)
+    elapsed = time.perf_counter() - started
+
+    await asyncio.gather(*(client.close() for client in clients),
+                         return_exceptions=True)
+
+    return {
+        "time": datetime.utcnow().isoformat(),
+        "version": version(),
+        "clients": args.clients,
+        "rooms": args.rooms,
+        "joins": args.joins,
+        "rate": args.rate,
+        "mix": dict(zip(ACTIONS, args.mix)),
+        "binary": args.binary,
+        "duration": args.duration,
+        "sent": results.sent,
+        "sent_per_sec": round(results.sent / args.duration, 1),
+        "delivered": len(results.delivery),
+        "delivered_per_sec": round(len(results.delivery) / elapsed, 1),
+        "lost": results.expected - len(results.delivery),
+        "errors": results.errors,
+        "delivery_ms": results.percentiles(results.delivery),
+        "request_ms": results.percentiles(results.request),
+    }
+
+
+def report(result: dict):
+    for key in ("sent", "sent_per_sec", "delivered", "delivered_per_sec",
+                "lost", "errors"):
+        print("{:<40} {:>10}".format(key, result[key]))
+    for key in ("delivery_ms", "request_ms"):
+        print("{:<40} {:>10} {:>10} {:>10}".format(
+            key + " p50/p99/p99.9", *[str(v) for v in result[key]]))
+
+
+def history(path: str):
+    """Prints the stored runs in `path`, oldest first."""
+    try:
+        with open(path) as f:
+            runs = [json.loads(line) for line in f if line.strip()]
+    except FileNotFoundError:
+        print("No results stored in " + path)
+        return
+    print("{:<20} {:<14} {:>7} {:>10} {:>12} {:>10} {:>10}".format(
+        "time", "version", "clients", "sent/s", "delivered/s", "p50 ms",
+        "p99 ms"))
+    for r in runs:
+        print("{:<20} {:<14} {:>7} {:>10} {:>12} {:>10} {:>10}".format(
+            r["time"][:19], r["version"][:14], r["clients"],
+            r["sent_per_sec"], r["delivered_per_sec"],
+            str(r["delivery_ms"][0]), str(r["delivery_ms"][1])))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Load generator for the CS594 IRC server")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--clients",
+                        type=int,
+                        default=100,
+                        help="simulated users (default 100)")
+    parser.add_argument("--rooms",
+                        type=int,
+                        default=10,
+                        help="rooms to spread them over (default 10)")
+    parser.add_argument("--joins",
+                        type=int,
+                        default=2,
+                        help="rooms each user joins (default 2)")
+    parser.add_argument("--rate",
+                        type=float,
+                        default=2.0,
+                        help="actions per second per user (default 2)")
+    parser.add_argument("--mix",
+                        type=parse_mix,
+                        default="room=85,pm=8,broadcast=1,list=6",
+                        help="relative weights of each action (default "
+                        "room=85,pm=8,broadcast=1,list=6)")
+    parser.add_argument("--duration",
+                        type=float,
+                        default=10.0,
+                        help="seconds to generate load for (default 10)")
+    parser.add_argument("--drain",
+                        type=float,
+                        default=1.0,
+                        help="seconds to wait for deliveries after the "
+                        "load stops (default 1)")
+    parser.add_argument("--binary",
+                        action="store_true",
+                        help="ask for binary framing")
+    parser.add_argument("--results",
+                        default="loadgen.jsonl",
+                        help="file to append each run's results to; empty "
+                        "to skip (default loadgen.jsonl)")
+    parser.add_argument("--history",
+                        action="store_true",
+                        help="print the runs stored in --results and exit")
+    args = parser.parse_args()
+
+    if args.history:
+        history(args.results)
+        sys.exit(0)
+    if not 0 < args.joins <= args.rooms:
+        parser.error("--joins must be between 1 and --rooms")
+
+    result = asyncio.run(run(args))
+    report(result)
+    if args.results:
+        with open(args.results, "a") as f:
+            f.write(json.dumps(result) + "\n")
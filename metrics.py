@@ -0,0 +1,241 @@
+# irc.py - an IRC-like implementation for Portland State University's
+#          CS594 - Internetworking Protocols project
+#
+# Copyright (C) 2017  Jeremiah Peschka <jpeschka@pdx.edu>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+# Server metrics for CS594 project
+
+from bisect import bisect_left
+from typing import Dict, List, Tuple
+import threading
+import unittest
+import common
+
+# Upper bounds of the handler latency buckets, in seconds: 1, 2.5 and 5 per
+# decade from 10us to 10s.
+LATENCY_BUCKETS = tuple(
+    round(m * 10**e, 9) for e in range(-5, 1) for m in (1, 2.5, 5)) + (10.0, )
+# Upper bounds of the fan-out buckets, in recipients
+FANOUT_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000,
+                  10000)
+
+
+class Histogram(object):
+    """Counts observations into fixed buckets.
+
+    `bounds` are the inclusive upper bounds of each bucket; anything larger
+    lands in a final overflow bucket.
+    """
+
+    def __init__(self, bounds: Tuple[float, ...]):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.total = 0
+        self.sum = 0
+
+    def observe(self, value: float):
+        self.counts[bisect_left(self.bounds, value)] += 1
+        self.total += 1
+        self.sum += value
+
+    def quantile(self, q: float):
+        """Returns the upper bound of the bucket holding the q-th quantile,
+        or None if nothing has been observed."""
+        if self.total == 0:
+            return None
+        rank = q * self.total
+        seen = 0
+        for bound, count in zip(self.bounds, self.counts):
+            seen += count
+            if seen >= rank:
+                return bound
+        return float("inf")
+
+    def cumulative(self) -> List[Tuple[float, int]]:
+        """Returns (upper bound, observations at or below it) pairs."""
+        pairs = []
+        seen = 0
+        for bound, count in zip(self.bounds, self.counts):
+            seen += count
+            pairs.append((bound, seen))
+        pairs.append((float("inf"), self.total))
+        return pairs
+
+
+class Metrics(object):
+    """Request, error, latency and fan-out counters for a server.
+
+    Recording is a dictionary lookup and a few additions under a lock, so
+    handlers can call it for every request.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.requests = dict.fromkeys(common.Operations, 0)
+        self.errors = dict.fromkeys(common.Error, 0)
+        self.latency = {
+            op: Histogram(LATENCY_BUCKETS)
+            for op in common.Operations
+        }
+        self.fanout = Histogram(FANOUT_BUCKETS)
+        self.failures = 0
+
+    def observe_request(self, opcode: common.Operations,
+                        error: common.Error, seconds: float):
+        with self.lock:
+            self.requests[opcode] += 1
+            self.errors[error] += 1
+            self.latency[opcode].observe(seconds)
+
+    def count_error(self, error: common.Error):
+        with self.lock:
+            self.errors[error] += 1
+
+    def observe_fanout(self, recipients: int):
+        with self.lock:
+            self.fanout.observe(recipients)
+
+    def count_failure(self):
+        with self.lock:
+            self.failures += 1
+
+    def summary(self, gauges: Dict[str, int],
+                counters: Dict[str, int]) -> List[str]:
+        """Returns the metrics as "name value" lines for a STATS reply.
+
+        Latencies are given as bucket bounds in milliseconds.
+        """
+        lines = [
+            "{} {}".format(name, value)
+            for name, value in list(gauges.items()) + list(counters.items())
+        ]
+        with self.lock:
+            for op, count in self.requests.items():
+                if count:
+                    latency = self.latency[op]
+                    lines.append("requests_{} {}".format(op.name, count))
+                    lines.append("latency_ms_p50_{} {:g}".format(
+                        op.name,
+                        latency.quantile(0.5) * 1e3))
+                    lines.append("latency_ms_p99_{} {:g}".format(
+                        op.name,
+                        latency.quantile(0.99) * 1e3))
+            for error, count in self.errors.items():
+                if count and error != common.Error.NO_ERROR:
+                    lines.append("errors_{} {}".format(error.name, count))
+            lines.append("fanout_messages {}".format(self.fanout.total))
+            lines.append("fanout_recipients {}".format(self.fanout.sum))
+            lines.append("delivery_failures {}".format(self.failures))
+        return lines
+
+    def render(self, gauges: Dict[str, int], counters: Dict[str, int]) -> str:
+        """Returns every metric in the Prometheus text exposition format.
+
+        `gauges` are point-in-time values, such as connected users, and
+        `counters` are totals kept elsewhere, such as by the outboxes; the
+        server works both out at scrape time.
+        """
+        lines = []
+        for name, value in gauges.items():
+            lines.append("# TYPE irc_" + name + " gauge")
+            lines.append("irc_{} {}".format(name, value))
+        for name, value in counters.items():
+            lines.append("# TYPE irc_" + name + "_total counter")
+            lines.append("irc_{}_total {}".format(name, value))
+        with self.lock:
+            lines.append("# TYPE irc_requests_total counter")
+            for op, count in self.requests.items():
+                lines.append('irc_requests_total{{opcode="{}"}} {}'.format(
+                    op.name, count))
+            lines.append("# TYPE irc_errors_total counter")
+            for error, count in self.errors.items():
+                lines.append('irc_errors_total{{error="{}"}} {}'.format(
+                    error.name, count))
+            lines.append("# TYPE irc_handler_seconds histogram")
+            for op, histogram in self.latency.items():
+                lines.extend(
+                    histogram_lines("irc_handler_seconds", histogram,
+                                    'opcode="' + op.name + '",'))
+            lines.append("# TYPE irc_fanout_recipients histogram")
+            lines.extend(
+                histogram_lines("irc_fanout_recipients", self.fanout, ""))
+            lines.append("# TYPE irc_delivery_failures_total counter")
+            lines.append("irc_delivery_failures_total {}".format(
+                self.failures))
+        return "\n".join(lines) + "\n"
+
+
+def histogram_lines(name: str, histogram: Histogram, labels: str):
+    lines = []
+    for bound, count in histogram.cumulative():
+        le = "+Inf" if bound == float("inf") else "{:g}".format(bound)
+        lines.append('{}_bucket{{{}le="{}"}} {}'.format(
+            name, labels, le, count))
+    labels = "{" + labels.rstrip(",") + "}" if labels else ""
+    lines.append("{}_sum{} {:g}".format(name, labels, histogram.sum))
+    lines.append("{}_count{} {}".format(name, labels, histogram.total))
+    return lines
+
+
+class TestMetrics(unittest.TestCase):
+    def test_histogram(self):
+        histogram = Histogram((1, 2, 5))
+        for value in (0.5, 1, 2, 3, 100):
+            histogram.observe(value)
+        self.assertEqual([1, 2, 5, float("inf")],
+                         [bound for bound, _ in histogram.cumulative()])
+        self.assertEqual([2, 3, 4, 5],
+                         [count for _, count in histogram.cumulative()])
+        self.assertEqual(2, histogram.quantile(0.5))
+        self.assertEqual(float("inf"), histogram.quantile(1))
+        self.assertIsNone(Histogram((1, )).quantile(0.5))
+
+    def test_render(self):
+        metrics = Metrics()
+        metrics.observe_request(common.Operations.ROOM_MSG,
+                                common.Error.NO_ERROR, 0.0002)
+        metrics.observe_request(common.Operations.ROOM_JOIN,
+                                common.Error.ROOM_NOT_FOUND, 0.00001)
+        metrics.observe_fanout(3)
+        metrics.count_failure()
+        text = metrics.render({"users": 4}, {"outbox_sent": 7})
+        self.assertIn("irc_users 4\n", text)
+        self.assertIn("irc_outbox_sent_total 7\n", text)
+        self.assertIn('irc_requests_total{opcode="ROOM_MSG"} 1\n', text)
+        self.assertIn('irc_errors_total{error="ROOM_NOT_FOUND"} 1\n', text)
+        self.assertIn(
+            'irc_handler_seconds_bucket{opcode="ROOM_MSG",le="0.00025"} 1\n',
+            text)
+        self.assertIn('irc_handler_seconds_count{opcode="ROOM_MSG"} 1\n',
+                      text)
+        self.assertIn('irc_fanout_recipients_bucket{le="5"} 1\n', text)
+        self.assertIn("irc_delivery_failures_total 1\n", text)
+
+    def test_summary(self):
+        metrics = Metrics()
+        metrics.observe_request(common.Operations.USER_MSG,
+                                common.Error.USER_NOT_FOUND, 0.003)
+        lines = metrics.summary({"users": 1}, {})
+        self.assertIn("users 1", lines)
+        self.assertIn("requests_USER_MSG 1", lines)
+        self.assertIn("latency_ms_p99_USER_MSG 5", lines)
+        self.assertIn("errors_USER_NOT_FOUND 1", lines)
+        for line in lines:
+            self.assertNotIn(",", line)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,451 @@
+# irc.py - an IRC-like implementation for Portland State University's
+#          CS594 - Internetworking Protocols project
+#
+# Copyright (C) 2017  Jeremiah Peschka <jpeschka@pdx.edu>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+# Durable message log for CS594 project
+#
+# The log is a directory of append-only segments. Each record is the time it
+# was appended (microseconds since the Unix epoch, as a 64-bit big-endian
+# integer) followed by the packet as a binary frame, length prefix included.
+# A segment is named after the append time of its first record, so the
+# segment holding a given time can be found from the file names alone. Next
+# to each segment, a sparse index holds (append time, offset) pairs for
+# every record that starts at least INDEX_INTERVAL bytes after the last one
+# indexed.
+#
+# Running this module prints the packets in a log:
+#
+#     python3 msglog.py <directory> [--since <time>] [--room <room>]
+
+from bisect import bisect_right
+from typing import Iterator, List, Tuple
+import argparse
+import datetime
+import logging
+import mmap
+import os
+import queue
+import struct
+import tempfile
+import threading
+import time
+import unittest
+import unittest.mock
+import common
+
+LOG = logging.getLogger("irc.msglog")
+
+RECORD_TIME = struct.Struct(">q")
+INDEX_ENTRY = struct.Struct(">qQ")
+SEGMENT_SUFFIX = ".log"
+INDEX_SUFFIX = ".idx"
+INDEX_INTERVAL = 64 * 1024
+# Packet timestamps come from clients; when looking for packets sent since
+# a time, start reading this much earlier to allow for their clocks.
+CLOCK_SKEW = datetime.timedelta(minutes=5)
+
+
+def now_micros() -> int:
+    return time.time_ns() // 1000
+
+
+def segment_name(start: int) -> str:
+    return "{:020d}".format(start)
+
+
+def list_segments(directory: str) -> List[Tuple[int, str]]:
+    """Returns (start time, path without suffix) for each segment, oldest
+    first."""
+    segments = []
+    for name in os.listdir(directory):
+        if name.endswith(SEGMENT_SUFFIX):
+            stem = name[:-len(SEGMENT_SUFFIX)]
+            if stem.isdigit():
+                segments.append((int(stem), os.path.join(directory, stem)))
+    segments.sort()
+    return segments
+
+
+def valid_length(data) -> int:
+    """Returns the length of the complete records at the start of `data`."""
+    offset = 0
+    size = len(data)
+    head = RECORD_TIME.size + common.FRAME_LENGTH.size
+    while offset + head <= size:
+        (length, ) = common.FRAME_LENGTH.unpack_from(data,
+                                                     offset + RECORD_TIME.size)
+        end = offset + head + length
+        if length > common.MAX_FRAME or end > size:
+            break
+        offset = end
+    return offset
+
+
+class MessageLog(object):
+    """Appends packets to the log from a background writer.
+
+    append() only puts the packet on a queue, so routing never waits on the
+    disk. The writer takes whatever has queued up within `commit_interval`
+    seconds of the first packet, writes it in one go and syncs once for the
+    whole batch. A segment is closed and a new one started once it reaches
+    `segment_bytes`.
+    """
+
+    def __init__(self,
+                 directory: str,
+                 segment_bytes: int = 64 * 1024 * 1024,
+                 commit_interval: float = 0.005):
+        self.directory = directory
+        self.segment_bytes = segment_bytes
+        self.commit_interval = commit_interval
+        self.packets = queue.SimpleQueue()
+        self.last_time = 0
+        self.written = 0
+        self.syncs = 0
+        os.makedirs(directory, exist_ok=True)
+        self.open_last_segment()
+        self.writer = threading.Thread(target=self.write_forever,
+                                       daemon=True)
+        self.writer.start()
+
+    def append(self, packet: common.IrcPacket):
+        self.packets.put(packet)
+
+    def close(self):
+        """Writes out everything appended so far and stops the writer."""
+        self.packets.put(None)
+        self.writer.join()
+        self.segment.close()
+        self.index.close()
+
+    def open_last_segment(self):
+        segments = list_segments(self.directory)
+        if not segments:
+            self.start_segment()
+            return
+        start, stem = segments[-1]
+        # Drop a record left half-written by a crash.
+        with open(stem + SEGMENT_SUFFIX, "rb") as f:
+            data = f.read()
+        length = valid_length(data)
+        if length < len(data):
+            LOG.warning("Truncating %s from %d to %d bytes",
+                        stem + SEGMENT_SUFFIX, len(data), length)
+        self.segment = open(stem + SEGMENT_SUFFIX, "r+b")
+        self.segment.truncate(length)
+        self.segment.seek(length)
+        self.index = open(stem + INDEX_SUFFIX, "ab")
+        self.size = length
+        self.indexed = length if length else -INDEX_INTERVAL
+        self.last_time = max(start, self.last_time)
+
+    def start_segment(self):
+        start = max(now_micros(), self.last_time)
+        stem = os.path.join(self.directory, segment_name(start))
+        self.segment = open(stem + SEGMENT_SUFFIX, "ab")
+        self.index = open(stem + INDEX_SUFFIX, "ab")
+        self.size = 0
+        self.indexed = -INDEX_INTERVAL
+        self.last_time = start
+
+    def write_forever(self):
+        stopping = False
+        while not stopping:
+            batch = [self.packets.get()]
+            if batch[0] is not None and self.commit_interval > 0:
+                time.sleep(self.commit_interval)
+            while True:
+                try:
+                    batch.append(self.packets.get_nowait())
+                except queue.Empty:
+                    break
+            if None in batch:
+                stopping = True
+                batch = [packet for packet in batch if packet is not None]
+            try:
+                self.write_batch(batch)
+            except OSError as e:
+                LOG.error("Unable to write the message log: %s", e)
+
+    def write_batch(self, batch: List[common.IrcPacket]):
+        records = []
+        entries = []
+        for packet in batch:
+            if self.size >= self.segment_bytes:
+                self.flush(records, entries)
+                records, entries = [], []
+                self.segment.close()
+                self.index.close()
+                self.start_segment()
+            # Append times never go backwards, so the index can be searched.
+            when = self.last_time = max(now_micros(), self.last_time)
+            record = RECORD_TIME.pack(when) + packet.encode_binary()
+            if self.size - self.indexed >= INDEX_INTERVAL:
+                entries.append(INDEX_ENTRY.pack(when, self.size))
+                self.indexed = self.size
+            records.append(record)
+            self.size += len(record)
+        self.flush(records, entries)
+        self.written += len(batch)
+
+    def flush(self, records: List[bytes], entries: List[bytes]):
+        if not records:
+            return
+        self.segment.write(b"".join(records))
+        self.segment.flush()
+        os.fsync(self.segment.fileno())
+        if entries:
+            # The index is only a hint, so it isn't synced.
+            self.index.write(b"".join(entries))
+            self.index.flush()
+        self.syncs += 1
+
+
+class LogReader(object):
+    """Reads a message log through memory-mapped segments.
+
+    Readers share nothing with the writer but the files, so they can run in
+    another thread or process while the log is being written. Records still
+    being written when a segment is mapped are left out.
+    """
+
+    def __init__(self, directory: str):
+        self.directory = directory
+
+    def read(self,
+             since: datetime.datetime = None) -> Iterator[Tuple[int, common.
+                                                                 IrcPacket]]:
+        """Yields (append time, packet) for every record appended at or
+        after `since`, or for every record, oldest first."""
+        after = 0 if since is None else common.micros_since_epoch(since)
+        segments = list_segments(self.directory)
+        starts = [start for start, _ in segments]
+        first = max(0, bisect_right(starts, after) - 1)
+        for _, stem in segments[first:]:
+            yield from self.read_segment(stem, after)
+
+    def read_segment(self, stem: str, after: int, opcode: int = None):
+        """Yields (append time, packet) for the records in one segment
+        appended at or after `after`, and only those with the given opcode
+        if one is given; other records are skipped without decoding."""
+        with open(stem + SEGMENT_SUFFIX, "rb") as f:
+            size = os.fstat(f.fileno()).st_size
+            if size == 0:
+                return
+            data = mmap.mmap(f.fileno(), size, access=mmap.ACCESS_READ)
+        try:
+            offset = self.seek(stem, after)
+            head = RECORD_TIME.size + common.FRAME_LENGTH.size
+            while offset + head <= size:
+                (when, ) = RECORD_TIME.unpack_from(data, offset)
+                (length, ) = common.FRAME_LENGTH.unpack_from(
+                    data, offset + RECORD_TIME.size)
+                end = offset + head + length
+                if end > size:
+                    break
+                if when >= after and (opcode is None
+                                      or data[offset + head] == opcode):
+                    try:
+                        yield when, common.decode_binary(data[offset +
+                                                              head:end])
+                    except TypeError as e:
+                        LOG.warning("Bad record in %s at %d: %s", stem,
+                                    offset, e)
+                offset = end
+        finally:
+            data.close()
+
+    def seek(self, stem: str, after: int) -> int:
+        """Returns the offset of the last indexed record appended before
+        `after`, or 0."""
+        try:
+            with open(stem + INDEX_SUFFIX, "rb") as f:
+                raw = f.read()
+        except FileNotFoundError:
+            return 0
+        entries = [
+            INDEX_ENTRY.unpack_from(raw, i)
+            for i in range(0, len(raw) - INDEX_ENTRY.size + 1,
+                           INDEX_ENTRY.size)
+        ]
+        position = bisect_right([when for when, _ in entries], after) - 1
+        return entries[position][1] if position >= 0 else 0
+
+    def room_messages(self, room: str, since: datetime.datetime,
+                      before: int = None,
+                      limit: int = None) -> List[common.MessageRoom]:
+        """Returns the messages sent to `room` with timestamps at or after
+        `since`, and before `before` microseconds since the epoch if given,
+        oldest first.
+
+        With a limit, only the newest `limit` of them are returned: segments
+        are read newest first, and older ones are left alone once that many
+        messages have been found.
+        """
+        after = common.micros_since_epoch(since)
+        skew = CLOCK_SKEW // common.ONE_MICROSECOND
+        # Nothing was appended before the epoch, so a `since` from long ago
+        # reads the whole log rather than running off the end of datetime.
+        earliest = max(0, after - skew)
+        segments = list_segments(self.directory)
+        starts = [start for start, _ in segments]
+        first = max(0, bisect_right(starts, earliest) - 1)
+        last = len(segments) if before is None else bisect_right(
+            starts, before + skew)
+        opcode = common.Operations.ROOM_MSG.value
+        batches = []
+        found = 0
+        for _, stem in reversed(segments[first:last]):
+            batch = []
+            for _, packet in self.read_segment(stem, earliest, opcode):
+                when = common.micros_since_epoch(packet.timestamp)
+                if packet.room == room and when >= after and (
+                        before is None or when < before):
+                    batch.append(packet)
+            batches.append(batch)
+            found += len(batch)
+            if limit is not None and found >= limit:
+                break
+        messages = [packet for batch in reversed(batches) for packet in batch]
+        return messages if limit is None else messages[-limit:]
+
+
+class TestMessageLog(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def test_round_trip(self):
+        log = MessageLog(self.dir.name, commit_interval=0)
+        packets = [
+            common.MessageRoom("room", "hello", "alice"),
+            common.PrivateMessage("alice", "bob", "hi"),
+            common.Broadcast("everyone", "carol"),
+        ]
+        for packet in packets:
+            log.append(packet)
+        log.close()
+        self.assertEqual(
+            packets, [p for _, p in LogReader(self.dir.name).read()])
+
+    def test_group_commit(self):
+        log = MessageLog(self.dir.name, commit_interval=0.05)
+        for i in range(100):
+            log.append(common.Broadcast(str(i), "alice"))
+        log.close()
+        self.assertEqual(100, log.written)
+        self.assertLess(log.syncs, 10)
+
+    def test_rotation_and_index(self):
+        log = MessageLog(self.dir.name, segment_bytes=16 * 1024,
+                         commit_interval=0)
+        text = "x" * 1000
+        for i in range(200):
+            log.append(common.MessageRoom("room", text + str(i), "alice"))
+        log.close()
+        segments = list_segments(self.dir.name)
+        self.assertGreater(len(segments), 5)
+        reader = LogReader(self.dir.name)
+        records = list(reader.read())
+        self.assertEqual(200, len(records))
+        times = [when for when, _ in records]
+        self.assertEqual(sorted(times), times)
+        middle = common.EPOCH + datetime.timedelta(microseconds=times[150])
+        later = list(reader.read(middle))
+        self.assertEqual(records[150:], later[-50:])
+        self.assertEqual(times[150], later[0][0])
+
+    def test_torn_tail_is_dropped(self):
+        log = MessageLog(self.dir.name, commit_interval=0)
+        log.append(common.Broadcast("first", "alice"))
+        log.close()
+        _, stem = list_segments(self.dir.name)[-1]
+        with open(stem + SEGMENT_SUFFIX, "ab") as f:
+            f.write(b"\x00\x00\x00")
+        log = MessageLog(self.dir.name, commit_interval=0)
+        log.append(common.Broadcast("second", "alice"))
+        log.close()
+        self.assertEqual(["first", "second"], [
+            p.message for _, p in LogReader(self.dir.name).read()
+        ])
+
+    def test_room_messages(self):
+        log = MessageLog(self.dir.name, commit_interval=0)
+        old = datetime.datetime(2017, 10, 3, 22, 0)
+        new = datetime.datetime.utcnow()
+        log.append(common.MessageRoom("room", "old", "alice", old))
+        log.append(common.MessageRoom("other", "elsewhere", "alice", new))
+        log.append(common.MessageRoom("room", "new", "alice", new))
+        log.close()
+        messages = LogReader(self.dir.name).room_messages(
+            "room", new - datetime.timedelta(seconds=1))
+        self.assertEqual(["new"], [p.message for p in messages])
+
+    def test_room_messages_since_long_ago(self):
+        log = MessageLog(self.dir.name, commit_interval=0)
+        sent = datetime.datetime(2017, 10, 3, 22, 0)
+        for i in range(3):
+            log.append(common.MessageRoom("room", str(i), "alice", sent))
+        log.close()
+        reader = LogReader(self.dir.name)
+        for since in (common.EPOCH, datetime.datetime.min):
+            self.assertEqual(["0", "1", "2"], [
+                p.message for p in reader.room_messages("room", since)
+            ])
+
+    def test_room_messages_limit_reads_newest_segments(self):
+        log = MessageLog(self.dir.name, segment_bytes=4 * 1024,
+                         commit_interval=0)
+        text = "x" * 1000
+        for i in range(40):
+            log.append(common.MessageRoom("room", text + str(i), "alice"))
+        log.close()
+        segments = list_segments(self.dir.name)
+        self.assertGreater(len(segments), 5)
+        reader = LogReader(self.dir.name)
+        with unittest.mock.patch.object(
+                reader, "read_segment", wraps=reader.read_segment) as read:
+            messages = reader.room_messages("room", common.EPOCH, limit=3)
+        self.assertEqual([text + str(i) for i in range(37, 40)],
+                         [p.message for p in messages])
+        self.assertLess(read.call_count, len(segments))
+        self.assertEqual(segments[-1][1], read.call_args_list[0][0][0])
+        before = common.micros_since_epoch(messages[0].timestamp)
+        self.assertEqual([text + str(i) for i in range(34, 37)], [
+            p.message
+            for p in reader.room_messages("room", common.EPOCH, before, 3)
+        ])
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Print a CS594 message log")
+    parser.add_argument("directory")
+    parser.add_argument("--since",
+                        type=common.parse_timestamp,
+                        help="only records appended at or after this UTC time")
+    parser.add_argument("--room", help="only messages to this room")
+    args = parser.parse_args()
+    for when, packet in LogReader(args.directory).read(args.since):
+        if args.room is not None and getattr(packet, "room",
+                                             None) != args.room:
+            continue
+        appended = common.EPOCH + datetime.timedelta(microseconds=when)
+        print(appended.isoformat(), packet.opcode, packet.username,
+              getattr(packet, "room", getattr(packet, "to", "*")),
+              packet.message)
@@ -0,0 +1,370 @@
+# irc.py - an IRC-like implementation for Portland State University's
+#          CS594 - Internetworking Protocols project
+#
+# Copyright (C) 2017  Jeremiah Peschka <jpeschka@pdx.edu>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+# Per-user outbound message queues for CS594 project
+
+from collections import deque
+from typing import Callable, Iterable
+import asyncio
+import queue
+import threading
+import unittest
+
+# What to do when a user's queue is full
+DROP_OLDEST = "drop-oldest"
+DISCONNECT = "disconnect"
+BACKPRESSURE = "backpressure"
+POLICIES = [DROP_OLDEST, DISCONNECT, BACKPRESSURE]
+
+
+class Stats(object):
+    """Delivery counters for all outboxes, including closed ones."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.queued = 0
+        self.sent = 0
+        self.dropped = 0
+        self.disconnected = 0
+        self.failed = 0
+
+    def retire(self, outbox: "Outbox"):
+        with self.lock:
+            self.queued += outbox.queued
+            self.sent += outbox.sent
+            self.dropped += outbox.dropped
+
+    def count_disconnect(self):
+        with self.lock:
+            self.disconnected += 1
+
+    def count_failure(self):
+        with self.lock:
+            self.failed += 1
+
+    def snapshot(self, outboxes: Iterable["Outbox"]):
+        """Returns the totals so far and the current queue depths."""
+        with self.lock:
+            totals = {
+                "queued": self.queued,
+                "sent": self.sent,
+                "dropped": self.dropped,
+                "disconnected": self.disconnected,
+                "failed": self.failed,
+            }
+        depths = []
+        for outbox in outboxes:
+            totals["queued"] += outbox.queued
+            totals["sent"] += outbox.sent
+            totals["dropped"] += outbox.dropped
+            depths.append(len(outbox.frames))
+        totals["outboxes"] = len(depths)
+        totals["depth"] = sum(depths)
+        totals["max_depth"] = max(depths, default=0)
+        return totals
+
+
+class Outbox(object):
+    """A bounded queue of encoded frames waiting to be sent to one user.
+
+    send() only appends to the queue; a WriterPool thread does the actual
+    sending, so a slow or dead client never holds up whoever is fanning a
+    message out. When the queue is full, `policy` decides whether the
+    oldest frame is dropped, the user is disconnected, or send() waits for
+    room.
+    """
+
+    def __init__(self,
+                 session,
+                 pool: "WriterPool",
+                 limit: int,
+                 policy: str,
+                 on_close: Callable[[], None],
+                 stats: Stats,
+                 timeout: float = 5.0):
+        self.session = session
+        self.pool = pool
+        self.limit = limit
+        self.policy = policy
+        self.on_close = on_close
+        self.stats = stats
+        self.timeout = timeout
+        self.frames = deque()
+        self.lock = threading.Lock()
+        self.space = threading.Condition(self.lock)
+        self.scheduled = False
+        self.closed = False
+        self.queued = 0
+        self.sent = 0
+        self.dropped = 0
+
+    def send(self, data: bytes):
+        overflowed = False
+        with self.lock:
+            full = len(self.frames) >= self.limit
+            if full and not self.closed and not self._make_room():
+                self.stats.count_disconnect()
+                self._close()
+                overflowed = True
+            if not self.closed:
+                self.frames.append(data)
+                self.queued += 1
+                if not self.scheduled:
+                    self.scheduled = True
+                    self.pool.schedule(self)
+        if overflowed:
+            self.on_close()
+
+    def _make_room(self):
+        """Applies the slow consumer policy to a full queue. Returns False
+        if the user should be disconnected instead."""
+        if self.policy == DROP_OLDEST:
+            self.frames.popleft()
+            self.dropped += 1
+            return True
+        elif self.policy == BACKPRESSURE:
+            return self.space.wait_for(
+                lambda: len(self.frames) < self.limit or self.closed,
+                self.timeout)
+        return False
+
+    def drain(self):
+        """Sends everything queued so far. Called from a writer thread."""
+        with self.lock:
+            frames = self.frames
+            self.frames = deque()
+            self.space.notify_all()
+
+        try:
+            for data in frames:
+                self.session.send(data)
+                self.sent += 1
+        except OSError:
+            self.stats.count_failure()
+            self.close()
+            self.on_close()
+            return
+
+        with self.lock:
+            if self.frames and not self.closed:
+                self.pool.schedule(self)
+            else:
+                self.scheduled = False
+
+    def close(self):
+        with self.lock:
+            self._close()
+
+    def _close(self):
+        if not self.closed:
+            self.closed = True
+            self.frames.clear()
+            self.space.notify_all()
+            self.stats.retire(self)
+
+
+class WriterPool(object):
+    """Threads that send queued frames for whichever outboxes have any."""
+
+    def __init__(self, workers: int):
+        self.ready = queue.Queue()
+        for _ in range(workers):
+            t = threading.Thread(target=self.run)
+            t.daemon = True
+            t.start()
+
+    def schedule(self, outbox: Outbox):
+        self.ready.put(outbox)
+
+    def run(self):
+        while True:
+            self.ready.get().drain()
+            self.ready.task_done()
+
+    def join(self, timeout: float = None):
+        """Waits until every scheduled outbox has been drained."""
+        with self.ready.all_tasks_done:
+            return self.ready.all_tasks_done.wait_for(
+                lambda: not self.ready.unfinished_tasks, timeout)
+
+
+class AsyncOutbox(object):
+    """An Outbox for the asyncio engine, drained by its own task.
+
+    Handlers can't block the event loop, so under the backpressure policy
+    send() lets the queue run over its limit and records the outbox in
+    `pressured`. The connection that produced the messages then awaits
+    relieve() before reading its next request.
+    """
+
+    pressured = set()
+
+    def __init__(self,
+                 session,
+                 limit: int,
+                 policy: str,
+                 on_close: Callable[[], None],
+                 stats: Stats,
+                 timeout: float = 5.0):
+        self.session = session
+        self.limit = limit
+        self.policy = policy
+        self.on_close = on_close
+        self.stats = stats
+        self.timeout = timeout
+        self.frames = deque()
+        self.ready = asyncio.Event()
+        self.space = asyncio.Event()
+        self.space.set()
+        self.closed = False
+        self.queued = 0
+        self.sent = 0
+        self.dropped = 0
+        self.task = asyncio.ensure_future(self.run())
+
+    def send(self, data: bytes):
+        if self.closed:
+            return
+        if len(self.frames) >= self.limit:
+            if self.policy == DROP_OLDEST:
+                self.frames.popleft()
+                self.dropped += 1
+            elif self.policy == BACKPRESSURE:
+                self.space.clear()
+                AsyncOutbox.pressured.add(self)
+            else:
+                self.stats.count_disconnect()
+                self.close()
+                self.on_close()
+                return
+        self.frames.append(data)
+        self.queued += 1
+        self.ready.set()
+
+    async def run(self):
+        try:
+            while not self.closed:
+                await self.ready.wait()
+                self.ready.clear()
+                while self.frames:
+                    self.session.send(self.frames.popleft())
+                    self.sent += 1
+                # Frames keep queueing here while the socket drains.
+                await self.session.flush()
+                if len(self.frames) < self.limit:
+                    self.space.set()
+        except OSError:
+            self.stats.count_failure()
+            self.close()
+            self.on_close()
+
+    def close(self):
+        if not self.closed:
+            self.closed = True
+            self.frames.clear()
+            self.space.set()
+            self.ready.set()
+            self.stats.retire(self)
+
+    @staticmethod
+    async def relieve():
+        """Waits until every outbox pushed over its limit has room again,
+        disconnecting any that don't drain within their timeout."""
+        while AsyncOutbox.pressured:
+            outbox = AsyncOutbox.pressured.pop()
+            try:
+                await asyncio.wait_for(outbox.space.wait(), outbox.timeout)
+            except asyncio.TimeoutError:
+                outbox.stats.count_disconnect()
+                outbox.close()
+                outbox.on_close()
+
+
+class RecordingSession(object):
+    def __init__(self, delay: threading.Event = None):
+        self.frames = []
+        self.delay = delay
+
+    def send(self, data: bytes):
+        if self.delay is not None:
+            self.delay.wait()
+        self.frames.append(data)
+
+
+class TestOutbox(unittest.TestCase):
+    def setUp(self):
+        self.pool = WriterPool(1)
+        self.stats = Stats()
+        self.closed = []
+
+    def make(self, session, policy, limit=2):
+        return Outbox(session, self.pool, limit, policy,
+                      lambda: self.closed.append(session), self.stats, 0.1)
+
+    def test_delivers_in_order(self):
+        session = RecordingSession()
+        outbox = self.make(session, DROP_OLDEST, 100)
+        for i in range(50):
+            outbox.send(str(i).encode())
+        self.pool.join()
+        self.assertEqual([str(i).encode() for i in range(50)],
+                         session.frames)
+        self.assertEqual(50, self.stats.snapshot([outbox])["sent"])
+
+    def test_drop_oldest(self):
+        gate = threading.Event()
+        session = RecordingSession(gate)
+        outbox = self.make(session, DROP_OLDEST)
+        outbox.send(b"in flight")
+        # Wait for the writer to pick up the first frame, then fill up.
+        while outbox.frames:
+            pass
+        for data in (b"1", b"2", b"3"):
+            outbox.send(data)
+        gate.set()
+        self.pool.join()
+        self.assertEqual([b"in flight", b"2", b"3"], session.frames)
+        self.assertEqual(1, self.stats.snapshot([outbox])["dropped"])
+
+    def test_disconnect(self):
+        gate = threading.Event()
+        session = RecordingSession(gate)
+        outbox = self.make(session, DISCONNECT)
+        for data in (b"1", b"2", b"3", b"4"):
+            outbox.send(data)
+        gate.set()
+        self.pool.join()
+        self.assertEqual([session], self.closed)
+        self.assertTrue(outbox.closed)
+
+    def test_backpressure_times_out(self):
+        gate = threading.Event()
+        session = RecordingSession(gate)
+        outbox = self.make(session, BACKPRESSURE, 1)
+        outbox.send(b"in flight")
+        while outbox.frames:
+            pass
+        outbox.send(b"queued")
+        outbox.send(b"blocked")
+        gate.set()
+        self.pool.join()
+        self.assertEqual([session], self.closed)
+
+
+if __name__ == '__main__':
+    unittest.main()
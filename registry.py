@@ -0,0 +1,403 @@
+# irc.py - an IRC-like implementation for Portland State University's
+#          CS594 - Internetworking Protocols project
+#
+# Copyright (C) 2017  Jeremiah Peschka <jpeschka@pdx.edu>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+# User and room registry for CS594 project
+
+from bisect import bisect_left, bisect_right
+from collections import deque
+from itertools import takewhile
+from typing import Dict, Iterable, List, Set, Tuple
+import heapq
+import threading
+import unittest
+
+
+class SortedNames(object):
+    """A set of names kept in sorted order.
+
+    A page of names after a cursor is a binary search and a slice, so it
+    costs the size of the page rather than of the whole set. Adding and
+    removing names shifts the list along, which is a memmove.
+    """
+
+    def __init__(self, names: Iterable[str] = ()):
+        self.names: List[str] = sorted(set(names))
+
+    def add(self, name: str) -> bool:
+        names = self.names
+        i = bisect_left(names, name)
+        if i < len(names) and names[i] == name:
+            return False
+        names.insert(i, name)
+        return True
+
+    def discard(self, name: str) -> bool:
+        names = self.names
+        i = bisect_left(names, name)
+        if i < len(names) and names[i] == name:
+            del names[i]
+            return True
+        return False
+
+    def __contains__(self, name: str):
+        names = self.names
+        i = bisect_left(names, name)
+        return i < len(names) and names[i] == name
+
+    def __iter__(self):
+        return iter(self.names)
+
+    def __len__(self):
+        return len(self.names)
+
+    def page(self, after: str = "", limit: int = 0,
+             prefix: str = "") -> Tuple[List[str], bool]:
+        """Returns up to `limit` names that sort after `after` and start
+        with `prefix`, and whether there are more. A limit of 0 returns all
+        of them."""
+        names = self.names
+        start = bisect_left(names, prefix)
+        if after:
+            start = max(start, bisect_right(names, after))
+        end = len(names) if limit <= 0 else min(len(names), start + limit)
+        page = list(
+            takewhile(lambda name: name.startswith(prefix),
+                      names[start:end]))
+        more = (len(page) == end - start and end < len(names)
+                and names[end].startswith(prefix))
+        return page, more
+
+
+def merge_pages(pages: Iterable[Tuple[List[str], bool]],
+                limit: int = 0) -> Tuple[List[str], bool]:
+    """Combines pages of distinct names taken from several SortedNames
+    with the same cursor and prefix into one page of up to `limit` names."""
+    more = False
+    lists = []
+    for names, rest in pages:
+        lists.append(names)
+        more = more or rest
+    merged = list(heapq.merge(*lists))
+    if limit > 0 and len(merged) > limit:
+        merged = merged[:limit]
+        more = True
+    return merged, more
+
+
+class User(object):
+    def __init__(self, nick: str, host: str, port: int, session=None):
+        self.nick = nick
+        self.host = host[0]
+        self.port = port
+        self.session = session
+        # Queue of frames waiting to be sent, when the server uses one
+        self.outbox = None
+        # Set when the user asked to be told who joins and leaves their rooms
+        self.presence = False
+
+
+class Room(object):
+    def __init__(self, name):
+        # Members are keyed by nick; dicts keep join order for listings.
+        self.users: Dict[str, User] = dict()
+        self.name = name
+        # Snapshot of the members used for message delivery. Rebuilt on the
+        # first message after a join or leave rather than on every message.
+        self._recipients: Tuple[User, ...] = None
+        # Recent messages, oldest first; kept by history.History
+        self.history = deque()
+        # Member nicks in sorted order, for paged listings
+        self.index = SortedNames()
+
+    def add_to_room(self, user: User):
+        self.users[user.nick] = user
+        self.index.add(user.nick)
+        self._recipients = None
+
+    def remove_user(self, nick: str) -> bool:
+        """Returns False if the user wasn't in the room."""
+        if self.users.pop(nick, None) is None:
+            return False
+        self.index.discard(nick)
+        self._recipients = None
+        return True
+
+    def recipients(self) -> Tuple[User, ...]:
+        recipients = self._recipients
+        if recipients is None:
+            recipients = self._recipients = tuple(self.users.values())
+        return recipients
+
+    def contains_user(self, nick: str):
+        return nick in self.users
+
+    def __str__(self):
+        return self.name
+
+
+class Registry(object):
+    """Indexes connected users and rooms by name.
+
+    Alongside the nick -> User and name -> Room maps, the registry keeps a
+    nick -> room names index so a departing user is removed from only the
+    rooms they joined, and sorted indexes of nicks and room names for paged
+    listings. All methods are safe to call from handler threads.
+    """
+
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.users: Dict[str, User] = dict()
+        self.rooms: Dict[str, Room] = dict()
+        self.memberships: Dict[str, Set[str]] = dict()
+        self.user_index = SortedNames()
+        self.room_index = SortedNames()
+
+    def add_user(self, user: User, limit: int = 0):
+        """Adds a user unless their nick is taken, which returns False, or
+        `limit` users are already here, which returns None."""
+        with self.lock:
+            if user.nick in self.users:
+                return False
+            if limit and len(self.users) >= limit:
+                return None
+            self.users[user.nick] = user
+            self.memberships[user.nick] = set()
+            self.user_index.add(user.nick)
+            return True
+
+    def remove_user(self, nick: str, session=None):
+        """Removes a user from the server and from every room they joined.
+
+        If session is given, the user is only removed while they are still
+        reachable through it, so a stale connection can't evict a user who
+        has since reconnected under the same nick.
+        """
+        with self.lock:
+            user = self.users.get(nick)
+            if user is None or (session is not None
+                                and user.session is not session):
+                return None
+            del self.users[nick]
+            self.user_index.discard(nick)
+            for name in self.memberships.pop(nick, ()):
+                self.rooms[name].remove_user(nick)
+            return user
+
+    def remove_users(self, users: Iterable[User]
+                     ) -> List[Tuple[User, List[str]]]:
+        """Removes several users, and them from their rooms, under one hold
+        of the lock. A user is skipped if their nick now belongs to someone
+        else. Returns each user removed with the rooms they were in."""
+        removed = []
+        with self.lock:
+            for user in users:
+                if self.users.get(user.nick) is not user:
+                    continue
+                del self.users[user.nick]
+                self.user_index.discard(user.nick)
+                rooms = list(self.memberships.pop(user.nick, ()))
+                for name in rooms:
+                    self.rooms[name].remove_user(user.nick)
+                removed.append((user, rooms))
+        return removed
+
+    def find_user(self, nick: str):
+        return self.users.get(nick)
+
+    def user_names(self):
+        with self.lock:
+            return list(self.users)
+
+    def user_list(self):
+        with self.lock:
+            return list(self.users.values())
+
+    def user_page(self, after: str, limit: int, prefix: str):
+        with self.lock:
+            return self.user_index.page(after, limit, prefix)
+
+    def add_room(self, room: Room, limit: int = 0):
+        """Adds a room unless the name is taken, which returns False, or
+        `limit` rooms already exist, which returns None."""
+        with self.lock:
+            if room.name in self.rooms:
+                return False
+            if limit and len(self.rooms) >= limit:
+                return None
+            self.rooms[room.name] = room
+            self.room_index.add(room.name)
+            return True
+
+    def find_room(self, name: str):
+        return self.rooms.get(name)
+
+    def room_names(self):
+        with self.lock:
+            return list(self.rooms)
+
+    def room_page(self, after: str, limit: int, prefix: str):
+        with self.lock:
+            return self.room_index.page(after, limit, prefix)
+
+    def member_page(self, name: str, after: str, limit: int, prefix: str):
+        """Returns a page of a room's member nicks, or None if the room
+        doesn't exist."""
+        with self.lock:
+            room = self.rooms.get(name)
+            if room is None:
+                return None
+            return room.index.page(after, limit, prefix)
+
+    def join(self, nick: str, name: str):
+        """Adds a user to a room. Returns the room, or None if the room or
+        user doesn't exist."""
+        with self.lock:
+            room = self.rooms.get(name)
+            user = self.users.get(nick)
+            if room is None or user is None:
+                return None
+            room.add_to_room(user)
+            self.memberships[nick].add(name)
+            return room
+
+    def leave(self, nick: str, name: str) -> bool:
+        """Removes a user from a room. Returns False if they weren't in it,
+        or None if the room doesn't exist."""
+        with self.lock:
+            room = self.rooms.get(name)
+            if room is None:
+                return None
+            self.memberships.get(nick, set()).discard(name)
+            return room.remove_user(nick)
+
+    def members(self, name: str) -> Tuple[User, ...]:
+        room = self.rooms.get(name)
+        if room is None:
+            return None
+        recipients = room._recipients
+        if recipients is None:
+            with self.lock:
+                recipients = room.recipients()
+        return recipients
+
+
+class TestRegistry(unittest.TestCase):
+    def setUp(self):
+        self.registry = Registry()
+        for nick in ("alice", "bob"):
+            self.registry.add_user(User(nick, ("127.0.0.1", 0), 0))
+        for name in ("first", "second"):
+            self.registry.add_room(Room(name))
+
+    def test_duplicate_user(self):
+        self.assertFalse(
+            self.registry.add_user(User("alice", ("127.0.0.1", 0), 0)))
+
+    def test_limits(self):
+        carol = User("carol", ("127.0.0.1", 0), 0)
+        self.assertIsNone(self.registry.add_user(carol, 2))
+        self.assertFalse(
+            self.registry.add_user(User("alice", ("127.0.0.1", 0), 0), 2))
+        self.assertTrue(self.registry.add_user(carol, 3))
+        self.assertIsNone(self.registry.add_room(Room("third"), 2))
+        self.assertFalse(self.registry.add_room(Room("first"), 2))
+        self.assertTrue(self.registry.add_room(Room("third"), 3))
+        self.assertIsNone(self.registry.find_user("dave"))
+
+    def test_join_unknown(self):
+        self.assertIsNone(self.registry.join("alice", "third"))
+        self.assertIsNone(self.registry.join("carol", "first"))
+
+    def test_remove_user_leaves_rooms(self):
+        self.registry.join("alice", "first")
+        self.registry.join("alice", "second")
+        self.registry.join("bob", "first")
+        self.registry.remove_user("alice")
+        self.assertEqual(["bob"], self.registry.user_names())
+        self.assertEqual(["bob"], list(self.registry.rooms["first"].users))
+        self.assertEqual([], list(self.registry.rooms["second"].users))
+
+    def test_remove_user_stale_session(self):
+        self.registry.users["alice"].session = object()
+        self.assertIsNone(self.registry.remove_user("alice", object()))
+        self.assertIn("alice", self.registry.users)
+
+    def test_remove_users(self):
+        alice = self.registry.users["alice"]
+        stale = User("bob", ("127.0.0.1", 0), 0)
+        self.registry.join("alice", "first")
+        self.registry.join("bob", "first")
+        removed = self.registry.remove_users([alice, stale])
+        self.assertEqual([(alice, ["first"])], removed)
+        self.assertEqual(["bob"], self.registry.user_names())
+        self.assertEqual(["bob"],
+                         [user.nick for user in self.registry.members("first")])
+
+    def test_members_cache(self):
+        self.registry.join("alice", "first")
+        first = self.registry.members("first")
+        self.assertIs(first, self.registry.members("first"))
+        self.registry.join("bob", "first")
+        self.assertEqual(["alice", "bob"],
+                         [user.nick for user in self.registry.members("first")])
+        self.registry.remove_user("alice")
+        self.assertEqual(["bob"],
+                         [user.nick for user in self.registry.members("first")])
+
+    def test_pages(self):
+        for nick in ("carol", "dave", "dan", "dora"):
+            self.registry.add_user(User(nick, ("127.0.0.1", 0), 0))
+        self.assertEqual((["alice", "bob"], True),
+                         self.registry.user_page("", 2, ""))
+        self.assertEqual((["carol", "dan"], True),
+                         self.registry.user_page("bob", 2, ""))
+        self.assertEqual((["dan", "dave"], True),
+                         self.registry.user_page("", 2, "d"))
+        self.assertEqual((["dora"], False),
+                         self.registry.user_page("dave", 2, "d"))
+        self.assertEqual((["dan", "dave", "dora"], False),
+                         self.registry.user_page("", 3, "d"))
+        self.assertEqual(([], False), self.registry.user_page("", 2, "z"))
+        self.registry.remove_user("dan")
+        self.assertEqual((["dave", "dora"], False),
+                         self.registry.user_page("", 0, "d"))
+        self.registry.join("bob", "first")
+        self.registry.join("alice", "first")
+        self.assertEqual((["alice"], True),
+                         self.registry.member_page("first", "", 1, ""))
+        self.assertIsNone(self.registry.member_page("third", "", 1, ""))
+
+    def test_merge_pages(self):
+        first = SortedNames(["a", "c", "e"])
+        second = SortedNames(["b", "d"])
+        pages = [first.page("", 3), second.page("", 3)]
+        self.assertEqual((["a", "b", "c"], True), merge_pages(pages, 3))
+        pages = [first.page("c", 3), second.page("c", 3)]
+        self.assertEqual((["d", "e"], False), merge_pages(pages, 3))
+
+    def test_leave(self):
+        self.registry.join("alice", "first")
+        self.assertTrue(self.registry.leave("alice", "first"))
+        self.assertEqual((), self.registry.members("first"))
+        self.assertEqual(set(), self.registry.memberships["alice"])
+        self.assertFalse(self.registry.leave("alice", "first"))
+        self.assertIsNone(self.registry.leave("alice", "third"))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,169 @@
+# irc.py - an IRC-like implementation for Portland State University's
+#          CS594 - Internetworking Protocols project
+#
+# Copyright (C) 2017  Jeremiah Peschka <jpeschka@pdx.edu>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+# Terminal output for the CS594 project client
+
+from datetime import datetime
+from dateutil import tz
+from typing import Dict, List, Tuple
+import io
+import sys
+import threading
+import time
+import unittest
+
+TIME_FORMAT = "%Y-%m-%d %H:%M"
+# Minutes of formatted times kept before the cache starts over
+TIME_CACHE_LIMIT = 4096
+# In firehose mode, the least time between writes to the terminal and the
+# most lines shown in one; older lines in a bigger batch are skipped
+FIREHOSE_INTERVAL = 0.1
+FIREHOSE_LINES = 200
+
+
+class TimeFormatter(object):
+    """Formats UTC timestamps as local times to the minute.
+
+    Converting to the local zone and calling strftime costs tens of
+    microseconds, and every line shown carries a time. All messages in the
+    same minute share a prefix, so each minute is formatted once and looked
+    up by its fields after that.
+    """
+
+    def __init__(self, to_zone=None, fmt: str = TIME_FORMAT):
+        self.from_zone = tz.tzutc()
+        self.to_zone = to_zone if to_zone is not None else tz.tzlocal()
+        self.fmt = fmt
+        self.cache: Dict[Tuple[int, int, int, int, int], str] = dict()
+
+    def format(self, utc: datetime) -> str:
+        key = (utc.year, utc.month, utc.day, utc.hour, utc.minute)
+        text = self.cache.get(key)
+        if text is None:
+            if len(self.cache) >= TIME_CACHE_LIMIT:
+                self.cache.clear()
+            local = utc.replace(tzinfo=self.from_zone).astimezone(self.to_zone)
+            text = self.cache[key] = local.strftime(self.fmt)
+        return text
+
+
+class Renderer(object):
+    """Writes lines to the terminal from a thread of its own.
+
+    Callers only append to a list. The writer takes everything queued so
+    far and writes it with one call and one flush, so a burst of messages
+    costs a system call per batch rather than per line.
+
+    In firehose mode the writer also waits `interval` between batches, and
+    shows only the last `keep` lines of a batch with a count of those
+    skipped, so thousands of lines a second don't bury the terminal.
+    """
+
+    def __init__(self, stream=None, firehose: bool = False,
+                 interval: float = FIREHOSE_INTERVAL,
+                 keep: int = FIREHOSE_LINES):
+        self.stream = stream if stream is not None else sys.stdout
+        self.firehose = firehose
+        self.interval = interval
+        self.keep = keep
+        self.condition = threading.Condition()
+        self.lines: List[str] = []
+        # Lines queued and lines written so far, for flush()
+        self.queued = 0
+        self.written = 0
+        self.skipped = 0
+        writer = threading.Thread(target=self.run)
+        writer.daemon = True
+        writer.start()
+
+    def write(self, line: str):
+        with self.condition:
+            self.lines.append(line)
+            self.queued += 1
+            if len(self.lines) == 1:
+                self.condition.notify_all()
+
+    def flush(self, timeout: float = 1.0):
+        """Waits until every line written so far is out."""
+        deadline = time.monotonic() + timeout
+        with self.condition:
+            target = self.queued
+            while self.written < target:
+                left = deadline - time.monotonic()
+                if left <= 0:
+                    return
+                self.condition.wait(left)
+
+    def run(self):
+        while True:
+            with self.condition:
+                while not self.lines:
+                    self.condition.wait()
+                lines, self.lines = self.lines, []
+            self.emit(lines)
+            with self.condition:
+                self.written += len(lines)
+                self.condition.notify_all()
+            if self.firehose:
+                time.sleep(self.interval)
+
+    def emit(self, lines: List[str]):
+        if self.firehose and len(lines) > self.keep:
+            skipped = len(lines) - self.keep
+            self.skipped += skipped
+            lines = lines[-self.keep:]
+            lines.insert(0, "... " + str(skipped) + " lines skipped")
+        try:
+            self.stream.write("\n".join(lines) + "\n")
+            self.stream.flush()
+        except (OSError, ValueError):
+            # The terminal went away; there is nobody left to show it to.
+            pass
+
+
+class TestRender(unittest.TestCase):
+    def test_time_formatter(self):
+        formatter = TimeFormatter(tz.gettz("America/Los_Angeles"))
+        utc = datetime(2017, 10, 3, 22, 5, 30)
+        self.assertEqual("2017-10-03 15:05", formatter.format(utc))
+        self.assertEqual("2017-10-03 15:05",
+                         formatter.format(utc.replace(second=59)))
+        self.assertEqual("2017-10-03 15:06",
+                         formatter.format(utc.replace(minute=6)))
+        self.assertEqual(2, len(formatter.cache))
+
+    def test_renderer_keeps_order(self):
+        stream = io.StringIO()
+        renderer = Renderer(stream)
+        for i in range(1000):
+            renderer.write(str(i))
+        renderer.flush()
+        self.assertEqual([str(i) for i in range(1000)],
+                         stream.getvalue().splitlines())
+
+    def test_firehose_skips_old_lines(self):
+        stream = io.StringIO()
+        renderer = Renderer(stream, firehose=True, interval=0.0, keep=3)
+        renderer.emit([str(i) for i in range(10)])
+        self.assertEqual(["... 7 lines skipped", "7", "8", "9"],
+                         stream.getvalue().splitlines())
+        self.assertEqual(7, renderer.skipped)
+
+
+if __name__ == '__main__':
+    unittest.main()
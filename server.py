@@ -18,100 +18,481 @@
 
 # Server for CS594 project
 
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 from typing import List
+import argparse
+import asyncio
+import logging
+import logging.handlers
+import os
+import queue
+import random
+import shutil
 import socket
 import socketserver
+import subprocess
 import sys
 import signal
+import tempfile
+import threading
+import time
+import unittest
+import unittest.mock
 import common
+import federation
+import history
+import limits
+import metrics
+import msglog
+import outbox
+import registry
+import shard
 
 
-class User(object):
+class Session(object):
+    """A persistent connection opened by a client's Connect handshake.
+
+    Replies and pushed messages for the user share the same socket, so all
+    writes go through a lock to keep frames from interleaving.
+    """
+
+    def __init__(self, connection: socket.socket):
+        self.connection = connection
+        self.lock = threading.Lock()
+        # Set once the client negotiates binary framing at Connect
+        self.binary = False
+        # Set once the client negotiates compression at Connect
+        self.compressor: common.Compressor = None
+        self.decompressor: common.Decompressor = None
+        # Set once the client agrees to answer pings at Connect
+        self.heartbeat = False
+        # The user whose session this is, once their Connect is accepted
+        self.nick: str = None
+        # Rate limit buckets by opcode, made on first use by limits.RateLimits
+        self.buckets = None
+        # When the client last sent anything, by time.monotonic()
+        self.last_seen = time.monotonic()
+        # Replies and pushes are small, separate writes; don't let Nagle's
+        # algorithm hold them back waiting on the client's delayed ACKs.
+        connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    def send(self, data: bytes):
+        with self.lock:
+            # Packed under the lock so frames enter the deflate stream in
+            # the order they go out.
+            if self.compressor is not None:
+                data = self.compressor.pack(data)
+            self.connection.sendall(data)
+
+    def close(self):
+        # Wakes the handler thread blocked reading the connection, which
+        # then ends the session.
+        try:
+            self.connection.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+
+class Callback(object):
+    """Delivers messages by dialing back to a client's listening port."""
+
+    binary = False
+    compressor = None
+    heartbeat = False
+
     def __init__(self, nick: str, host: str, port: int):
         self.nick = nick
-        self.host = host[0]
+        self.host = host
         self.port = port
+        # When the client last answered a probe; requests come in on other
+        # connections, so they don't count
+        self.last_seen = time.monotonic()
 
+    def send(self, data: bytes):
+        s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        try:
+            s.connect((self.host, self.port))
+            s.sendall(data)
+        finally:
+            s.close()
 
-class Room(object):
-    def __init__(self, name, users: List[str] = None):
-        if users is None:
-            self.users = []
-        else:
-            self.users = [users]
-        self.name = name
+    def probe(self) -> bool:
+        """Returns whether the client still accepts connections on its
+        listening port. Nothing is sent, so the client sees an empty
+        connection."""
+        try:
+            socket.create_connection((self.host, self.port),
+                                     PROBE_TIMEOUT).close()
+            return True
+        except OSError:
+            return False
 
-    def add_to_room(self, user: User):
-        if not user in self.users:
-            self.users.append(user)
+    def close(self):
+        pass
 
-    def remove_user(self, user: User):
-        try:
-            if user in self.users:
-                self.users.remove(user)
-            if DEBUG:
-                print(self.name + ": Removed '" + user + "'")
-        except ValueError:
-            print("\tUnable to find user, probably safe to ignore them...")
 
-    def contains_user(self, username):
-        for user in self.users:
-            if user == username:
-                return True
+class AsyncSession(object):
+    """A session connection served by the asyncio engine."""
 
-        return False
+    def __init__(self, writer: asyncio.StreamWriter):
+        self.writer = writer
+        self.binary = False
+        self.compressor: common.Compressor = None
+        self.decompressor: common.Decompressor = None
+        self.heartbeat = False
+        self.nick: str = None
+        self.buckets = None
+        self.last_seen = time.monotonic()
+
+    def send(self, data: bytes):
+        if self.writer.is_closing():
+            raise ConnectionResetError("session closed")
+        if self.compressor is not None:
+            data = self.compressor.pack(data)
+        self.writer.write(data)
+
+    async def flush(self):
+        await self.writer.drain()
+
+    def close(self):
+        self.writer.close()
+
+
+class AsyncCallback(Callback):
+    """Dials back to a listening client without blocking the event loop.
+
+    Deliveries to the same client are chained so they arrive in order.
+    """
+
+    def __init__(self, nick: str, host: str, port: int):
+        super().__init__(nick, host, port)
+        self.last = None
+
+    def send(self, data: bytes):
+        self.last = asyncio.ensure_future(self.deliver(data, self.last))
+
+    async def flush(self):
+        if self.last is not None:
+            await asyncio.wait([self.last])
+
+    async def probe(self) -> bool:
+        try:
+            _, writer = await asyncio.wait_for(
+                asyncio.open_connection(self.host, self.port), PROBE_TIMEOUT)
+            writer.close()
+            return True
+        except (OSError, asyncio.TimeoutError):
+            return False
+
+    async def deliver(self, data: bytes, previous: asyncio.Future):
+        if previous is not None:
+            await asyncio.wait([previous])
+        try:
+            _, writer = await asyncio.open_connection(self.host, self.port)
+            writer.write(data)
+            await writer.drain()
+            writer.close()
+        except OSError as e:
+            METRICS.count_failure()
+            IRCServer.drop_user(self.nick, self)
+            LOG.debug("Unable to reach %s:%s: %s", self.host, self.port, e)
 
-    def __str__(self):
-        return self.name
 
+LOG = logging.getLogger("irc.server")
+# Sampled requests are logged here at INFO whatever the server's log level.
+TRACE = logging.getLogger("irc.trace")
+# Fraction of requests to trace; 0 turns tracing off
+TRACE_SAMPLE = 0.0
+LOG_FORMAT = "%(asctime)s %(levelname)s %(name)s: %(message)s"
+LOG_LISTENER: logging.handlers.QueueListener = None
 
-USERS: List[User] = list()
-ROOMS: List[Room] = list()
+REGISTRY = registry.Registry()
 
 LISTEN_ADDRESS = "127.0.0.1"
 LISTEN_PORT = 8080
 SERVER_SOCKET = None
-DEBUG = False
+ENGINE = "threaded"
+
+# Messages for each user wait in an outbox of up to OUTBOX_LIMIT frames and
+# are sent by writer threads (or a task per user on the asyncio engine).
+# With a limit of 0, messages are sent directly by the handler.
+OUTBOX_LIMIT = 0
+SLOW_CONSUMER = outbox.DROP_OLDEST
+WRITERS: outbox.WriterPool = None
+OUTBOX_STATS = outbox.Stats()
+# Set when this process is one of several workers; rooms and nicks are then
+# owned by whichever worker shard.owner() picks.
+SHARD: shard.Shard = None
+# Recent messages kept per room for replay; None when --history is 0
+HISTORY: history.History = None
+# Durable log of routed messages and a reader over it; None without
+# --message-log
+MESSAGE_LOG: msglog.MessageLog = None
+LOG_READER: msglog.LogReader = None
+# Most messages a history request replays from the message log
+LOG_REPLAY_LIMIT = 1000
+# Most names sent in one page of a listing
+PAGE_LIMIT = 1000
+# Set when this server accepts or opens links to other servers
+FEDERATION: federation.Federation = None
+METRICS = metrics.Metrics()
+# Per-user request rates, set by --rate
+LIMITS: limits.RateLimits = None
+# Open connections, capped by --max-connections
+ADMISSION: limits.Admission = None
+# Caps on connected users and rooms on this server; 0 for none
+MAX_USERS = 0
+MAX_ROOMS = 0
+# How long a connection turned away gets to send the request it is told is
+# refused
+BUSY_TIMEOUT = 2.0
+# Port for the plain-text metrics endpoint; 0 leaves it off
+METRICS_PORT = 0
+# Binary frames shorter than this go uncompressed to sessions that asked for
+# compression; 0 turns compression off
+COMPRESS_THRESHOLD = common.COMPRESS_THRESHOLD
+# Seconds of quiet before a heartbeat session is pinged, and between sweeps
+# for dead users; 0 turns heartbeats off
+HEARTBEAT = 0.0
+# Seconds of quiet after which a heartbeat session is evicted, and a
+# dial-back client is checked on
+IDLE_TIMEOUT = 0.0
+# Seconds to wait when dialing a client to see if it's still there
+PROBE_TIMEOUT = 2.0
+# Users evicted by the sweeper
+EVICTIONS = 0
 
 
 def interrupt_handler(signal, frame):
-    for user in USERS:
+    for user in REGISTRY.user_list():
         disco = common.Disconnect(user.nick)
         IRCServer.send_message(disco, user)
+    if WRITERS is not None:
+        WRITERS.join(2.0)
+    if MESSAGE_LOG is not None:
+        MESSAGE_LOG.close()
     server.server_close()
     SERVER_SOCKET.close()
+    stop_logging()
     sys.exit(0)
 
 
-signal.signal(signal.SIGINT, interrupt_handler)
+def start_logging(level: int):
+    """Sends the server's log records through a queue to a writer thread.
+
+    Handlers only pay for putting a record on the queue; formatting and the
+    write to stdout happen on the listener's thread. Records below `level`
+    are dropped before their message is formatted.
+    """
+    global LOG_LISTENER
+    records = queue.SimpleQueue()
+    output = logging.StreamHandler(sys.stdout)
+    output.setFormatter(logging.Formatter(LOG_FORMAT))
+    LOG_LISTENER = logging.handlers.QueueListener(records, output)
+    root = logging.getLogger("irc")
+    root.addHandler(logging.handlers.QueueHandler(records))
+    root.setLevel(level)
+    root.propagate = False
+    TRACE.setLevel(logging.INFO)
+    LOG_LISTENER.start()
+
+
+def stop_logging():
+    """Writes out any queued records."""
+    if LOG_LISTENER is not None:
+        LOG_LISTENER.stop()
 
 
 class IRCServer(socketserver.StreamRequestHandler):
     @staticmethod
-    def handle_connect(packet: common.Connect, address):
-        for user in USERS:
-            if user.nick == packet.username:
-                packet.status = common.Status.ERROR
-                packet.error = common.Error.USER_ALREADY_EXISTS
-                return packet
-        if DEBUG:
-            print("\tConnection from: " + address.__str__())
-        u = User(packet.username, address, packet.port)
-        USERS.append(u)
+    def handle_connect(packet: common.Connect, address,
+                       session: Session = None):
+        LOG.debug("Connection from: %s", address)
+        if session is None:
+            callback = AsyncCallback if ENGINE == "asyncio" else Callback
+            session = callback(packet.username, address[0], packet.port)
+            packet.features = 0
+        else:
+            # Binary framing needs a session to switch over; the reply to
+            # this Connect is the first binary frame the client sees.
+            # Presence events are pushed, so they need one too.
+            packet.features &= (common.FEATURE_BINARY
+                                | common.FEATURE_PRESENCE
+                                | common.FEATURE_COMPRESS
+                                | common.FEATURE_HEARTBEAT)
+            session.binary = bool(packet.features & common.FEATURE_BINARY)
+            if not session.binary or COMPRESS_THRESHOLD <= 0:
+                packet.features &= ~common.FEATURE_COMPRESS
+            if HEARTBEAT <= 0:
+                packet.features &= ~common.FEATURE_HEARTBEAT
+            session.heartbeat = bool(packet.features
+                                     & common.FEATURE_HEARTBEAT)
+        if packet.features & common.FEATURE_COMPRESS:
+            # Compression, like binary framing, starts with the reply to
+            # this Connect.
+            session.compressor = common.Compressor(COMPRESS_THRESHOLD)
+            session.decompressor = common.Decompressor()
+        u = registry.User(packet.username, address, packet.port, session)
+        u.presence = bool(packet.features & common.FEATURE_PRESENCE)
+        claimed = SHARD is None or SHARD.claim_nick(packet.username)
+        if FEDERATION is not None and FEDERATION.knows(packet.username):
+            claimed = False
+        # The cap on users is checked as the user is added, under the
+        # registry's lock, so racing Connects can't both take the last place.
+        added = claimed and REGISTRY.add_user(u, MAX_USERS)
+        if not added:
+            if claimed and SHARD is not None:
+                SHARD.release_nick(packet.username, [])
+            session.binary = session.heartbeat = False
+            session.compressor = session.decompressor = None
+            packet.features = 0
+            packet.status = common.Status.ERROR
+            packet.error = (common.Error.SERVER_BUSY if added is None else
+                            common.Error.USER_ALREADY_EXISTS)
+            return packet
+        if packet.port == 0:
+            session.nick = packet.username
+        IRCServer.attach_outbox(u)
+        IRCServer.announce(common.Connect(packet.username, 0))
+        packet.status = common.Status.OK
+        packet.error = common.Error.NO_ERROR
+        return packet
+
+    @staticmethod
+    def attach_outbox(user: registry.User):
+        if OUTBOX_LIMIT <= 0:
+            return
+
+        def on_close():
+            IRCServer.drop_user(user.nick, user.session)
+
+        if ENGINE == "asyncio":
+            user.outbox = outbox.AsyncOutbox(user.session, OUTBOX_LIMIT,
+                                             SLOW_CONSUMER, on_close,
+                                             OUTBOX_STATS)
+        else:
+            user.outbox = outbox.Outbox(user.session, WRITERS, OUTBOX_LIMIT,
+                                        SLOW_CONSUMER, on_close,
+                                        OUTBOX_STATS)
+
+    @staticmethod
+    def drop_user(nick: str, session=None):
+        rooms = list(REGISTRY.memberships.get(nick, ()))
+        user = REGISTRY.remove_user(nick, session)
+        if user is not None:
+            IRCServer.departed(user, rooms)
+        return user
+
+    @staticmethod
+    def departed(user: registry.User, rooms: List[str]):
+        """Tells everyone who needs to know that a user removed from the
+        registry has gone, and stops their deliveries."""
+        if SHARD is not None:
+            SHARD.release_nick(user.nick, rooms)
+        IRCServer.announce(common.Disconnect(user.nick))
+        for name in rooms:
+            IRCServer.presence(name, user.nick, common.PRESENCE_QUIT)
+        if user.outbox is not None:
+            user.outbox.close()
+
+    @staticmethod
+    def quiet_users(now: float):
+        """Sorts out the users who have been quiet for a heartbeat or more.
+
+        Returns the heartbeat sessions to ping, the heartbeat sessions
+        quiet past IDLE_TIMEOUT, which are taken to be dead, and the
+        dial-back clients quiet that long, which should be probed.
+        """
+        ping, dead, probe = [], [], []
+        # Dial-back clients are probed once every IDLE_TIMEOUT.
+        for user in REGISTRY.user_list():
+            session = user.session
+            quiet = now - session.last_seen
+            if quiet < HEARTBEAT:
+                continue
+            if session.heartbeat:
+                if quiet >= IDLE_TIMEOUT:
+                    dead.append(user)
+                else:
+                    ping.append(user)
+            elif isinstance(session, Callback) and quiet >= IDLE_TIMEOUT:
+                probe.append(user)
+        return ping, dead, probe
+
+    @staticmethod
+    def evict(users: List[registry.User]):
+        """Removes dead users from the registry and all of their rooms in
+        one batch, so fan-out stops spending time on them, then tells the
+        rest and closes their connections."""
+        global EVICTIONS
+        removed = REGISTRY.remove_users(users)
+        for user, rooms in removed:
+            LOG.info("Evicting %s, quiet for %.0fs", user.nick,
+                     time.monotonic() - user.session.last_seen)
+            IRCServer.departed(user, rooms)
+            user.session.close()
+        EVICTIONS += len(removed)
+
+    @staticmethod
+    def announce(packet: common.IrcPacket):
+        """Passes a change or message that started here to linked
+        servers."""
+        if FEDERATION is not None:
+            FEDERATION.relay(packet)
+
+    @staticmethod
+    def journal(packet: common.IrcPacket):
+        """Adds a message sent by one of this server's users to the message
+        log."""
+        if MESSAGE_LOG is not None:
+            MESSAGE_LOG.append(packet)
+
+    @staticmethod
+    def outbox_stats():
+        """Delivery totals and current queue depths across all users."""
+        return OUTBOX_STATS.snapshot(user.outbox
+                                     for user in REGISTRY.user_list()
+                                     if user.outbox is not None)
+
+    @staticmethod
+    def live_metrics():
+        """Point-in-time values and outbox totals reported alongside the
+        metrics."""
+        stats = IRCServer.outbox_stats()
+        gauges = {
+            "users": len(REGISTRY.users),
+            "rooms": len(REGISTRY.rooms),
+            "outbox_depth": stats["depth"],
+            "outbox_max_depth": stats["max_depth"],
+        }
+        if HISTORY is not None:
+            gauges["history_messages"] = HISTORY.count
+            gauges["history_bytes"] = HISTORY.size
+        counters = {
+            "outbox_" + name: stats[name]
+            for name in ("queued", "sent", "dropped", "disconnected",
+                         "failed")
+        }
+        if MESSAGE_LOG is not None:
+            counters["message_log_records"] = MESSAGE_LOG.written
+            counters["message_log_syncs"] = MESSAGE_LOG.syncs
+        if HEARTBEAT > 0:
+            counters["idle_evictions"] = EVICTIONS
+        return gauges, counters
+
+    @staticmethod
+    def handle_stats(packet: common.ServerStats):
+        packet.stats = METRICS.summary(*IRCServer.live_metrics())
         packet.status = common.Status.OK
         packet.error = common.Error.NO_ERROR
         return packet
 
     @staticmethod
     def handle_disconnect(packet: common.Disconnect):
-        for user in USERS:
-            if user.nick == packet.username:
-                USERS.remove(user)
-                for room in ROOMS:
-                    room.remove_user(packet.username)
-                packet.status = common.Status.OK
-                packet.error = common.Error.NO_ERROR
-                return packet
+        if IRCServer.drop_user(packet.username) is not None:
+            packet.status = common.Status.OK
+            packet.error = common.Error.NO_ERROR
+            return packet
 
         packet.status = common.Status.ERROR
         packet.error = common.Error.USER_NOT_FOUND
@@ -119,232 +500,1315 @@ class IRCServer(socketserver.StreamRequestHandler):
 
     @staticmethod
     def handle_create_room(packet: common.CreateRoom):
-        for room in ROOMS:
-            if room.name == packet.room:
-                packet.status = common.Status.ERROR
-                packet.error = common.Error.ROOM_ALREADY_EXISTS
-                return packet
+        # Under --workers, each worker caps the rooms it owns.
+        if SHARD is not None:
+            created = SHARD.create_room(packet.room)
+        else:
+            created = REGISTRY.add_room(registry.Room(packet.room), MAX_ROOMS)
+        if created is None:
+            packet.status = common.Status.ERROR
+            packet.error = common.Error.SERVER_BUSY
+            return packet
+        if not created:
+            packet.status = common.Status.ERROR
+            packet.error = common.Error.ROOM_ALREADY_EXISTS
+            return packet
 
-        ROOMS.append(Room(packet.room))
+        IRCServer.announce(packet)
         packet.status = common.Status.OK
         packet.error = common.Error.NO_ERROR
         return packet
 
     @staticmethod
     def handle_join_room(packet: common.JoinRoom):
-        if DEBUG:
-            print("In handle_join_room")
-        for room in ROOMS:
-            if room.name == packet.room:
-                if DEBUG:
-                    print("\tfound room")
-                room.add_to_room(packet.username)
-                packet.status = common.Status.OK
-                packet.error = common.Error.NO_ERROR
-                return packet
+        if SHARD is not None:
+            return IRCServer.handle_sharded_join_room(packet)
+        if REGISTRY.find_room(packet.room) is None:
+            packet.status = common.Status.ERROR
+            packet.error = common.Error.ROOM_NOT_FOUND
+            return packet
 
-        packet.status = common.Status.ERROR
-        packet.error = common.Error.ROOM_NOT_FOUND
+        if REGISTRY.join(packet.username, packet.room) is None:
+            packet.status = common.Status.ERROR
+            packet.error = common.Error.USER_NOT_FOUND
+            return packet
+
+        IRCServer.announce(packet)
+        IRCServer.presence(packet.room, packet.username, common.PRESENCE_JOIN)
+        IRCServer.replay_on_join(packet)
+        packet.status = common.Status.OK
+        packet.error = common.Error.NO_ERROR
+        return packet
+
+    @staticmethod
+    def handle_sharded_join_room(packet: common.JoinRoom):
+        # The room's owner has the final say on whether it exists; this
+        # worker keeps a room of its own members to deliver to.
+        if REGISTRY.find_user(packet.username) is None:
+            packet.status = common.Status.ERROR
+            packet.error = common.Error.USER_NOT_FOUND
+            return packet
+
+        if not SHARD.join(packet.username, packet.room):
+            packet.status = common.Status.ERROR
+            packet.error = common.Error.ROOM_NOT_FOUND
+            return packet
+
+        REGISTRY.add_room(registry.Room(packet.room))
+        REGISTRY.join(packet.username, packet.room)
+        IRCServer.presence(packet.room, packet.username, common.PRESENCE_JOIN)
+        IRCServer.replay_on_join(packet)
+        packet.status = common.Status.OK
+        packet.error = common.Error.NO_ERROR
+        return packet
+
+    @staticmethod
+    def replay_on_join(packet: common.JoinRoom):
+        if packet.history > 0 and HISTORY is not None:
+            room = REGISTRY.find_room(packet.room)
+            user = REGISTRY.find_user(packet.username)
+            if room is not None and user is not None:
+                for frame in HISTORY.recent(room.history, packet.history):
+                    IRCServer.deliver(frame, user)
+
+    @staticmethod
+    def handle_room_history(packet: common.RoomHistory):
+        room = REGISTRY.find_room(packet.room)
+        if room is None:
+            packet.status = common.Status.ERROR
+            packet.error = common.Error.ROOM_NOT_FOUND
+            return packet
+
+        user = REGISTRY.find_user(packet.username)
+        if user is None:
+            packet.status = common.Status.ERROR
+            packet.error = common.Error.USER_NOT_FOUND
+            return packet
+
+        frames = []
+        if HISTORY is not None:
+            if packet.count > 0:
+                frames = HISTORY.recent(room.history, packet.count)
+            else:
+                frames = HISTORY.since(room.history, packet.since)
+        if packet.count <= 0 and LOG_READER is not None:
+            frames = IRCServer.logged_messages(room, packet.since) + frames
+        # Replayed messages go out as the bytes encoded when they were
+        # first delivered.
+        for frame in frames:
+            IRCServer.deliver(frame, user)
+        packet.count = len(frames)
+        packet.status = common.Status.OK
+        packet.error = common.Error.NO_ERROR
         return packet
 
+    @staticmethod
+    def logged_messages(room: registry.Room,
+                        since) -> List[common.Frame]:
+        """Returns frames for the messages to a room sent since `since` that
+        are in the message log but have already left the room's history."""
+        oldest = None if HISTORY is None else HISTORY.oldest(room.history)
+        if oldest is not None and oldest <= common.micros_since_epoch(since):
+            return []
+        messages = LOG_READER.room_messages(room.name, since, oldest,
+                                            LOG_REPLAY_LIMIT)
+        return [common.Frame(m) for m in messages]
+
     @staticmethod
     def handle_leave_room(packet: common.LeaveRoom):
-        for room in ROOMS:
-            if room.name == packet.room:
-                room.remove_user(packet.username)
-                packet.status = common.Status.OK
-                packet.error = common.Error.NO_ERROR
-                return packet
+        if SHARD is not None:
+            REGISTRY.leave(packet.username, packet.room)
+            left = SHARD.leave(packet.username, packet.room)
+        else:
+            left = REGISTRY.leave(packet.username, packet.room)
+        if left:
+            IRCServer.announce(packet)
+            IRCServer.presence(packet.room, packet.username,
+                               common.PRESENCE_LEAVE)
+            packet.status = common.Status.OK
+            packet.error = common.Error.NO_ERROR
+            return packet
 
+        # Leaving a room you aren't in changes nothing, so nobody is told.
         packet.status = common.Status.ERROR
-        packet.error = common.Error.ROOM_NOT_FOUND
+        packet.error = (common.Error.ROOM_NOT_FOUND if left is None else
+                        common.Error.MALFORMED_MESSAGE)
         return packet
 
-    def handle_message_room(self, packet: common.MessageRoom):
-        if DEBUG:
-            print("In handle_message_room")
-        for room in ROOMS:
-            if room.name == packet.room:
-                if DEBUG:
-                    print("\tFound room")
-                for user in USERS:
-                    if room.contains_user(user.nick):
-                        self.send_message(packet, user)
-                return packet
+    @staticmethod
+    def handle_message_room(packet: common.MessageRoom):
+        if SHARD is not None:
+            delivered = SHARD.message_room(packet)
+        else:
+            delivered = IRCServer.deliver_room(packet)
+            if delivered:
+                IRCServer.announce(packet)
+        if delivered:
+            IRCServer.journal(packet)
+            return packet
 
         packet.status = common.Status.ERROR
         packet.error = common.Error.ROOM_NOT_FOUND
         return packet
 
-    def handle_private_message(self, packet: common.PrivateMessage):
-        if DEBUG:
-            print("In handle_private_message")
-            print("\tmessage is: " + packet.__str__())
-        for user in USERS:
-            if user.nick == packet.to:
-                if DEBUG:
-                    print("\tSending message to " + packet.to)
-                self.send_message(packet, user)
-                return packet
+    @staticmethod
+    def handle_private_message(packet: common.PrivateMessage):
+        if SHARD is not None:
+            delivered = SHARD.private_message(packet)
+        else:
+            delivered = IRCServer.deliver_user(packet)
+            if not delivered and FEDERATION is not None:
+                delivered = FEDERATION.route(packet)
+        if delivered:
+            IRCServer.journal(packet)
+            return packet
 
         packet.status = common.Status.ERROR
         packet.error = common.Error.USER_NOT_FOUND
+        return packet
 
     @staticmethod
-    def handle_list_rooms(packet: common.ListRooms):
-        packet.rooms = list()
-        for room in ROOMS:
-            packet.rooms.append(room.name)
+    def page_limit(packet) -> int:
+        """Returns how many names to send in reply to a paged listing, or 0
+        for a request without paging, which gets every name."""
+        if packet.limit <= 0 and not packet.cursor and not packet.prefix:
+            return 0
+        if packet.limit <= 0:
+            return PAGE_LIMIT
+        return min(packet.limit, PAGE_LIMIT)
 
+    @staticmethod
+    def finish_page(packet, page) -> List[str]:
+        """Sets the reply's cursor for a page and returns its names."""
+        names, more = page
+        packet.cursor = names[-1] if more else ""
+        return names
+
+    @staticmethod
+    def handle_list_rooms(packet: common.ListRooms):
+        limit = IRCServer.page_limit(packet)
+        if limit > 0:
+            source = SHARD if SHARD is not None else REGISTRY
+            packet.rooms = IRCServer.finish_page(
+                packet, source.room_page(packet.cursor, limit, packet.prefix))
+        elif SHARD is not None:
+            packet.rooms = SHARD.room_names()
+        else:
+            packet.rooms = REGISTRY.room_names()
         packet.status = common.Status.OK
         packet.error = common.Error.NO_ERROR
         return packet
 
     @staticmethod
     def handle_list_users(packet: common.ListUsers):
-        packet.users = list()
-        for user in USERS:
-            packet.users.append(user.nick)
-
+        limit = IRCServer.page_limit(packet)
+        if limit > 0:
+            if SHARD is not None:
+                page = SHARD.user_page(packet.cursor, limit, packet.prefix)
+            else:
+                pages = [
+                    REGISTRY.user_page(packet.cursor, limit, packet.prefix)
+                ]
+                if FEDERATION is not None:
+                    pages.append(
+                        FEDERATION.user_page(packet.cursor, limit,
+                                             packet.prefix))
+                page = registry.merge_pages(pages, limit)
+            packet.users = IRCServer.finish_page(packet, page)
+        elif SHARD is not None:
+            packet.users = SHARD.user_names()
+        else:
+            packet.users = REGISTRY.user_names()
+            if FEDERATION is not None:
+                packet.users += FEDERATION.user_names()
         packet.status = common.Status.OK
         packet.error = common.Error.NO_ERROR
         return packet
 
     @staticmethod
     def handle_list_users_in_room(packet: common.ListUsersInRoom):
-        packet.users = list()
-        if DEBUG:
-            print("In handle_list_users_in_room")
-            print("\tpacket is '" + packet.__str__() + "'")
-            print("\tlooking for room '" + packet.room + "'")
-        for room in ROOMS:
-            if DEBUG:
-                print("\t" + room.name + " == " + packet.room)
-            if room.name == packet.room:
-                print("\tFound room '" + room.name + "'")
-                for user in room.users:
-                    packet.users.append(user)
-                packet.status = common.Status.OK
-                packet.error = common.Error.NO_ERROR
-                return packet
+        LOG.debug("Looking for room '%s'", packet.room)
+        limit = IRCServer.page_limit(packet)
+        if limit > 0:
+            if SHARD is not None:
+                page = SHARD.member_page(packet.room, packet.cursor, limit,
+                                         packet.prefix)
+            else:
+                page = REGISTRY.member_page(packet.room, packet.cursor, limit,
+                                            packet.prefix)
+                if page is not None and FEDERATION is not None:
+                    page = registry.merge_pages([
+                        page,
+                        FEDERATION.member_page(packet.room, packet.cursor,
+                                               limit, packet.prefix)
+                    ], limit)
+            users = None if page is None else IRCServer.finish_page(
+                packet, page)
+        elif SHARD is not None:
+            users = SHARD.room_members(packet.room)
+        else:
+            members = REGISTRY.members(packet.room)
+            users = None if members is None else [u.nick for u in members]
+            if users is not None and FEDERATION is not None:
+                users += FEDERATION.members(packet.room)
+        if users is not None:
+            packet.users = users
+            packet.status = common.Status.OK
+            packet.error = common.Error.NO_ERROR
+            return packet
 
+        packet.users = list()
         packet.status = common.Status.ERROR
         packet.error = common.Error.ROOM_NOT_FOUND
         return packet
 
     @staticmethod
-    def send_message(packet: common.IrcPacket, user: User):
-        if DEBUG:
-            print("In send_message ")
+    def deliver_room(packet: common.MessageRoom) -> bool:
+        """Sends a room message to the room's members on this server.
+
+        Returns False if there's no such room here.
+        """
+        room = REGISTRY.find_room(packet.room)
+        if room is None:
+            return False
+        members = REGISTRY.members(packet.room)
+        # Encode once; every member gets the same bytes.
+        frame = common.Frame(packet)
+        if HISTORY is not None:
+            HISTORY.record(room.history, frame)
+        METRICS.observe_fanout(len(members))
+        for user in members:
+            IRCServer.deliver(frame, user)
+        return True
+
+    @staticmethod
+    def deliver_user(packet: common.PrivateMessage) -> bool:
+        """Sends a private message to its recipient, if they are connected
+        to this server."""
+        user = REGISTRY.find_user(packet.to)
+        if user is None:
+            return False
+        LOG.debug("Sending message to %s", packet.to)
+        IRCServer.send_message(packet, user)
+        return True
+
+    @staticmethod
+    def deliver_all(packet: common.Broadcast):
+        """Sends a broadcast to every user on this server."""
+        frame = common.Frame(packet)
+        users = REGISTRY.user_list()
+        METRICS.observe_fanout(len(users))
+        for user in users:
+            IRCServer.deliver(frame, user)
+
+    @staticmethod
+    def presence(room: str, nick: str, change: int):
+        """Tells the members of a room that asked for presence events that
+        a user joined, left or disconnected."""
+        packet = common.Presence(room, nick, change)
+        if SHARD is not None:
+            SHARD.room_presence(packet)
+        else:
+            IRCServer.deliver_presence(packet)
+
+    @staticmethod
+    def deliver_presence(packet: common.Presence):
+        """Sends a presence event to the room's members on this server that
+        asked for them, other than the user it is about."""
+        members = REGISTRY.members(packet.room)
+        if not members:
+            return
+        frame = None
+        for user in members:
+            if user.presence and user.nick != packet.username:
+                if frame is None:
+                    frame = common.Frame(packet)
+                IRCServer.deliver(frame, user)
+
+    @staticmethod
+    def send_message(packet: common.IrcPacket, user: registry.User):
+        IRCServer.deliver(common.Frame(packet), user)
+
+    @staticmethod
+    def deliver(frame: common.Frame, user: registry.User):
+        """Sends a frame to a user in the user's wire format."""
+        LOG.debug("Sending message to %s:%s", user.host, user.port)
+        data = frame.encode(user.session.binary)
+        if user.outbox is not None:
+            user.outbox.send(data)
+            return
         try:
-            s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            if DEBUG:
-                print("\tpreparing debug message")
-                print("\tSending message to " + user.host[0] + ":" + str(
-                    user.host[1]))
-                print("\tport is" + str(user.port))
-            s.connect((user.host, user.port))
-            s.send(packet.encode())
-            s.close()
+            user.session.send(data)
         except socket.error as e:
-            if e.errno == 111:
-                if user in USERS:
-                    USERS.remove(user)
+            METRICS.count_failure()
+            # A refused dial-back or a broken session both mean the client
+            # is gone.
+            if e.errno == 111 or not isinstance(user.session, Callback):
+                IRCServer.drop_user(user.nick, user.session)
             else:
-                print(e)
+                LOG.warning("Unable to deliver to %s: %s", user.nick, e)
 
-    def handle_broadcast(self, packet: common.Broadcast):
-        for user in USERS:
-            self.send_message(packet, user)
+    @staticmethod
+    def handle_broadcast(packet: common.Broadcast):
+        if SHARD is not None:
+            SHARD.broadcast(packet)
+        else:
+            IRCServer.deliver_all(packet)
+            IRCServer.announce(packet)
+        IRCServer.journal(packet)
         return packet
 
     def handle(self):
-        new_input = self.rfile.readline()
+        if ADMISSION is None:
+            self.serve()
+        elif ADMISSION.enter():
+            try:
+                self.serve()
+            finally:
+                ADMISSION.leave()
+        else:
+            self.turn_away()
 
+    def turn_away(self):
+        # Read the first request so the reply can say why, but don't wait
+        # long for it.
+        self.connection.settimeout(BUSY_TIMEOUT)
+        try:
+            message = self.decode(self.rfile.readline(), False)
+            if message is not None:
+                self.wfile.write(self.turned_away(message).encode())
+        except OSError:
+            pass
+
+    def serve(self):
         address = self.connection.getpeername()
+        # Every connection carries requests until the client closes it or
+        # disconnects, and replies go back in request order. A Connect with
+        # port 0 also asks for a session: the server pushes messages down the
+        # connection instead of dialing back to a listener on the client.
+        self.session = Session(self.connection)
+        session = None
+        nick = None
 
         try:
-            message = common.decode(new_input)
+            while True:
+                binary = self.session.binary
+                if binary:
+                    try:
+                        new_input = common.read_binary(
+                            self.rfile, self.session.decompressor)
+                    except TypeError:
+                        break
+                else:
+                    new_input = self.rfile.readline()
+                if not new_input:
+                    break
+                self.session.last_seen = time.monotonic()
+
+                message = self.decode(new_input, binary)
+                if message is None:
+                    continue
+
+                if (isinstance(message, common.ServerLink)
+                        and FEDERATION is not None and session is None):
+                    # Another server; the connection is a link from now on.
+                    FEDERATION.accept(self.connection, self.rfile, message)
+                    break
+
+                message = self.handle_request(message, address,
+                                              self.session)
+                if (isinstance(message, common.Connect) and message.port == 0
+                        and message.status == common.Status.OK):
+                    session = self.session
+                    nick = message.username
+
+                if session is not None:
+                    session.send(common.Frame(message).encode(session.binary))
+                else:
+                    self.wfile.write(message.encode())
+
+                if isinstance(message, common.Disconnect):
+                    break
+        except ConnectionError as e:
+            LOG.debug("Connection from %s failed: %s", address, e)
+        finally:
+            # Whatever ends the loop, a session's nick mustn't outlive it.
+            self.end_session(nick, session)
+
+    @staticmethod
+    def end_session(nick: str, session):
+        # The client went away without a Disconnect; free up its nick.
+        if session is not None:
+            IRCServer.drop_user(nick, session)
+
+    @staticmethod
+    def throttled(message: common.IrcPacket, session) -> bool:
+        """Returns True if the connection has used up its allowance for this
+        kind of request. Leaving is never refused.
+
+        Requests are charged to the connection they come in on, whoever
+        they claim to be from, so one client can't spend another's
+        allowance or dodge its own by naming someone else.
+        """
+        if (LIMITS is None or session is None
+                or isinstance(message, common.Disconnect)):
+            return False
+        return not LIMITS.allow(session, message.opcode)
+
+    @staticmethod
+    def impostor(message: common.IrcPacket, address, session) -> bool:
+        """Returns True if a request names a user it can't be from.
+
+        On a session connection only the session's user may send requests.
+        Elsewhere the user must be connected, taking deliveries by dialing
+        back to the host the request comes from.
+        """
+        if session is None or isinstance(message, common.Connect):
+            return False
+        if session.nick is not None:
+            return message.username != session.nick
+        user = REGISTRY.find_user(message.username)
+        return (user is None or not isinstance(user.session, Callback)
+                or user.session.host != address[0])
+
+    @staticmethod
+    def turned_away(message: common.IrcPacket) -> common.IrcPacket:
+        """Refuses the only request of a connection over the limit."""
+        METRICS.count_error(common.Error.SERVER_BUSY)
+        message.status = common.Status.ERROR
+        message.error = common.Error.SERVER_BUSY
+        if isinstance(message, common.Connect):
+            message.features = 0
+        return message
+
+    @staticmethod
+    def decode(new_input: bytes, binary: bool):
+        """Decodes one frame, or returns None if it is malformed."""
+        try:
+            if binary:
+                return common.decode_binary(new_input)
+            return common.decode(new_input)
         except TypeError as te:
-            print("Error processing packet: '" + input + "' generated error '"
-                  + te.__str__() + "'")
+            METRICS.count_error(common.Error.MALFORMED_MESSAGE)
+            LOG.warning("Error processing packet: %r generated error '%s'",
+                        new_input, te)
+            return None
 
+    @classmethod
+    def handle_request(cls, message: common.IrcPacket, address, session):
+        started = time.perf_counter()
+        LOG.debug("Received %s: '%s'", message.opcode, message)
         try:
-            if isinstance(message, common.Connect):
-                print("***Received Connect***")
-                if DEBUG:
-                    print("\tmessage is: '" + message.to_string() + "'")
-                message = self.handle_connect(message, address)
+            if cls.throttled(message, session):
+                message.status = common.Status.ERROR
+                message.error = common.Error.SERVER_BUSY
+                if isinstance(message, common.Connect):
+                    message.features = 0
+            elif cls.impostor(message, address, session):
+                message.status = common.Status.ERROR
+                message.error = common.Error.USER_NOT_FOUND
+            elif isinstance(message, common.Connect):
+                if session is not None and session.nick is not None:
+                    # One user per connection: a second nick taken here
+                    # would never be freed when the connection closes.
+                    message.features = 0
+                    message.status = common.Status.ERROR
+                    message.error = common.Error.USER_ALREADY_EXISTS
+                else:
+                    if message.port != 0:
+                        session = None
+                    message = cls.handle_connect(message, address, session)
             elif isinstance(message, common.Disconnect):
-                print("***Received Disconnect***")
-                if DEBUG:
-                    print("\tmessage is: '" + message.to_string() + "'")
-                message = self.handle_disconnect(message)
+                message = cls.handle_disconnect(message)
             elif isinstance(message, common.CreateRoom):
-                print("***Received Create Room***")
-                if DEBUG:
-                    print("\tmessage is: '" + message.to_string() + "'")
-                message = self.handle_create_room(message)
+                message = cls.handle_create_room(message)
             elif isinstance(message, common.JoinRoom):
-                print("***Received Join Room***")
-                if DEBUG:
-                    print("\tmessage is: '" + message.to_string() + "'")
-                message = self.handle_join_room(message)
+                message = cls.handle_join_room(message)
             elif isinstance(message, common.LeaveRoom):
-                print("***Received Leave Room***")
-                if DEBUG:
-                    print("\tmessage is: '" + message.to_string() + "'")
-                message = self.handle_leave_room(message)
+                message = cls.handle_leave_room(message)
             elif isinstance(message, common.MessageRoom):
-                print("***Received Message Room***")
-                if DEBUG:
-                    print("\tmessage is: '" + message.to_string() + "'")
-                message = self.handle_message_room(message)
+                message = cls.handle_message_room(message)
             elif isinstance(message, common.ListRooms):
-                print("***Received List Rooms***")
-                if DEBUG:
-                    print("\tmessage is: '" + message.to_string() + "'")
-                message = self.handle_list_rooms(message)
+                message = cls.handle_list_rooms(message)
             elif isinstance(message, common.ListUsers):
-                print("***Received List Users***")
-                if DEBUG:
-                    print("\tmessage is: '" + message.to_string() + "'")
-                message = self.handle_list_users(message)
+                message = cls.handle_list_users(message)
             elif isinstance(message, common.ListUsersInRoom):
-                print("***Received List Users in Room***")
-                if DEBUG:
-                    print("\tmessage is: '" + message.to_string() + "'")
-                message = self.handle_list_users_in_room(message)
+                message = cls.handle_list_users_in_room(message)
             elif isinstance(message, common.PrivateMessage):
-                print("***Received Private Message***")
-                if DEBUG:
-                    print("\tmessage is: '" + message.to_string() + "'")
-                message = self.handle_private_message(message)
+                message = cls.handle_private_message(message)
             elif isinstance(message, common.Broadcast):
-                print("***Received Broadcast***")
-                if DEBUG:
-                    print("\tmessage is: '" + message.to_string() + "'")
-                message = self.handle_broadcast(message)
+                message = cls.handle_broadcast(message)
+            elif isinstance(message, common.ServerStats):
+                message = cls.handle_stats(message)
+            elif isinstance(message, common.RoomHistory):
+                message = cls.handle_room_history(message)
+            elif isinstance(message, common.Ping):
+                message.status = common.Status.OK
+                message.error = common.Error.NO_ERROR
             else:
                 message.status = common.Status.ERROR
                 message.error = common.Error.MALFORMED_MESSAGE
         except TypeError as te:
             message.status = common.Status.ERROR
             message.error = common.Error.MALFORMED_MESSAGE
-            print("Error in message router: '" + te.__str__() + "'")
+            LOG.error("Error in message router: '%s'", te)
             raise (te)
 
-        if DEBUG:
-            print("\toutbound message is '" + message.__str__() + "'")
+        elapsed = time.perf_counter() - started
+        METRICS.observe_request(message.opcode, message.error, elapsed)
+        if TRACE_SAMPLE and random.random() < TRACE_SAMPLE:
+            TRACE.info("%s from %s at %s: %s %s in %.3f ms", message.opcode,
+                       message.username, address, message.status,
+                       message.error.name, elapsed * 1e3)
+        LOG.debug("Outbound message is '%s'", message)
+
+        return message
+
+
+class ThreadingIRCServer(socketserver.ThreadingTCPServer):
+    # Session handlers live as long as their client, so don't wait on them
+    # at shutdown, and don't let their TIME_WAIT sockets block a restart.
+    allow_reuse_address = True
+    daemon_threads = True
+    # socketserver's default backlog of 5 makes bursts of connecting
+    # clients wait out SYN retransmits; match the asyncio engine.
+    request_queue_size = 1024
+    # Workers all listen on the same port and the kernel spreads new
+    # connections between them.
+    reuse_port = False
+
+    def server_bind(self):
+        if self.reuse_port:
+            self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        super().server_bind()
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    """Serves the metrics as plain text on every GET."""
 
-        self.wfile.write(message.encode())
+    def do_GET(self):
+        body = METRICS.render(*IRCServer.live_metrics()).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def serve_metrics():
+    """Starts the metrics endpoint on its own thread, if it is enabled.
+
+    Both engines use it; everything it reads is safe to read from another
+    thread.
+    """
+    if METRICS_PORT <= 0:
+        return None
+    httpd = ThreadingHTTPServer((LISTEN_ADDRESS, METRICS_PORT),
+                                MetricsHandler)
+    httpd.daemon_threads = True
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+    LOG.info("Metrics on http://%s:%s/metrics", LISTEN_ADDRESS, METRICS_PORT)
+    return httpd
+
+
+async def handle_stream(reader: asyncio.StreamReader,
+                        writer: asyncio.StreamWriter):
+    """Serves one client connection on the asyncio engine.
+
+    This mirrors IRCServer.handle, but an idle session costs a coroutine
+    and a pair of stream buffers instead of an OS thread.
+    """
+    if ADMISSION is not None and not ADMISSION.enter():
+        try:
+            new_input = await asyncio.wait_for(reader.readline(),
+                                               BUSY_TIMEOUT)
+            message = IRCServer.decode(new_input, False)
+            if message is not None:
+                writer.write(IRCServer.turned_away(message).encode())
+                await writer.drain()
+        except (ConnectionError, asyncio.TimeoutError):
+            pass
+        writer.close()
         return
 
+    address = writer.get_extra_info('peername')
+    candidate = AsyncSession(writer)
+    session = None
+    nick = None
+
+    try:
+        while True:
+            binary = candidate.binary
+            if binary:
+                try:
+                    new_input = await common.read_binary_async(
+                        reader, candidate.decompressor)
+                except TypeError:
+                    break
+            else:
+                new_input = await reader.readline()
+                if not new_input:
+                    break
+            candidate.last_seen = time.monotonic()
+
+            message = IRCServer.decode(new_input, binary)
+            if message is None:
+                continue
+
+            message = IRCServer.handle_request(message, address, candidate)
+            if (isinstance(message, common.Connect) and message.port == 0
+                    and message.status == common.Status.OK):
+                session = candidate
+                nick = message.username
+
+            # Through the session, so replies and pushes share its deflate
+            # stream in the order they are written.
+            candidate.send(common.Frame(message).encode(candidate.binary))
+            await writer.drain()
+            if outbox.AsyncOutbox.pressured:
+                await outbox.AsyncOutbox.relieve()
+
+            if isinstance(message, common.Disconnect):
+                break
+    except (ConnectionError, ValueError, asyncio.IncompleteReadError) as e:
+        LOG.debug("Connection from %s failed: %s", address, e)
+    finally:
+        IRCServer.end_session(nick, session)
+        writer.close()
+        if ADMISSION is not None:
+            ADMISSION.leave()
+
+
+def sweep(now: float):
+    """Pings quiet sessions, probes quiet dial-back clients and evicts the
+    users found dead."""
+    ping, dead, probe = IRCServer.quiet_users(now)
+    for user in ping:
+        IRCServer.send_message(common.Ping(user.nick), user)
+    for user in probe:
+        if user.session.probe():
+            user.session.last_seen = now
+        else:
+            dead.append(user)
+    if dead:
+        IRCServer.evict(dead)
+
+
+def sweep_forever():
+    """Every heartbeat, pings quiet sessions and evicts the dead ones."""
+    while True:
+        time.sleep(HEARTBEAT)
+        sweep(time.monotonic())
+
+
+async def sweep_asyncio():
+    """sweep_forever() for the asyncio engine; probes run concurrently."""
+    while True:
+        await asyncio.sleep(HEARTBEAT)
+        now = time.monotonic()
+        ping, dead, probe = IRCServer.quiet_users(now)
+        for user in ping:
+            IRCServer.send_message(common.Ping(user.nick), user)
+        alive = await asyncio.gather(*(user.session.probe()
+                                       for user in probe))
+        for user, answered in zip(probe, alive):
+            if answered:
+                user.session.last_seen = now
+            else:
+                dead.append(user)
+        if dead:
+            IRCServer.evict(dead)
+
+
+async def serve_asyncio():
+    loop = asyncio.get_running_loop()
+    stop = loop.create_future()
+    loop.add_signal_handler(signal.SIGINT, stop.set_result, None)
+
+    server = await asyncio.start_server(handle_stream,
+                                        LISTEN_ADDRESS,
+                                        LISTEN_PORT,
+                                        reuse_address=True,
+                                        backlog=1024)
+    LOG.info("Server started on %s:%s (asyncio)", LISTEN_ADDRESS,
+             LISTEN_PORT)
+    if HEARTBEAT > 0:
+        sweeper = asyncio.ensure_future(sweep_asyncio())
+    async with server:
+        await stop
+        if HEARTBEAT > 0:
+            sweeper.cancel()
+        users = REGISTRY.user_list()
+        for user in users:
+            IRCServer.send_message(common.Disconnect(user.nick), user)
+        await asyncio.sleep(0)
+        await asyncio.gather(*(user.session.flush() for user in users),
+                             return_exceptions=True)
+
+
+def run_workers(count: int):
+    """Runs `count` copies of this server as worker processes sharing the
+    listening port, and waits for them to exit.
+
+    Each worker is started with the same arguments plus its index and the
+    directory holding the sockets the workers link up through. Workers run
+    in their own sessions, so an interrupt reaches them once, from here.
+    """
+    link_dir = tempfile.mkdtemp(prefix="irc-")
+    env = dict(os.environ, IRC_LINK_KEY=os.urandom(16).hex())
+    children = [
+        subprocess.Popen([sys.executable,
+                          os.path.abspath(__file__)] + sys.argv[1:] +
+                         ["--worker-index",
+                          str(i), "--link-dir", link_dir],
+                         env=env,
+                         start_new_session=True) for i in range(count)
+    ]
+
+    def stop(signum, frame):
+        for child in children:
+            child.send_signal(signal.SIGINT)
+
+    signal.signal(signal.SIGINT, stop)
+    signal.signal(signal.SIGTERM, stop)
+    try:
+        for child in children:
+            child.wait()
+    finally:
+        shutil.rmtree(link_dir, ignore_errors=True)
+
+
+class QuietIRCServer(ThreadingIRCServer):
+    """The threaded engine, for tests, without tracebacks from handlers
+    that are meant to fail."""
+
+    def handle_error(self, request, client_address):
+        pass
+
+
+class TestServer(unittest.TestCase):
+    """Runs the threaded engine in the same process."""
+
+    def setUp(self):
+        self.patch("REGISTRY", registry.Registry())
+        self.patch("ENGINE", "threaded")
+        self.server = QuietIRCServer(("127.0.0.1", 0), IRCServer)
+        serving = threading.Thread(target=self.server.serve_forever)
+        serving.daemon = True
+        serving.start()
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+
+    def patch(self, name: str, value):
+        """Sets one of the server's globals for the rest of the test."""
+        patcher = unittest.mock.patch.object(sys.modules[__name__], name,
+                                             value)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def connect(self):
+        s = socket.create_connection(self.server.server_address, 5)
+        rfile = s.makefile("rb")
+        self.addCleanup(s.close)
+        self.addCleanup(rfile.close)
+        return s, rfile
+
+    def request(self, s, rfile, packet: common.IrcPacket):
+        s.sendall(packet.encode())
+        return common.decode(rfile.readline())
+
+    def test_session_ends_when_handler_fails(self):
+        s, rfile = self.connect()
+        self.request(s, rfile, common.Connect("alice", 0))
+        with unittest.mock.patch.object(IRCServer, "handle_stats",
+                                        side_effect=RuntimeError("boom")):
+            s.sendall(common.ServerStats([], "alice").encode())
+            self.assertEqual(b"", rfile.readline())
+        self.assertIsNone(REGISTRY.find_user("alice"))
+
+    def test_pipelined_requests(self):
+        s, rfile = self.connect()
+        requests = [
+            common.Connect("alice", 0),
+            common.CreateRoom("room", "alice"),
+            common.JoinRoom("room", "alice"),
+            common.ListRooms([], "alice"),
+            common.ListUsers([], "alice"),
+        ]
+        # A malformed line among them is skipped, and the connection
+        # carries on with the requests after it.
+        lines = [request.encode() for request in requests]
+        lines.insert(2, b"99\x1fnot a request\n")
+        s.sendall(b"".join(lines))
+        replies = [common.decode(rfile.readline()) for _ in requests]
+        self.assertEqual([(r.opcode, r.timestamp) for r in requests],
+                         [(r.opcode, r.timestamp) for r in replies])
+        self.assertEqual([common.Status.OK] * len(requests),
+                         [r.status for r in replies])
+        self.assertEqual(["room"], replies[3].rooms)
+        self.assertEqual(["alice"], replies[4].users)
+
+    def test_second_session_connect_is_refused(self):
+        s, rfile = self.connect()
+        self.assertEqual(common.Status.OK,
+                         self.request(s, rfile, common.Connect("alice",
+                                                               0)).status)
+        reply = self.request(s, rfile, common.Connect("bob", 0))
+        self.assertEqual(common.Error.USER_ALREADY_EXISTS, reply.error)
+        self.assertIsNone(REGISTRY.find_user("bob"))
+        s.shutdown(socket.SHUT_WR)
+        self.assertEqual(b"", rfile.readline())
+        deadline = time.monotonic() + 5
+        while REGISTRY.find_user("alice") is not None:
+            self.assertLess(time.monotonic(), deadline)
+            time.sleep(0.01)
+
+    def test_second_session_connect_is_refused_asyncio(self):
+        self.patch("ENGINE", "asyncio")
+
+        async def test():
+            listener = await asyncio.start_server(handle_stream, "127.0.0.1",
+                                                  0)
+            port = listener.sockets[0].getsockname()[1]
+            reader, writer = await asyncio.open_connection("127.0.0.1", port)
+            errors = []
+            for nick in ("alice", "bob"):
+                writer.write(common.Connect(nick, 0).encode())
+                errors.append(common.decode(await reader.readline()).error)
+            writer.close()
+            await reader.read()
+            listener.close()
+            await listener.wait_closed()
+            return errors
+
+        self.assertEqual(
+            [common.Error.NO_ERROR, common.Error.USER_ALREADY_EXISTS],
+            asyncio.run(test()))
+        self.assertEqual([], REGISTRY.user_names())
+
+    def test_max_users(self):
+        self.patch("MAX_USERS", 1)
+        s, rfile = self.connect()
+        self.assertEqual(common.Status.OK,
+                         self.request(s, rfile, common.Connect("alice",
+                                                               0)).status)
+        s, rfile = self.connect()
+        reply = self.request(s, rfile, common.Connect("bob", 0))
+        self.assertEqual(common.Error.SERVER_BUSY, reply.error)
+        self.assertIsNone(REGISTRY.find_user("bob"))
+        reply = self.request(s, rfile, common.Connect("alice", 0))
+        self.assertEqual(common.Error.USER_ALREADY_EXISTS, reply.error)
+
+    def test_max_rooms(self):
+        self.patch("MAX_ROOMS", 1)
+        s, rfile = self.connect()
+        self.request(s, rfile, common.Connect("alice", 0))
+        self.assertEqual(
+            [common.Error.NO_ERROR, common.Error.SERVER_BUSY,
+             common.Error.ROOM_ALREADY_EXISTS],
+            [self.request(s, rfile, common.CreateRoom(name, "alice")).error
+             for name in ("first", "second", "first")])
+        self.assertEqual(["first"], REGISTRY.room_names())
+
+    def test_max_connections(self):
+        self.patch("ADMISSION", limits.Admission(1))
+        s, rfile = self.connect()
+        self.request(s, rfile, common.Connect("alice", 0))
+        other, other_rfile = self.connect()
+        reply = self.request(other, other_rfile, common.ListUsers([], "bob"))
+        self.assertEqual(common.Error.SERVER_BUSY, reply.error)
+        self.assertEqual(b"", other_rfile.readline())
+        reply = self.request(s, rfile, common.ListUsers([], "alice"))
+        self.assertEqual(["alice"], reply.users)
+
+    def test_rate_limit(self):
+        self.patch("LIMITS",
+                   limits.RateLimits({"USER_LIST": (0.01, 1.0)}))
+        s, rfile = self.connect()
+        self.request(s, rfile, common.Connect("alice", 0))
+        self.assertEqual(
+            [common.Error.NO_ERROR, common.Error.SERVER_BUSY],
+            [self.request(s, rfile, common.ListUsers([], "alice")).error
+             for _ in range(2)])
+        # Leaving is never refused.
+        reply = self.request(s, rfile, common.Disconnect("alice"))
+        self.assertEqual(common.Status.OK, reply.status)
+
+    def test_rate_limit_is_per_connection(self):
+        self.patch("LIMITS",
+                   limits.RateLimits({"USER_LIST": (0.01, 1.0),
+                                      "SERVER_JOIN": (0.01, 1.0)}))
+        s, rfile = self.connect()
+        self.request(s, rfile, common.Connect("alice", 0))
+        # Naming alice from another connection spends that connection's
+        # allowance, not hers.
+        other, other_rfile = self.connect()
+        self.assertEqual(
+            [common.Error.USER_NOT_FOUND, common.Error.SERVER_BUSY],
+            [self.request(other, other_rfile,
+                          common.ListUsers([], "alice")).error
+             for _ in range(2)])
+        reply = self.request(s, rfile, common.ListUsers([], "alice"))
+        self.assertEqual(common.Status.OK, reply.status)
+        # Connects are charged to their connection too, so one connection
+        # can't take nick after nick.
+        reply = self.request(other, other_rfile, common.Connect("bob", 9))
+        self.assertEqual(common.Status.OK, reply.status)
+        reply = self.request(other, other_rfile, common.Connect("carol", 9))
+        self.assertEqual(common.Error.SERVER_BUSY, reply.error)
+        self.assertIsNone(REGISTRY.find_user("carol"))
+
+    def test_leave_room_not_joined(self):
+        s, rfile = self.connect()
+        self.request(
+            s, rfile,
+            common.Connect("alice", 0, features=common.FEATURE_PRESENCE))
+        self.request(s, rfile, common.CreateRoom("room", "alice"))
+        self.request(s, rfile, common.JoinRoom("room", "alice"))
+        other, other_rfile = self.connect()
+        self.request(other, other_rfile, common.Connect("bob", 0))
+        with unittest.mock.patch.object(IRCServer, "announce") as announce:
+            reply = self.request(other, other_rfile,
+                                 common.LeaveRoom("room", "bob"))
+            self.assertEqual(common.Error.MALFORMED_MESSAGE, reply.error)
+            reply = self.request(other, other_rfile,
+                                 common.LeaveRoom("nowhere", "bob"))
+            self.assertEqual(common.Error.ROOM_NOT_FOUND, reply.error)
+        announce.assert_not_called()
+        # Alice heard nothing about bob leaving, so her next reply is the
+        # next thing on her connection.
+        reply = self.request(s, rfile, common.ListUsers([], "alice"))
+        self.assertEqual(common.Operations.USER_LIST, reply.opcode)
+        reply = self.request(s, rfile, common.LeaveRoom("room", "alice"))
+        self.assertEqual(common.Status.OK, reply.status)
+
+    def test_requests_must_come_from_their_user(self):
+        s, rfile = self.connect()
+        self.request(s, rfile, common.Connect("alice", 0))
+        other, other_rfile = self.connect()
+        self.request(other, other_rfile, common.Connect("bob", 9))
+        for packet in (common.Broadcast("hi", "ghost"),
+                       common.Broadcast("hi", "alice")):
+            reply = self.request(other, other_rfile, packet)
+            self.assertEqual(common.Error.USER_NOT_FOUND, reply.error)
+        # A session speaks only for its own user.
+        reply = self.request(s, rfile, common.ListUsers([], "bob"))
+        self.assertEqual(common.Error.USER_NOT_FOUND, reply.error)
+        # Nothing was broadcast to alice, so her next reply is the next
+        # thing on her connection.
+        reply = self.request(s, rfile, common.ListUsers([], "alice"))
+        self.assertEqual(common.Operations.USER_LIST, reply.opcode)
+        self.assertEqual(common.Status.OK, reply.status)
+        # Bob takes deliveries by dial-back from this host, so he may send
+        # from any connection.
+        reply = self.request(other, other_rfile, common.ListUsers([], "bob"))
+        self.assertEqual(common.Status.OK, reply.status)
+
+    def quiet_user(self, nick: str, session) -> registry.User:
+        """Registers a user who was last heard from at time 0."""
+        session.last_seen = 0.0
+        user = registry.User(nick, ("127.0.0.1", 0), 0, session)
+        REGISTRY.add_user(user)
+        return user
+
+    def test_sweep_pings_then_evicts(self):
+        self.patch("HEARTBEAT", 10.0)
+        self.patch("IDLE_TIMEOUT", 30.0)
+        self.patch("EVICTIONS", 0)
+        alice = self.quiet_user("alice", FakeSession(heartbeat=True))
+        bob = self.quiet_user("bob", FakeSession())
+        REGISTRY.add_room(registry.Room("room"))
+        REGISTRY.join("alice", "room")
+        sweep(5.0)
+        self.assertEqual([], alice.session.sent)
+        sweep(15.0)
+        pings = [common.decode(data) for data in alice.session.sent]
+        self.assertEqual([(common.Operations.SERVER_PING, "alice")],
+                         [(p.opcode, p.username) for p in pings])
+        sweep(40.0)
+        self.assertIsNone(REGISTRY.find_user("alice"))
+        self.assertFalse(REGISTRY.find_room("room").contains_user("alice"))
+        self.assertTrue(alice.session.closed)
+        self.assertEqual(1, EVICTIONS)
+        # Without heartbeats, a quiet session is never pinged or evicted.
+        self.assertIs(bob, REGISTRY.find_user("bob"))
+        self.assertEqual([], bob.session.sent)
+        self.assertFalse(bob.session.closed)
+
+    def test_sweep_probes_dial_back_clients(self):
+        self.patch("HEARTBEAT", 10.0)
+        self.patch("IDLE_TIMEOUT", 30.0)
+        self.patch("EVICTIONS", 0)
+        carol = self.quiet_user("carol", Callback("carol", "127.0.0.1", 0))
+        dave = self.quiet_user("dave", Callback("dave", "127.0.0.1", 0))
+        with unittest.mock.patch.object(carol.session, "probe",
+                                        return_value=True) as answered, \
+                unittest.mock.patch.object(dave.session, "probe",
+                                           return_value=False) as refused:
+            sweep(15.0)
+            self.assertFalse(answered.called or refused.called)
+            sweep(40.0)
+        self.assertEqual(1, answered.call_count)
+        self.assertEqual(1, refused.call_count)
+        self.assertIs(carol, REGISTRY.find_user("carol"))
+        self.assertEqual(40.0, carol.session.last_seen)
+        self.assertIsNone(REGISTRY.find_user("dave"))
+        self.assertEqual(1, EVICTIONS)
+
+    def test_evict_spares_reconnected_nick(self):
+        self.patch("HEARTBEAT", 10.0)
+        self.patch("IDLE_TIMEOUT", 30.0)
+        self.patch("EVICTIONS", 0)
+        old = self.quiet_user("alice", FakeSession(heartbeat=True))
+        _, dead, _ = IRCServer.quiet_users(40.0)
+        self.assertEqual([old], dead)
+        # alice reconnects between the sweep finding her and evicting her.
+        REGISTRY.remove_user("alice", old.session)
+        new = registry.User("alice", ("127.0.0.1", 0), 0,
+                            FakeSession(heartbeat=True))
+        REGISTRY.add_user(new)
+        IRCServer.evict(dead)
+        self.assertIs(new, REGISTRY.find_user("alice"))
+        self.assertFalse(new.session.closed)
+        self.assertEqual(0, EVICTIONS)
+
+
+class FakeSession(object):
+    """Stands in for a session, keeping what's sent to it."""
+
+    binary = False
+    compressor = None
+
+    def __init__(self, heartbeat: bool = False):
+        self.heartbeat = heartbeat
+        self.last_seen = time.monotonic()
+        self.sent: List[bytes] = []
+        self.closed = False
+
+    def send(self, data: bytes):
+        self.sent.append(data)
+
+    def close(self):
+        self.closed = True
+
 
 if __name__ == "__main__":
-    with socketserver.ThreadingTCPServer((LISTEN_ADDRESS, LISTEN_PORT),
-                                         IRCServer) as server:
+    parser = argparse.ArgumentParser(description="CS594 IRC server")
+    parser.add_argument("--port",
+                        type=int,
+                        default=LISTEN_PORT,
+                        help="port to listen on (default 8080)")
+    parser.add_argument("--engine",
+                        choices=["threaded", "asyncio"],
+                        default="threaded",
+                        help="serve each connection on its own thread, or "
+                        "all of them from a single asyncio event loop")
+    parser.add_argument("--outbox-limit",
+                        type=int,
+                        default=1024,
+                        help="messages queued per user before the "
+                        "slow consumer policy applies; 0 sends messages "
+                        "from the handler without queueing (default 1024)")
+    parser.add_argument("--slow-consumer",
+                        choices=outbox.POLICIES,
+                        default=outbox.DROP_OLDEST,
+                        help="what to do when a user's queue is full "
+                        "(default drop-oldest)")
+    parser.add_argument("--writers",
+                        type=int,
+                        default=8,
+                        help="writer threads for the threaded engine "
+                        "(default 8)")
+    parser.add_argument("--history",
+                        type=int,
+                        default=100,
+                        help="recent messages kept per room for replay; 0 "
+                        "keeps none (default 100)")
+    parser.add_argument("--history-budget",
+                        type=float,
+                        default=64,
+                        help="megabytes of history kept across all rooms "
+                        "before the oldest messages are dropped "
+                        "(default 64)")
+    parser.add_argument("--message-log",
+                        metavar="DIR",
+                        help="append every room, private and broadcast "
+                        "message to a log in this directory (default off)")
+    parser.add_argument("--log-segment-size",
+                        type=float,
+                        default=64,
+                        help="megabytes written to a message log segment "
+                        "before starting the next (default 64)")
+    parser.add_argument("--log-commit-interval",
+                        type=float,
+                        default=5,
+                        help="milliseconds the message log waits to gather "
+                        "messages into one disk sync (default 5)")
+    parser.add_argument("--rate",
+                        type=limits.parse_rate,
+                        action="append",
+                        default=[],
+                        metavar="OPCODE=RATE[/BURST]",
+                        help="limit each user to RATE requests a second of "
+                        "an opcode, such as BROADCAST, with bursts of up to "
+                        "BURST; * sets the limit for opcodes not given "
+                        "their own; may be given more than once "
+                        "(default no limits)")
+    parser.add_argument("--max-users",
+                        type=int,
+                        default=0,
+                        help="most users connected at once; 0 for no limit "
+                        "(default 0)")
+    parser.add_argument("--max-rooms",
+                        type=int,
+                        default=0,
+                        help="most rooms; with --workers, most rooms each "
+                        "worker owns; 0 for no limit (default 0)")
+    parser.add_argument("--max-connections",
+                        type=int,
+                        default=0,
+                        help="most connections open at once, sessions and "
+                        "single requests alike; 0 for no limit (default 0)")
+    parser.add_argument("--compress-threshold",
+                        type=int,
+                        default=common.COMPRESS_THRESHOLD,
+                        help="bytes a binary frame needs before it is "
+                        "compressed for sessions that ask for it; 0 turns "
+                        "compression off (default 256)")
+    parser.add_argument("--heartbeat",
+                        type=float,
+                        default=0,
+                        help="seconds of quiet before a session that agreed "
+                        "to heartbeats is pinged, and between sweeps for "
+                        "dead users; 0 turns heartbeats off (default 0)")
+    parser.add_argument("--idle-timeout",
+                        type=float,
+                        default=0,
+                        help="seconds of quiet after which a heartbeat "
+                        "session is evicted and a dial-back client is "
+                        "checked on (default three heartbeats)")
+    parser.add_argument("--metrics-port",
+                        type=int,
+                        default=0,
+                        help="serve plain-text metrics over HTTP on this "
+                        "port (default off)")
+    parser.add_argument("--log-level",
+                        choices=["debug", "info", "warning", "error"],
+                        default="info",
+                        help="least severe messages to log; debug logs "
+                        "every request (default info)")
+    parser.add_argument("--trace-sample",
+                        type=float,
+                        default=0.0,
+                        help="fraction of requests to log with their "
+                        "outcome and handler time, whatever the log level "
+                        "(default 0)")
+    parser.add_argument("--workers",
+                        type=int,
+                        default=1,
+                        help="processes to serve from, each owning a share "
+                        "of the rooms; threaded engine only (default 1)")
+    parser.add_argument("--link",
+                        action="append",
+                        default=[],
+                        metavar="HOST:PORT",
+                        help="keep a link to another server; may be given "
+                        "more than once")
+    parser.add_argument("--node-name",
+                        help="this server's name on its links, which must "
+                        "be unique among linked servers; a server only "
+                        "accepts links once it has one (default host:port "
+                        "when --link is given)")
+    parser.add_argument("--worker-index", type=int, help=argparse.SUPPRESS)
+    parser.add_argument("--link-dir", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.workers > 1 and args.engine != "threaded":
+        # Handlers wait on other workers, which would stall an event loop.
+        parser.error("--workers needs the threaded engine")
+    if (args.link or args.node_name) and (args.workers > 1
+                                          or args.engine != "threaded"):
+        # Relays are applied from link threads, outside any event loop.
+        parser.error("--link and --node-name need the threaded engine and "
+                     "one worker")
+    if args.workers > 1 and args.worker_index is None:
+        run_workers(args.workers)
+        sys.exit(0)
+
+    ENGINE = args.engine
+    LISTEN_PORT = args.port
+    OUTBOX_LIMIT = args.outbox_limit
+    SLOW_CONSUMER = args.slow_consumer
+    METRICS_PORT = args.metrics_port
+    TRACE_SAMPLE = args.trace_sample
+    MAX_USERS = args.max_users
+    MAX_ROOMS = args.max_rooms
+    COMPRESS_THRESHOLD = args.compress_threshold
+    HEARTBEAT = args.heartbeat
+    IDLE_TIMEOUT = args.idle_timeout or 3 * HEARTBEAT
+    if HEARTBEAT > 0 and IDLE_TIMEOUT < HEARTBEAT:
+        parser.error("--idle-timeout must be at least --heartbeat")
+    if args.rate:
+        LIMITS = limits.RateLimits(
+            {name: (rate, burst)
+             for name, rate, burst in args.rate})
+    if args.max_connections > 0:
+        ADMISSION = limits.Admission(args.max_connections)
+    if args.history > 0:
+        HISTORY = history.History(args.history,
+                                  int(args.history_budget * 1024 * 1024))
+    start_logging(getattr(logging, args.log_level.upper()))
+    if args.worker_index is not None:
+        SHARD = shard.Shard(args.worker_index, args.workers, args.link_dir,
+                            bytes.fromhex(os.environ["IRC_LINK_KEY"]),
+                            IRCServer, MAX_ROOMS)
+        SHARD.listen()
+        ThreadingIRCServer.reuse_port = True
+        if METRICS_PORT > 0:
+            METRICS_PORT += args.worker_index
+        if args.message_log:
+            # Each worker logs what its own users send.
+            args.message_log = os.path.join(args.message_log,
+                                            "worker" + str(args.worker_index))
+        LOG.info("Worker %d of %d", args.worker_index, args.workers)
+    if args.message_log:
+        MESSAGE_LOG = msglog.MessageLog(
+            args.message_log, int(args.log_segment_size * 1024 * 1024),
+            args.log_commit_interval / 1000)
+        # History requests are answered on the event loop under asyncio, and
+        # a worker's log only has its own users' messages, so only a single
+        # threaded server reads its log back.
+        if ENGINE == "threaded" and SHARD is None:
+            LOG_READER = msglog.LogReader(args.message_log)
+    serve_metrics()
+    if args.link or args.node_name:
+        FEDERATION = federation.Federation(
+            args.node_name or LISTEN_ADDRESS + ":" + str(LISTEN_PORT),
+            REGISTRY, IRCServer)
+        for peer in args.link:
+            host, _, port = peer.rpartition(":")
+            FEDERATION.connect(host, int(port))
+
+    if ENGINE == "asyncio":
+        asyncio.run(serve_asyncio())
+        if MESSAGE_LOG is not None:
+            MESSAGE_LOG.close()
+        stop_logging()
+        sys.exit(0)
+
+    if OUTBOX_LIMIT > 0:
+        WRITERS = outbox.WriterPool(args.writers)
+    if HEARTBEAT > 0:
+        sweeper = threading.Thread(target=sweep_forever)
+        sweeper.daemon = True
+        sweeper.start()
+
+    signal.signal(signal.SIGINT, interrupt_handler)
+    with ThreadingIRCServer((LISTEN_ADDRESS, LISTEN_PORT),
+                            IRCServer) as server:
         SERVER_SOCKET = server.socket
-        print("Server started on " + str(LISTEN_ADDRESS) + ":" +
-              str(LISTEN_PORT))
+        LOG.info("Server started on %s:%s", LISTEN_ADDRESS, LISTEN_PORT)
         server.serve_forever()
@@ -0,0 +1,503 @@
+# irc.py - an IRC-like implementation for Portland State University's
+#          CS594 - Internetworking Protocols project
+#
+# Copyright (C) 2017  Jeremiah Peschka <jpeschka@pdx.edu>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+# Room and nick sharding across server worker processes for CS594 project
+
+from multiprocessing.connection import Client, Listener
+from typing import Dict, List, Set
+import logging
+import os
+import tempfile
+import threading
+import time
+import unittest
+import zlib
+import common
+import registry
+
+LOG = logging.getLogger("irc.shard")
+
+# How long a worker keeps retrying a peer that hasn't started listening yet
+CONNECT_TIMEOUT = 10.0
+
+
+def owner(name: str, workers: int) -> int:
+    """Returns the index of the worker that owns a room or nick.
+
+    Python's own hash() is salted per process, so workers would disagree.
+    """
+    return zlib.crc32(name.encode()) % workers
+
+
+def link_address(link_dir: str, index: int) -> str:
+    return os.path.join(link_dir, "worker" + str(index))
+
+
+class Peer(object):
+    """Links this worker to another one.
+
+    Calls wait for the peer's answer; casts don't. Each has its own
+    connection so a call in progress never holds up fan-out traffic, and
+    casts from one worker to another arrive in the order they were sent.
+    """
+
+    def __init__(self, address: str, authkey: bytes):
+        self.address = address
+        self.authkey = authkey
+        self.call_lock = threading.Lock()
+        self.cast_lock = threading.Lock()
+        self.call_conn = None
+        self.cast_conn = None
+
+    def connect(self):
+        deadline = time.monotonic() + CONNECT_TIMEOUT
+        while True:
+            try:
+                return Client(self.address, "AF_UNIX", authkey=self.authkey)
+            except (FileNotFoundError, ConnectionRefusedError):
+                # The peer may still be starting up.
+                if time.monotonic() > deadline:
+                    raise
+                time.sleep(0.05)
+
+    def call(self, method: str, *args):
+        with self.call_lock:
+            if self.call_conn is None:
+                self.call_conn = self.connect()
+            self.call_conn.send((method, args, True))
+            return self.call_conn.recv()
+
+    def cast(self, method: str, *args):
+        with self.cast_lock:
+            if self.cast_conn is None:
+                self.cast_conn = self.connect()
+            self.cast_conn.send((method, args, False))
+
+
+class Shard(object):
+    """One worker's part of a server split over several processes.
+
+    Every room and nick is owned by exactly one worker, picked by owner().
+    The owner of a nick knows which worker the user is connected to; the
+    owner of a room knows whether it exists and which members it has on
+    which worker. Room messages go to the room's owner, which passes them
+    on once to each worker with members there, and that worker delivers
+    them to its own users; presence changes take the same route. `local`
+    does the delivering and must provide deliver_room, deliver_user,
+    deliver_all and deliver_presence.
+
+    Methods named remote_* are what other workers can call or cast.
+    """
+
+    def __init__(self, index: int, workers: int, link_dir: str,
+                 authkey: bytes, local, room_limit: int = 0):
+        self.index = index
+        self.workers = workers
+        self.link_dir = link_dir
+        self.authkey = authkey
+        self.local = local
+        # Most rooms this worker owns; 0 for no limit
+        self.room_limit = room_limit
+        self.lock = threading.Lock()
+        # Owned nicks -> index of the worker they are connected to
+        self.nicks: Dict[str, int] = dict()
+        # Owned rooms -> member nicks -> index of their worker
+        self.rooms: Dict[str, Dict[str, int]] = dict()
+        # Sorted owned nicks, owned rooms and members of each owned room,
+        # for paged listings
+        self.nick_index = registry.SortedNames()
+        self.room_index = registry.SortedNames()
+        self.member_index: Dict[str, registry.SortedNames] = dict()
+        # Rooms known to exist, wherever they are owned. Rooms are never
+        # removed, so this only grows.
+        self.known_rooms: Set[str] = set()
+        self.peers = [
+            None if i == index else Peer(link_address(link_dir, i), authkey)
+            for i in range(workers)
+        ]
+        self.listener = None
+
+    def listen(self):
+        """Starts accepting links from the other workers."""
+        self.listener = Listener(link_address(self.link_dir, self.index),
+                                 "AF_UNIX",
+                                 authkey=self.authkey)
+        threading.Thread(target=self.accept_forever, daemon=True).start()
+
+    def accept_forever(self):
+        while True:
+            try:
+                conn = self.listener.accept()
+            except OSError:
+                return
+            threading.Thread(target=self.serve, args=(conn, ),
+                             daemon=True).start()
+
+    def serve(self, conn):
+        try:
+            while True:
+                method, args, wants_reply = conn.recv()
+                result = getattr(self, "remote_" + method)(*args)
+                if wants_reply:
+                    conn.send(result)
+        except (EOFError, OSError):
+            pass
+        finally:
+            conn.close()
+
+    def call(self, index: int, method: str, *args):
+        if index == self.index:
+            return getattr(self, "remote_" + method)(*args)
+        return self.peers[index].call(method, *args)
+
+    def cast(self, index: int, method: str, *args):
+        if index == self.index:
+            getattr(self, "remote_" + method)(*args)
+        else:
+            self.peers[index].cast(method, *args)
+
+    def owner(self, name: str) -> int:
+        return owner(name, self.workers)
+
+    # Used by this worker's handlers
+
+    def claim_nick(self, nick: str) -> bool:
+        return self.call(self.owner(nick), "claim_nick", nick, self.index)
+
+    def release_nick(self, nick: str, rooms: List[str]):
+        for name in rooms:
+            self.cast(self.owner(name), "part", name, nick)
+        self.cast(self.owner(nick), "release_nick", nick, self.index)
+
+    def create_room(self, name: str) -> bool:
+        """Returns False if the room already exists, or None if its owner
+        already owns room_limit rooms."""
+        created = self.call(self.owner(name), "create_room", name)
+        if created is not None:
+            self.known_rooms.add(name)
+        return created
+
+    def join(self, nick: str, name: str) -> bool:
+        if not self.call(self.owner(name), "join", name, nick, self.index):
+            return False
+        self.known_rooms.add(name)
+        return True
+
+    def leave(self, nick: str, name: str) -> bool:
+        """Returns False if the user wasn't in the room, or None if there's
+        no such room."""
+        return self.call(self.owner(name), "part", name, nick)
+
+    def room_exists(self, name: str) -> bool:
+        if name in self.known_rooms:
+            return True
+        if self.call(self.owner(name), "has_room", name):
+            self.known_rooms.add(name)
+            return True
+        return False
+
+    def message_room(self, packet: common.MessageRoom) -> bool:
+        if not self.room_exists(packet.room):
+            return False
+        self.cast(self.owner(packet.room), "room_message", packet)
+        return True
+
+    def private_message(self, packet: common.PrivateMessage) -> bool:
+        index = self.call(self.owner(packet.to), "locate", packet.to)
+        if index is None:
+            return False
+        self.cast(index, "deliver_user", packet)
+        return True
+
+    def room_presence(self, packet: common.Presence):
+        self.cast(self.owner(packet.room), "room_presence", packet)
+
+    def broadcast(self, packet: common.Broadcast):
+        for index in range(self.workers):
+            self.cast(index, "deliver_all", packet)
+
+    def room_members(self, name: str):
+        return self.call(self.owner(name), "room_members", name)
+
+    def room_names(self) -> List[str]:
+        names = []
+        for index in range(self.workers):
+            names.extend(self.call(index, "owned_rooms"))
+        return names
+
+    def user_names(self) -> List[str]:
+        names = []
+        for index in range(self.workers):
+            names.extend(self.call(index, "owned_nicks"))
+        return names
+
+    def room_page(self, after: str, limit: int, prefix: str):
+        return registry.merge_pages(
+            (self.call(index, "room_page", after, limit, prefix)
+             for index in range(self.workers)), limit)
+
+    def user_page(self, after: str, limit: int, prefix: str):
+        return registry.merge_pages(
+            (self.call(index, "nick_page", after, limit, prefix)
+             for index in range(self.workers)), limit)
+
+    def member_page(self, name: str, after: str, limit: int, prefix: str):
+        return self.call(self.owner(name), "member_page", name, after, limit,
+                         prefix)
+
+    # Called by other workers, or by this one for what it owns
+
+    def remote_claim_nick(self, nick: str, index: int) -> bool:
+        with self.lock:
+            if nick in self.nicks:
+                return False
+            self.nicks[nick] = index
+            self.nick_index.add(nick)
+            return True
+
+    def remote_release_nick(self, nick: str, index: int):
+        with self.lock:
+            if self.nicks.get(nick) == index:
+                del self.nicks[nick]
+                self.nick_index.discard(nick)
+
+    def remote_locate(self, nick: str):
+        return self.nicks.get(nick)
+
+    def remote_create_room(self, name: str) -> bool:
+        with self.lock:
+            if name in self.rooms:
+                return False
+            if self.room_limit and len(self.rooms) >= self.room_limit:
+                return None
+            self.rooms[name] = dict()
+            self.room_index.add(name)
+            self.member_index[name] = registry.SortedNames()
+            return True
+
+    def remote_has_room(self, name: str) -> bool:
+        return name in self.rooms
+
+    def remote_join(self, name: str, nick: str, index: int) -> bool:
+        with self.lock:
+            members = self.rooms.get(name)
+            if members is None:
+                return False
+            members[nick] = index
+            self.member_index[name].add(nick)
+            return True
+
+    def remote_part(self, name: str, nick: str) -> bool:
+        with self.lock:
+            members = self.rooms.get(name)
+            if members is None:
+                return None
+            if members.pop(nick, None) is None:
+                return False
+            self.member_index[name].discard(nick)
+            return True
+
+    def remote_room_members(self, name: str):
+        with self.lock:
+            members = self.rooms.get(name)
+            return None if members is None else list(members)
+
+    def remote_owned_rooms(self) -> List[str]:
+        with self.lock:
+            return list(self.rooms)
+
+    def remote_owned_nicks(self) -> List[str]:
+        with self.lock:
+            return list(self.nicks)
+
+    def remote_room_page(self, after: str, limit: int, prefix: str):
+        with self.lock:
+            return self.room_index.page(after, limit, prefix)
+
+    def remote_nick_page(self, after: str, limit: int, prefix: str):
+        with self.lock:
+            return self.nick_index.page(after, limit, prefix)
+
+    def remote_member_page(self, name: str, after: str, limit: int,
+                           prefix: str):
+        with self.lock:
+            members = self.member_index.get(name)
+            return None if members is None else members.page(
+                after, limit, prefix)
+
+    def remote_room_message(self, packet: common.MessageRoom):
+        with self.lock:
+            members = self.rooms.get(packet.room)
+            workers = set(members.values()) if members is not None else ()
+        for index in workers:
+            self.cast(index, "deliver_room", packet)
+
+    def remote_room_presence(self, packet: common.Presence):
+        with self.lock:
+            members = self.rooms.get(packet.room)
+            workers = set(members.values()) if members is not None else ()
+        for index in workers:
+            self.cast(index, "deliver_presence", packet)
+
+    def remote_deliver_room(self, packet: common.MessageRoom):
+        self.local.deliver_room(packet)
+
+    def remote_deliver_user(self, packet: common.PrivateMessage):
+        self.local.deliver_user(packet)
+
+    def remote_deliver_all(self, packet: common.Broadcast):
+        self.local.deliver_all(packet)
+
+    def remote_deliver_presence(self, packet: common.Presence):
+        self.local.deliver_presence(packet)
+
+
+class RecordingLocal(object):
+    """Stands in for a worker's users and keeps what it was asked to
+    deliver."""
+
+    def __init__(self):
+        self.delivered = []
+
+    def deliver_room(self, packet):
+        self.delivered.append(("room", packet))
+
+    def deliver_user(self, packet):
+        self.delivered.append(("user", packet))
+
+    def deliver_all(self, packet):
+        self.delivered.append(("all", packet))
+
+    def deliver_presence(self, packet):
+        self.delivered.append(("presence", packet))
+
+
+class TestShard(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.locals = [RecordingLocal() for _ in range(3)]
+        self.shards = [
+            Shard(i, 3, self.dir.name, b"key", self.locals[i])
+            for i in range(3)
+        ]
+        for shard in self.shards:
+            shard.listen()
+
+    def tearDown(self):
+        for shard in self.shards:
+            shard.listener.close()
+        self.dir.cleanup()
+
+    def wait_for(self, condition):
+        # Casts are one-way, so give them a moment to be handled.
+        deadline = time.monotonic() + 5
+        while not condition():
+            if time.monotonic() > deadline:
+                self.fail("timed out")
+            time.sleep(0.01)
+
+    def test_owner_is_stable(self):
+        self.assertEqual(owner("room", 3), owner("room", 3))
+        self.assertEqual({0, 1, 2},
+                         {owner("room" + str(i), 3)
+                          for i in range(30)})
+
+    def test_nicks_are_global(self):
+        self.assertTrue(self.shards[0].claim_nick("alice"))
+        self.assertFalse(self.shards[1].claim_nick("alice"))
+        self.assertEqual(["alice"], self.shards[2].user_names())
+        self.shards[0].release_nick("alice", [])
+        self.wait_for(lambda: self.shards[2].claim_nick("alice"))
+
+    def test_room_limit_is_kept_by_owner(self):
+        names = [name for name in ("room" + str(i) for i in range(30))
+                 if owner(name, 3) == 2]
+        self.shards[2].room_limit = 2
+        self.assertTrue(self.shards[0].create_room(names[0]))
+        self.assertTrue(self.shards[1].create_room(names[1]))
+        self.assertFalse(self.shards[0].create_room(names[1]))
+        self.assertIsNone(self.shards[1].create_room(names[2]))
+        self.assertFalse(self.shards[1].room_exists(names[2]))
+
+    def test_room_message_reaches_member_workers(self):
+        self.assertTrue(self.shards[0].create_room("room"))
+        self.assertFalse(self.shards[1].create_room("room"))
+        self.assertTrue(self.shards[1].join("bob", "room"))
+        self.assertTrue(self.shards[2].join("carol", "room"))
+        self.assertFalse(self.shards[2].join("carol", "other"))
+        self.assertEqual(["bob", "carol"],
+                         self.shards[0].room_members("room"))
+        packet = common.MessageRoom("room", "hello", "alice")
+        self.assertTrue(self.shards[0].message_room(packet))
+        self.assertFalse(self.shards[0].message_room(
+            common.MessageRoom("other", "hello", "alice")))
+        self.wait_for(lambda: self.locals[1].delivered and self.locals[2].
+                      delivered)
+        self.assertEqual([], self.locals[0].delivered)
+        self.assertEqual([("room", packet)], self.locals[1].delivered)
+        self.assertEqual([("room", packet)], self.locals[2].delivered)
+
+    def test_leave(self):
+        self.shards[0].create_room("room")
+        self.assertTrue(self.shards[1].join("bob", "room"))
+        self.assertTrue(self.shards[1].leave("bob", "room"))
+        self.assertFalse(self.shards[1].leave("bob", "room"))
+        self.assertIsNone(self.shards[1].leave("bob", "other"))
+        self.assertEqual([], self.shards[2].room_members("room"))
+
+    def test_presence_reaches_member_workers(self):
+        self.shards[0].create_room("room")
+        self.shards[1].join("bob", "room")
+        self.shards[0].join("alice", "room")
+        packet = common.Presence("room", "alice", common.PRESENCE_JOIN)
+        self.shards[0].room_presence(packet)
+        self.wait_for(lambda: self.locals[0].delivered and self.locals[1].
+                      delivered)
+        self.assertEqual([("presence", packet)], self.locals[1].delivered)
+        self.assertEqual([], self.locals[2].delivered)
+
+    def test_pages(self):
+        for i, nick in enumerate(("dave", "alice", "dan", "bob", "carol")):
+            self.shards[i % 3].claim_nick(nick)
+        self.assertEqual((["alice", "bob"], True),
+                         self.shards[0].user_page("", 2, ""))
+        self.assertEqual((["carol", "dan"], True),
+                         self.shards[1].user_page("bob", 2, ""))
+        self.assertEqual((["dave"], False),
+                         self.shards[2].user_page("dan", 2, ""))
+        self.assertEqual((["dan", "dave"], False),
+                         self.shards[2].user_page("", 0, "da"))
+        self.shards[0].create_room("room")
+        self.shards[1].join("bob", "room")
+        self.shards[2].join("alice", "room")
+        self.assertEqual((["alice"], True),
+                         self.shards[1].member_page("room", "", 1, ""))
+        self.assertIsNone(self.shards[1].member_page("other", "", 1, ""))
+
+    def test_private_message(self):
+        self.shards[2].claim_nick("carol")
+        packet = common.PrivateMessage("alice", "carol", "hi")
+        self.assertTrue(self.shards[0].private_message(packet))
+        self.assertFalse(self.shards[0].private_message(
+            common.PrivateMessage("alice", "nobody", "hi")))
+        self.wait_for(lambda: self.locals[2].delivered)
+        self.assertEqual([("user", packet)], self.locals[2].delivered)
+
+
+if __name__ == '__main__':
+    unittest.main()